@@ -7,6 +7,7 @@ from utils.utils import load_config
 from utils.logger import logger
 
 from typing import Optional, List, Dict, Any    
+import json
 
 
 # 实例化信息中心（全局单例）
@@ -56,6 +57,59 @@ class APIServer:
             result = self.info_center.update_prefix_tree(data)
             return JSONResponse(result)
 
+        @app.post("/v1/Nexuts/resync_instance")
+        async def resync_instance(request: Request):
+            """
+            实例全量同步，流式读取请求体：
+            - application/json: {"sentry_id", "instance_id", "tree": Sentry /v1/radixtree/full 形状的树}
+            - application/x-ndjson: 第一行 {"sentry_id", "instance_id"}，之后每行一条极大路径 [prompt, prompt_value]
+            """
+            if "ndjson" in request.headers.get("content-type", ""):
+                data, paths, pending = None, [], b""
+                async for chunk in request.stream():
+                    lines = (pending + chunk).split(b"\n")
+                    pending = lines.pop()
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        item = json.loads(line)
+                        if data is None:
+                            data = item
+                        else:
+                            paths.append(item)
+                if pending.strip():
+                    item = json.loads(pending)
+                    if data is None:
+                        data = item
+                    else:
+                        paths.append(item)
+                if data is None:
+                    return JSONResponse({"result": "failed", "message": "empty body"}, status_code=400)
+                data["paths"] = paths
+            else:
+                data = json.loads(await request.body())
+            return JSONResponse(self.info_center.resync_instance(data))
+
+        @app.get("/v1/Nexuts/tree_stats")
+        async def tree_stats():
+            """前缀树规模：节点数、token数、各实例覆盖、深度分布、平均扇出"""
+            return JSONResponse(self.info_center.get_tree_stats())
+
+        @app.get("/v1/Nexuts/ingest_metrics")
+        async def ingest_metrics():
+            """前缀树写入 lane 的队列深度"""
+            return JSONResponse(self.info_center.get_ingest_metrics())
+
+        @app.get("/v1/Nexuts/wal_metrics")
+        async def wal_metrics():
+            """WAL 落盘统计：落盘策略、fdatasync 次数、平均批大小、提交延迟、启动回放进度"""
+            return JSONResponse(self.info_center.get_wal_metrics())
+
+        @app.get("/v1/Nexuts/anti_entropy")
+        async def anti_entropy_metrics():
+            """和 Sentry 摘要比对的统计：请求数、流量、不一致路径数、修复数"""
+            return JSONResponse(self.info_center.get_anti_entropy_metrics())
+
         # @app.get("/instances")
         # async def list_instances():
         #     """查看当前注册的实例"""
@@ -67,8 +121,8 @@ class APIServer:
             return JSONResponse({"status": "ok"})
 
         @app.get("/v1/Nexuts/get_best_instance")  
-        async def get_best_instance(prompt_tokens: Optional[str] = None):  
-            """双重策略路由：缓存感知 + 负载均衡"""  
+        async def get_best_instance(prompt_tokens: Optional[str] = None, session_id: Optional[str] = None):  
+            """双重策略路由：缓存感知 + 负载均衡。session_id 可选，同一会话的多轮请求复用上一轮的前缀匹配位置"""  
               
             logger.info("prompt_tokens:{}".format(prompt_tokens))
             # 解析查询参数中的token列表  
@@ -128,7 +182,7 @@ class APIServer:
                 logger.info("1111111111111111111111111")
                 # logger.info("系统负载均衡，进入缓存感知路由")
                 # 尝试缓存感知路由  
-                cache_worker = self.info_center.find_worker_by_cache(token_list)  
+                cache_worker = self.info_center.find_worker_by_cache(token_list, session_id=session_id)  
                 logger.info("2222222222222222222222222")
                 if cache_worker:  
                     logger.info("router strategy: cache_aware, cache_worker:{}".format(cache_worker))
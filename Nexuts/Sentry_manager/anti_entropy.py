@@ -0,0 +1,110 @@
+import threading
+import time
+from typing import Dict, Any, List, Callable, Tuple
+
+from curl_cffi import requests
+
+from Tree.path_digest import LEVELS, FANOUT_BITS
+from Tree.tree import MergePrefixTree
+from Sentry_manager.Sentry import Sentry
+from utils.logger import logger
+
+
+class AntiEntropy:
+    """
+    定期和各 Sentry 上 prefill 实例的 RadixTree 做 Merkle 摘要比对：
+    从根开始逐层只展开哈希不一致的桶，到叶子桶后才拉取具体路径，带宽和不一致的规模成正比，和树的大小无关。
+    推送中的变更会造成短暂不一致，所以同一条路径连续两轮比对都不一致才修复；修复操作走 update_prefix_tree（写 WAL、按实例 lane 顺序执行）。
+    """
+
+    def __init__(self,
+                 tree: MergePrefixTree,
+                 list_sentries: Callable[[], List[Tuple[Sentry, List[str]]]],
+                 interval_seconds: float = 60,
+                 timeout_seconds: float = 3):
+        """
+        :param list_sentries: 返回 [(sentry, [prefill instance_id...])]，只比对在线的 Sentry
+        """
+        self.tree = tree
+        self.list_sentries = list_sentries
+        self.interval_seconds = float(interval_seconds)
+        self.timeout_seconds = float(timeout_seconds)
+        self._pending: Dict[str, set] = {}  # instance_id -> 上一轮不一致的路径哈希
+        self.metrics: Dict[str, Any] = {
+            "rounds": 0,
+            "requests": 0,
+            "bytes_received": 0,
+            "diff_paths": 0,
+            "repaired_insert": 0,
+            "repaired_delete": 0,
+            "errors": 0,
+            "last_round_seconds": 0.0,
+            "instances": {},  # instance_id -> 最近一次比对结果
+        }
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="anti-entropy", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval_seconds):
+            self.run_once()
+
+    def run_once(self):
+        begin = time.time()
+        for sentry, instance_ids in self.list_sentries():
+            for instance_id in instance_ids:
+                try:
+                    self.metrics["instances"][instance_id] = self.sync_instance(sentry, instance_id)
+                except Exception as e:
+                    self.metrics["errors"] += 1
+                    logger.warning(f"[AntiEntropy] sync {instance_id} with sentry {sentry.sentry_id} failed: {e}")
+        self.metrics["rounds"] += 1
+        self.metrics["last_round_seconds"] = round(time.time() - begin, 3)
+
+    def _post(self, sentry: Sentry, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        resp = requests.post(f"http://{sentry.ip}:{sentry.port}{path}", json=body, timeout=self.timeout_seconds)
+        self.metrics["requests"] += 1
+        self.metrics["bytes_received"] += len(resp.content)
+        if resp.status_code != 200:
+            raise RuntimeError(f"{path} bad status {resp.status_code}")
+        return resp.json()
+
+    def sync_instance(self, sentry: Sentry, instance_id: str) -> Dict[str, Any]:
+        level, frontier = 0, [0]
+        while True:
+            remote = self._post(sentry, "/v1/radixtree/digest",
+                                {"instance_id": instance_id, "level": level, "buckets": frontier})["digest"]
+            local = self.tree.digest_children(instance_id, level, frontier)
+            next_frontier = []
+            for bucket in frontier:
+                remote_item, local_item = remote[str(bucket)], local[str(bucket)]
+                if remote_item["hash"] == local_item["hash"]:
+                    continue
+                for i, (remote_child, local_child) in enumerate(zip(remote_item["children"], local_item["children"])):
+                    if remote_child != local_child:
+                        next_frontier.append((bucket << FANOUT_BITS) + i)
+            level, frontier = level + 1, next_frontier
+            if not frontier or level == LEVELS:
+                break
+
+        result = {"leaf_buckets": len(frontier), "diff_paths": 0, "repaired": 0, "ts": time.time()}
+        if not frontier:
+            self._pending.pop(instance_id, None)
+            return result
+
+        paths = self._post(sentry, "/v1/radixtree/paths", {"instance_id": instance_id, "buckets": frontier})["paths"]
+        diff, ops = self.tree.reconcile_ops(instance_id, frontier, paths, confirmed=self._pending.get(instance_id, set()))
+        self._pending[instance_id] = diff
+        result["diff_paths"] = len(diff)
+        result["repaired"] = len(ops)
+        self.metrics["diff_paths"] += len(diff)
+        if ops:
+            self.tree.update_prefix_tree({"updates": ops})
+            self.metrics["repaired_delete"] += sum(1 for op in ops if op["op_type"] == "delete_node")
+            self.metrics["repaired_insert"] += sum(1 for op in ops if op["op_type"] == "insert_node")
+            logger.info(f"[AntiEntropy] instance {instance_id}: {len(frontier)} leaf buckets differ, "
+                        f"{len(diff)} paths differ, repaired {len(ops)}")
+        return result
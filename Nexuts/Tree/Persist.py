@@ -5,7 +5,7 @@ import lz4.frame
 import queue
 import time
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
 from typing import List, Any, Dict, Tuple, Optional, Set
 import threading
 import concurrent.futures
@@ -94,7 +94,8 @@ class PersistenceManager:
             data_dir: str = "./prefix_tree_persist",
             wal_max_size: int = 512 * 1024 * 1024,  # 单WAL文件最大512MB
             snap_interval: int = 1800,  # 快照间隔30分钟（可调整）
-            snap_keep_count: int = 1  # 只保留最新1个快照（核心配置）
+            snap_keep_count: int = 1,  # 只保留最新1个快照（核心配置）
+            snap_workers: int = 4  # 快照按根节点的子树分给这么多个线程并行序列化，各写一个分段文件
     ):
         self.data_dir = data_dir
         self.wal_dir = os.path.join(data_dir, "wal")
@@ -111,6 +112,8 @@ class PersistenceManager:
         # 快照配置
         self.snap_interval = snap_interval
         self.snap_keep_count = snap_keep_count
+        self.snap_workers = max(int(snap_workers), 1)
+        self._snap_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.snap_workers)
         self.tree: Optional["MergePrefixTree"] = None  # 关联的前缀树实例
         self.snap_thread = threading.Thread(target=self._snapshot_loop, daemon=True)
         self.snap_thread.start()
@@ -170,20 +173,25 @@ class PersistenceManager:
             # 步骤3：强制轮转WAL（关键！快照后任务写入新WAL）
             self._rotate_wal()
 
-            # 步骤4：序列化一致性快照（基于snap_version）
-            print(f"[快照] 开始序列化（版本：{snap_version}）...")
-            snapshot_data = self._serialize_consistent_tree(snap_version)
-            node_count = len(snapshot_data["nodes"])
+            # 步骤4+5：根节点的子树分给多个线程，各自边遍历边序列化，经 lz4 帧流式压缩写入自己的分段文件；
+            # 快照文件本身是清单（根节点 + 分段文件列表），最后写入
+            print(f"[快照] 开始序列化（版本：{snap_version}，{self.snap_workers}个分段）...")
+            temp_file = os.path.join(self.snap_dir, f"tmp_{snap_version}.snap")
+            sections = [f"sec_{snap_version}_{i}.snap" for i in range(self.snap_workers)]
+            try:
+                node_count = self._write_snapshot_sections(temp_file, sections, snap_version)
+            except Exception:
+                for path in [temp_file] + [os.path.join(self.snap_dir, name) for name in sections]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
             print(f"[快照] 序列化完成，共{node_count}个节点")
 
-            # 步骤5：写入快照文件（lz4压缩）
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             snap_file = os.path.join(
                 self.snap_dir, f"snap_{timestamp}_{snap_version}_{node_count}.snap"
             )
-            with open(snap_file, "wb") as f:
-                compressed_data = lz4.frame.compress(pickle.dumps(snapshot_data))
-                f.write(compressed_data)
+            os.replace(temp_file, snap_file)  # 写完才改名，半截的快照不会被恢复流程选中
 
             # 步骤6：清理旧快照（只留最新1个）
             self._clean_expired_snaps()
@@ -201,19 +209,79 @@ class PersistenceManager:
             self.tree.set_snap_running(False)
             print(f"[快照] 资源清理完成（版本：{snap_version}）\n")
 
-    def _serialize_consistent_tree(self, snap_version: int) -> Dict:
-        """序列化一致性快照（遍历所有节点，基于快照版本获取状态）"""
-        snapshot_data = {
-            "root_id": self.tree.root.id,
-            "nodes": {},
-            "snap_version": snap_version,
-            "create_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def _write_snapshot_sections(self, manifest_file: str, sections: List[str], snap_version: int) -> int:
+        """
+        流式快照格式：文件头字典 + 每个节点一条 (node_id, 节点状态) + 结束标记 None，依次 pickle 进同一个 lz4 帧流。
+        清单文件头里有分段文件列表，清单只含根节点；根节点的各子树按轮转分到各分段。返回写入的节点数
+        """
+        node_index = self._build_node_index()
+        root = self.tree.root
+        root_state = root.get_snap_state(snap_version)
+        child_ids = [child_id for _, child_id in root_state["children"]] if root_state else []
+        jobs = [
+            self._snap_executor.submit(self._write_section, os.path.join(self.snap_dir, name),
+                                  child_ids[i::len(sections)], node_index, snap_version)
+            for i, name in enumerate(sections)
+        ]
+        node_count = sum(job.result() for job in jobs)
+
+        with lz4.frame.open(manifest_file, "wb") as f:
+            pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickler.dump({
+                "format": "sections",
+                "root_id": root.id,
+                "snap_version": snap_version,
+                "sections": sections,
+                "create_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
+            if root_state:
+                pickler.dump((root.id, self._node_record(root_state)))
+                node_count += 1
+            pickler.dump(None)
+        return node_count
+
+    def _write_section(self, section_file: str, start_ids: List[int], node_index: Dict[int, TreeNode],
+                       snap_version: int) -> int:
+        """写一个分段文件：start_ids 这些子树的全部节点"""
+        node_count = 0
+        with lz4.frame.open(section_file, "wb") as f:
+            pickler = pickle.Pickler(f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickler.dump({"format": "section", "snap_version": snap_version})
+            for node_id, node_data in self._serialize_consistent_tree(snap_version, start_ids, node_index):
+                pickler.dump((node_id, node_data))
+                pickler.clear_memo()  # 不让 memo 表随节点数增长
+                node_count += 1
+            pickler.dump(None)
+        return node_count
+
+    def _build_node_index(self) -> Dict[int, TreeNode]:
+        """遍历一遍当前树，建立 node_id → 节点的索引，序列化时按 id 找子节点是 O(1)"""
+        node_index = {}
+        stack = [self.tree.root]
+        while stack:
+            node = stack.pop()
+            node_index[node.id] = node
+            with node.lock:
+                stack.extend(node.children.values())
+        return node_index
+
+    @staticmethod
+    def _node_record(node_state: Dict) -> Dict:
+        return {
+            "parent_id": node_state["parent_id"],
+            "key": node_state["key"],
+            "decode_string": node_state["decode_string"],
+            "value": node_state["value"],
+            "children": node_state["children"]  # token→node.id映射
         }
+
+    def _serialize_consistent_tree(self, snap_version: int, start_ids: List[int], node_index: Dict[int, TreeNode]):
+        """从 start_ids 这些节点开始 BFS，逐个产出一致性快照的节点 (node_id, 节点状态)，基于快照版本获取状态"""
         visited = set()
-        queue = [self.tree.root]
+        queue = deque(node_index[node_id] for node_id in start_ids if node_id in node_index)
 
         while queue:
-            node = queue.pop(0)
+            node = queue.popleft()
             if node.id in visited:
                 continue
             visited.add(node.id)
@@ -223,36 +291,14 @@ class PersistenceManager:
             if not node_state:
                 continue
 
-            # 序列化节点状态
-            snapshot_data["nodes"][node.id] = {
-                "parent_id": node_state["parent_id"],
-                "key": node_state["key"],
-                "decode_string": node_state["decode_string"],
-                "value": node_state["value"],
-                "children": node_state["children"]  # token→node.id映射
-            }
+            yield node.id, self._node_record(node_state)
 
-            # 遍历子节点（基于快照版本的子节点列表）
+            # 遍历子节点（基于快照版本的子节点列表；用户自行维护节点存在性，这里假设节点未被物理删除）
             for _, child_id in node_state["children"]:
-                # 递归查找子节点（用户自行维护节点存在性，这里假设节点未被物理删除）
-                child_node = self._find_node_by_id(child_id, self.tree.root, visited)
+                child_node = node_index.get(child_id)
                 if child_node and child_node.id not in visited:
                     queue.append(child_node)
 
-        return snapshot_data
-
-    def _find_node_by_id(self, target_id: int, current_node: TreeNode, visited: Set[int]) -> Optional[TreeNode]:
-        """递归查找节点（基于节点ID）"""
-        if current_node.id == target_id:
-            return current_node
-        visited.add(current_node.id)
-        for child in current_node.children.values():
-            if child.id not in visited:
-                result = self._find_node_by_id(target_id, child, visited)
-                if result:
-                    return result
-        return None
-
     def _clean_expired_snaps(self):
         """清理旧快照：只保留最新1个"""
         snaps = sorted(
@@ -267,6 +313,14 @@ class PersistenceManager:
                     print(f"[快照清理] 删除旧快照：{snap}")
                 except Exception as e:
                     print(f"[快照清理] 失败：{snap} → {e}")
+        # 分段文件名：sec_{快照版本}_{序号}.snap，不属于保留快照的一并删除
+        keep_versions = {snap.split("_")[3] for snap in snaps[:self.snap_keep_count]}
+        for section in os.listdir(self.snap_dir):
+            if section.startswith("sec_") and section.split("_")[1] not in keep_versions:
+                try:
+                    os.remove(os.path.join(self.snap_dir, section))
+                except Exception as e:
+                    print(f"[快照清理] 失败：{section} → {e}")
 
     def _clean_expired_wal(self, snap_version: int):
         """清理过期WAL：删除所有早于快照版本的WAL（仅留快照后新生成的WAL）"""
@@ -327,9 +381,8 @@ class PersistenceManager:
 
     def _deserialize_snap(self, snap_file: str, tree: "MergePrefixTree") -> int:
         """反序列化快照到树，返回快照版本"""
-        with open(snap_file, "rb") as f:
-            compressed_data = f.read()
-            snapshot_data = pickle.loads(lz4.frame.decompress(compressed_data))
+        with lz4.frame.open(snap_file, "rb") as f:
+            snapshot_data = self._read_snapshot_stream(f)
 
         # 1. 重建节点字典
         node_map: Dict[int, TreeNode] = {}
@@ -359,6 +412,31 @@ class PersistenceManager:
 
         return snapshot_data["snap_version"]
 
+    def _read_snapshot_stream(self, f) -> Dict:
+        """读取流式快照清单和它的各分段；兼容旧格式（整个快照字典一次 pickle）"""
+        unpickler = pickle.Unpickler(f)
+        header = unpickler.load()
+        if header.get("format") not in ("stream", "sections"):
+            return header
+        nodes = {}
+        self._read_node_entries(unpickler, nodes)
+        for section in header.get("sections", []):
+            with lz4.frame.open(os.path.join(self.snap_dir, section), "rb") as section_file:
+                section_unpickler = pickle.Unpickler(section_file)
+                section_unpickler.load()  # 分段文件头
+                self._read_node_entries(section_unpickler, nodes)
+        header["nodes"] = nodes
+        return header
+
+    @staticmethod
+    def _read_node_entries(unpickler: pickle.Unpickler, nodes: Dict):
+        while True:
+            entry = unpickler.load()
+            if entry is None:
+                break
+            node_id, node_data = entry
+            nodes[node_id] = node_data
+
     def _get_wal_after_snap(self, snap_file: str) -> List[str]:
         """获取快照后的WAL文件（仅新生成的WAL）"""
         # 快照文件名格式：snap_20251117_100000_123456_100.snap
@@ -0,0 +1,101 @@
+import threading
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from Tree.token_key import _ITEMSIZE
+
+
+def _chain(prev: int, data) -> int:
+    """
+    g_j = adler32 << 32 | crc32，两者都在 g_{j-1} 对应的半边上继续累加第 j 段 token 的字节。
+    只用于路由命中判断，碰撞的代价只是一次错误的路由，不需要加密哈希；zlib 的两个校验都能增量续算，比逐段 blake2b 快 3 倍左右
+    """
+    return zlib.adler32(data, prev >> 32) << 32 | zlib.crc32(data, prev & 0xFFFFFFFF)
+
+
+class CheckpointIndex:
+    """
+    前缀检查点索引：每隔 interval 个 token 记录一次前缀的链式哈希，(偏移, 哈希) -> 包含该偏移的节点。
+    哈希只取决于前缀内容（g_0 = 0，逐段链式计算），和树怎么切分节点无关，split 只需要把记录挪到前半节点。
+    节点上的 checkpoints 是落在该节点区间 (depth - len(key), depth] 内的 [(偏移, 哈希)]。
+    """
+
+    def __init__(self, interval: int):
+        self.interval = int(interval)
+        self.table: Dict[Tuple[int, int], Any] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.table)
+
+    def prompt_hashes(self, prompt, count: int) -> List[int]:
+        """prompt（TokenKey）前 count 个检查点的哈希 g_1..g_count，一次顺序扫描"""
+        hashes = []
+        g = 0
+        raw = prompt._bytes()
+        step = self.interval * _ITEMSIZE
+        for j in range(count):
+            g = _chain(g, raw[j * step:(j + 1) * step])
+            hashes.append(g)
+        return hashes
+
+    def extend(self, offset: int, g: int, prompt, end: int) -> List[Tuple[int, int]]:
+        """从检查点 (offset, g) 开始沿 prompt 继续链式计算，返回 (offset, end] 内的所有检查点"""
+        entries = []
+        raw = prompt._bytes()
+        while offset + self.interval <= end:
+            g = _chain(g, raw[offset * _ITEMSIZE:(offset + self.interval) * _ITEMSIZE])
+            offset += self.interval
+            entries.append((offset, g))
+        return entries
+
+    def scan(self, offset: int, g: int, data: bytes) -> Tuple[List[Tuple[int, int]], bytes]:
+        """data 是检查点 (offset, g) 之后的 token 字节，返回其中完整的检查点和剩下不足一段的字节（全量重建时逐节点使用）"""
+        entries = []
+        step = self.interval * _ITEMSIZE
+        pos = 0
+        while len(data) - pos >= step:
+            g = _chain(g, data[pos:pos + step])
+            pos += step
+            offset += self.interval
+            entries.append((offset, g))
+        return entries, data[pos:]
+
+    def get(self, offset: int, g: int) -> Optional[Any]:
+        return self.table.get((offset, g))
+
+    def add(self, node, entries: List[Tuple[int, int]]):
+        if not entries:
+            return
+        with self.lock:
+            node.checkpoints = (node.checkpoints or []) + entries
+            for entry in entries:
+                self.table[entry] = node
+
+    def remove(self, node):
+        """节点被删除：只删除仍然指向它的记录"""
+        if not node.checkpoints:
+            return
+        with self.lock:
+            for entry in node.checkpoints:
+                if self.table.get(entry) is node:
+                    del self.table[entry]
+            node.checkpoints = None
+
+    def split(self, front, back):
+        """back 被切成 front(前半) -> back(后半)，偏移不超过 front.depth 的记录归 front"""
+        if not back.checkpoints:
+            return
+        with self.lock:
+            moved = [entry for entry in back.checkpoints if entry[0] <= front.depth]
+            if not moved:
+                return
+            rest = [entry for entry in back.checkpoints if entry[0] > front.depth]
+            front.checkpoints = moved
+            back.checkpoints = rest or None
+            for entry in moved:
+                self.table[entry] = front
+
+    def clear(self):
+        with self.lock:
+            self.table.clear()
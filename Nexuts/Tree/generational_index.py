@@ -0,0 +1,573 @@
+import itertools
+import os
+import pickle
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from Tree.partitioned_executor import PartitionedExecutor
+from Tree.token_key import TokenKey
+from Tree.tree import MergePrefixTree
+from utils.logger import logger
+
+
+class GenNode:
+    """
+    分代索引里的节点，key 是 TokenKey 视图。
+    value 是本代的记录；dead 是墓碑，只作用于更老的代：更老的代里该实例在本节点起始偏移及以下（整棵子树）的记录都已删除。
+    同一个实例可以同时有墓碑和本代的记录（删除之后又重新插入了这一段）
+    """
+    __slots__ = ("key", "children", "value", "dead", "epochs")
+
+    def __init__(self, key: Optional[TokenKey] = None):
+        self.key = key
+        self.children: Dict[int, "GenNode"] = {}
+        self.value: Dict[str, list] = {}  # instance_id -> 本节点区间的 prompt_value
+        self.dead: Dict[str, int] = {}  # instance_id -> 写墓碑时实例的代数
+        self.epochs: Dict[str, int] = {}  # instance_id -> 写入 value 时实例的代数，代数为 0 时不存
+
+
+class Generation:
+    """
+    一代前缀索引。年轻代可写（整代一把锁，年轻代很小，写入和查询都很快），
+    封存后不再修改，查询不加锁；合并总是生成新的一代，不改动参与合并的旧代。
+    """
+
+    def __init__(self, gen_id: int, sealed_at: float = 0.0):
+        self.gen_id = gen_id
+        self.root = GenNode()
+        self.lock = threading.RLock()
+        self.frozen = False
+        self.sealed_at = sealed_at  # 封存时间（time.time()），合并后的代取较新一代的时间，过期按它判断
+        self.node_count = 0
+        self.token_count = 0
+        self.file: Optional[str] = None  # 已经写入快照目录的文件名，没有持久化时为 None
+        self.pending = 0  # 已分配到本代、还没有执行完的写入任务数
+        self._idle = threading.Condition(threading.Lock())
+
+    # ------------------------------
+    # 写入（年轻代和合并过程中的新代）
+    # ------------------------------
+    def _split(self, parent: GenNode, node: GenNode, length: int) -> GenNode:
+        """node 切成 front(前 length 个 token) -> node(其余)，front 继承所有记录"""
+        front = GenNode(node.key.head(length).compact())
+        front.value = {instance_id: value[:length] for instance_id, value in node.value.items()}
+        front.dead = dict(node.dead)
+        front.epochs = dict(node.epochs)
+        node.key = node.key.tail(length).compact()
+        node.value = {instance_id: value[length:] for instance_id, value in node.value.items()}
+        front.children[node.key.first()] = node
+        parent.children[front.key.first()] = front
+        self.node_count += 1
+        return front
+
+    def cover(self, parent: GenNode, key: TokenKey) -> List[Tuple[GenNode, int, int]]:
+        """从 parent 往下恰好覆盖 key 的节点 [(节点, key 内起始偏移, 结束偏移)]，缺的节点新建，边界不齐的节点切开"""
+        covered = []
+        pos = 0
+        while pos < len(key):
+            rest = key.tail(pos)
+            child = parent.children.get(rest.first())
+            if child is None:
+                child = GenNode(rest.compact())  # 不持有整段 prompt 的 buffer
+                parent.children[rest.first()] = child
+                self.node_count += 1
+                self.token_count += len(rest)
+                covered.append((child, pos, len(key)))
+                break
+            length = rest.match_length(child.key)
+            if length < len(child.key):
+                child = self._split(parent, child, length)
+            covered.append((child, pos, pos + length))
+            pos += length
+            parent = child
+        return covered
+
+    @staticmethod
+    def _mark_live(node: GenNode, instance_id: str, value: list, epoch: int):
+        node.value[instance_id] = value
+        if epoch:
+            node.epochs[instance_id] = epoch
+        else:
+            node.epochs.pop(instance_id, None)
+
+    def insert(self, prompt: TokenKey, values: list, instance_id: str, epoch: int):
+        with self.lock:
+            for node, begin, end in self.cover(self.root, prompt):
+                self._mark_live(node, instance_id, values[begin:end], epoch)
+
+    def delete(self, prompt: TokenKey, instance_id: str, keep: int, epoch: int):
+        """
+        实例淘汰了 prompt[keep:]：去掉本代里偏移 keep 处节点整棵子树上该实例的记录，
+        并在这个节点上写墓碑遮住更老的代（年轻代不知道更老的代里有没有记录，总是写）。
+        前提是只淘汰叶子（prompt[keep:] 下该实例没有其他路径），这时整棵子树和 MergePrefixTree.evict_prompt
+        只清理的 prompt 路径相同；不满足时这里会多删掉子树里其他分支上的记录
+        """
+        if keep >= len(prompt):
+            return
+        with self.lock:
+            covered = self.cover(self.root, prompt.head(keep))
+            start = covered[-1][0] if covered else self.root
+            node = self.cover(start, prompt.tail(keep))[0][0]
+            _cut(node, instance_id)
+            node.dead[instance_id] = epoch
+
+    def done(self):
+        with self._idle:
+            self.pending -= 1
+            if self.pending == 0:
+                self._idle.notify_all()
+
+    def wait_idle(self):
+        with self._idle:
+            while self.pending > 0:
+                self._idle.wait()
+
+    # ------------------------------
+    # 查询
+    # ------------------------------
+    def walk(self, prompt: TokenKey, epochs: Dict[str, int]) -> Tuple[Dict[str, Tuple[int, GenNode]], Dict[str, int]]:
+        """
+        沿 prompt 匹配，返回 (live, dead)：live 是 instance_id -> (本代里覆盖到的最深偏移, 节点)，
+        dead 是 instance_id -> 路径上第一个墓碑的起始偏移。旧代数的记录忽略
+        """
+        if self.frozen:
+            return self._walk(prompt, epochs)
+        with self.lock:
+            return self._walk(prompt, epochs)
+
+    def _walk(self, prompt: TokenKey, epochs: Dict[str, int]):
+        live: Dict[str, Tuple[int, GenNode]] = {}
+        dead: Dict[str, int] = {}
+        node, offset = self.root, 0
+        remaining = prompt
+        while remaining:
+            child = node.children.get(remaining.first())
+            if child is None:
+                break
+            length = remaining.match_length(child.key)
+            for instance_id in child.value:
+                if child.epochs.get(instance_id, 0) == epochs.get(instance_id, 0):
+                    live[instance_id] = (offset + length, child)
+            for instance_id, epoch in child.dead.items():
+                if instance_id not in dead and epoch == epochs.get(instance_id, 0):
+                    dead[instance_id] = offset
+            if length < len(child.key):
+                break
+            offset += length
+            remaining = remaining.tail(length)
+            node = child
+        return live, dead
+
+    # ------------------------------
+    # 持久化：先序节点列表 [(父节点下标, key 字节, value, dead, epochs)]
+    # ------------------------------
+    def dump(self, path: str):
+        records = []
+        stack = [(self.root, -1)]
+        while stack:
+            node, parent_index = stack.pop()
+            index = len(records)
+            records.append((parent_index, node.key.tobytes() if node.key is not None else None,
+                            node.value, node.dead, node.epochs))
+            stack.extend((child, index) for child in node.children.values())
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            pickle.dump({"gen_id": self.gen_id, "sealed_at": self.sealed_at, "nodes": records}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Generation":
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        gen = cls(data["gen_id"], data["sealed_at"])
+        nodes: List[GenNode] = []
+        for parent_index, key, value, dead, epochs in data["nodes"]:
+            if parent_index < 0:
+                node = gen.root
+            else:
+                node = GenNode(TokenKey.from_bytes(key))
+                nodes[parent_index].children[node.key.first()] = node
+                gen.node_count += 1
+                gen.token_count += len(node.key)
+            node.value, node.dead, node.epochs = value, dead, epochs
+            nodes.append(node)
+        gen.frozen = True
+        gen.file = os.path.basename(path)
+        return gen
+
+
+def merge_generations(older: Generation, newer: Generation, gen_id: int,
+                      epochs: Dict[str, int], bottom: bool) -> Generation:
+    """
+    把相邻的两代合并成新的一代（older、newer 都不修改）：先复制 older，再自上而下按 newer 的墓碑删掉子树里 older 的记录、写入 newer 的记录。
+    旧代数的记录直接丢弃；bottom 为 True 时合并结果是最老的一代，墓碑没有可以遮挡的记录，也一并丢弃
+    """
+    merged = Generation(gen_id, newer.sealed_at)
+
+    def current(node: GenNode, instance_id: str) -> bool:
+        return node.epochs.get(instance_id, 0) == epochs.get(instance_id, 0)
+
+    stack = [(older.root, merged.root)]
+    while stack:
+        source, target = stack.pop()
+        for child in source.children.values():
+            copy = GenNode(child.key)
+            copy.value = {instance_id: value for instance_id, value in child.value.items() if current(child, instance_id)}
+            if not bottom:
+                copy.dead = {instance_id: epoch for instance_id, epoch in child.dead.items()
+                             if epoch == epochs.get(instance_id, 0)}
+            copy.epochs = {instance_id: epoch for instance_id, epoch in child.epochs.items() if instance_id in copy.value}
+            target.children[child.key.first()] = copy
+            merged.node_count += 1
+            merged.token_count += len(child.key)
+            stack.append((child, copy))
+
+    stack = [(newer.root, merged.root)]
+    while stack:
+        source, target = stack.pop()
+        for child in source.children.values():
+            covered = merged.cover(target, child.key)
+            for instance_id, epoch in child.dead.items():
+                if epoch != epochs.get(instance_id, 0):
+                    continue
+                _cut(covered[0][0], instance_id)
+                if not bottom:
+                    covered[0][0].dead[instance_id] = epoch
+            for instance_id, value in child.value.items():
+                if not current(child, instance_id):
+                    continue
+                for node, begin, end in covered:
+                    Generation._mark_live(node, instance_id, value[begin:end], child.epochs.get(instance_id, 0))
+            stack.append((child, covered[-1][0]))
+
+    _prune(merged)
+    merged.frozen = True
+    return merged
+
+
+def _cut(node: GenNode, instance_id: str):
+    """去掉实例在 node 及其子树上的全部记录和墓碑"""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        current.value.pop(instance_id, None)
+        current.dead.pop(instance_id, None)
+        current.epochs.pop(instance_id, None)
+        stack.extend(current.children.values())
+
+
+def _prune(gen: Generation):
+    """删掉没有任何记录的叶子（逐层向上），墓碑路径上为了定位而建的空节点在合并时被回收"""
+    order = []
+    stack = [(gen.root, None)]
+    while stack:
+        node, parent = stack.pop()
+        order.append((node, parent))
+        stack.extend((child, node) for child in node.children.values())
+    for node, parent in reversed(order):
+        if parent is not None and not node.children and not node.value and not node.dead:
+            del parent.children[node.key.first()]
+            gen.node_count -= 1
+            gen.token_count -= len(node.key)
+
+
+class GenerationalPrefixIndex:
+    """
+    分代（LSM 式）前缀索引，可以替代 MergePrefixTree 作为全局索引：
+    - 所有新写入进入一个小的可写年轻代，年轻代满了（或做快照时）封存成不可变的一代；
+    - 后台线程把大小相近的相邻老代合并成更大的一代，超过 max_age 的最老的几代整代丢弃；
+    - 查询从新到老逐代叠加：每代先用墓碑截断更老的代给出的匹配长度，再用本代的记录延长；
+    - 快照只需要写新封存的代和合并产生的代，已经持久化的老代在清单里按文件名引用。
+    实例注销/失联和全量同步沿用代数机制：代数 +1 后旧记录在查询时被忽略，合并时丢弃。
+    删除要求只淘汰叶子（和 Sentry 一致），见 Generation.delete。
+    不维护反熵摘要和会话游标，置信度固定为 1（记录按整代过期）。
+    """
+    INSERT_OPS = MergePrefixTree.INSERT_OPS
+    DELETE_OPS = MergePrefixTree.DELETE_OPS
+    RESYNC_OPS = MergePrefixTree.RESYNC_OPS
+    TOMBSTONE_OPS = MergePrefixTree.TOMBSTONE_OPS
+
+    _op_prompt = staticmethod(MergePrefixTree._op_prompt)
+    _op_value = staticmethod(MergePrefixTree._op_value)
+    _bound_op = MergePrefixTree._bound_op
+    image_paths = staticmethod(MergePrefixTree.image_paths)
+
+    def __init__(self,
+                 wal_manager=None,
+                 young_max_nodes: int = 50000,
+                 max_generations: int = 8,
+                 merge_ratio: float = 0.5,
+                 max_age: float = 0,
+                 maintenance_interval: float = 1.0,
+                 ingest_lanes: int = 16,
+                 max_index_depth: int = 0):
+        """
+        :param young_max_nodes: 年轻代节点数达到这个值后封存
+        :param max_generations: 封存的代数超过这个值时，即使大小不相近也合并最老的两代
+        :param merge_ratio: 较新一代的节点数不少于较老一代的 merge_ratio 倍时合并这两代
+        :param max_age: 封存超过这么久（秒）的代整代丢弃，0 表示不过期
+        :param maintenance_interval: 后台封存/合并/过期检查的周期（秒）
+        :param max_index_depth: 最多索引 prompt 的前多少个 token，0 表示不限制
+        """
+        self.wal_manager = wal_manager
+        self.young_max_nodes = int(young_max_nodes)
+        self.max_generations = max(int(max_generations), 1)
+        self.merge_ratio = float(merge_ratio)
+        self.max_age = float(max_age)
+        self.maintenance_interval = float(maintenance_interval)
+        self.max_index_depth = int(max_index_depth)
+        self.truncated_tokens = 0
+
+        self._gen_ids = itertools.count(1)
+        self.young = Generation(next(self._gen_ids))
+        self.sealing: List[Generation] = []  # 已经不再接收新写入、等待在途任务执行完的代，新的在前
+        self.frozen: List[Generation] = []  # 不可变的代，新的在前
+        self._gens_lock = threading.Lock()  # 代列表的替换
+        self._ingest_lock = threading.Lock()  # WAL 追加 + 分配到年轻代，和封存互斥：封存前的写入都落在被封存的代里
+        self._seal_lock = threading.Lock()
+        self.generations: Dict[str, int] = {}  # instance_id -> 当前代数
+        self.global_version = 0
+        self.sealed = 0
+        self.merges = 0
+        self.expired_generations = 0
+        self._executor = PartitionedExecutor(num_lanes=ingest_lanes)
+
+        self._maintenance_stop = threading.Event()
+        self._maintenance_wakeup = threading.Event()
+        self._maintenance_thread = threading.Thread(target=self._maintenance_loop, name="gen-index-maintenance",
+                                                    daemon=True)
+        self._maintenance_thread.start()
+
+    # ------------------------------
+    # 写入
+    # ------------------------------
+    def update_prefix_tree(self, data: Dict[str, Any], write_wal=True):
+        ops = []
+        for update_info in data["updates"]:
+            if update_info["op_type"] not in self.INSERT_OPS + self.DELETE_OPS + self.RESYNC_OPS + self.TOMBSTONE_OPS:
+                logger.warning("update prefix tree not support op_type:{}".format(update_info["op_type"]))
+                continue
+            if self.max_index_depth > 0:
+                update_info = self._bound_op(update_info)
+                if update_info is None:
+                    continue
+            ops.append(update_info)
+        if not ops:
+            return []
+        ops_by_instance: Dict[str, List[Dict[str, Any]]] = {}
+        for update_info in ops:
+            ops_by_instance.setdefault(update_info["instance_id"], []).append(update_info)
+        with self._ingest_lock:
+            if write_wal and self.wal_manager is not None:
+                self.wal_manager.append_batch(ops)
+            self.global_version += len(ops)
+            gen = self.young
+            with gen._idle:
+                gen.pending += len(ops_by_instance)
+            return [self._executor.submit(instance_id, self.apply_batch, gen, instance_ops)
+                    for instance_id, instance_ops in ops_by_instance.items()]
+
+    def ingest_metrics(self) -> Dict[str, Any]:
+        return self._executor.metrics()
+
+    def apply_batch(self, gen: Generation, ops: List[Dict[str, Any]]):
+        try:
+            for update_info in ops:
+                instance_id = update_info["instance_id"]
+                try:
+                    op_type = update_info["op_type"]
+                    if op_type in self.TOMBSTONE_OPS:
+                        self.bump_generation(instance_id)
+                    elif op_type in self.RESYNC_OPS:
+                        # 代数 +1 让所有代里的旧记录失效，再把镜像写进年轻代
+                        epoch = self.bump_generation(instance_id)
+                        for prompt, values in update_info.get("paths", []):
+                            if prompt:
+                                gen.insert(TokenKey.pack(prompt), values, instance_id, epoch)
+                    elif op_type in self.INSERT_OPS:
+                        gen.insert(TokenKey.pack(self._op_prompt(update_info)), self._op_value(update_info),
+                                   instance_id, self.generations.get(instance_id, 0))
+                    else:
+                        prompt = TokenKey.pack(self._op_prompt(update_info))
+                        keep = max(len(prompt) - update_info.get("length", 0), 0)
+                        gen.delete(prompt, instance_id, keep, self.generations.get(instance_id, 0))
+                except Exception as e:
+                    logger.warning(f"[GenIndex] apply {update_info.get('op_type')} failed instance:{instance_id} error:{e}")
+        finally:
+            gen.done()
+        if gen is self.young and gen.node_count >= self.young_max_nodes:
+            self._maintenance_wakeup.set()
+
+    def bump_generation(self, instance_id: str) -> int:
+        generation = self.generations.get(instance_id, 0) + 1
+        self.generations[instance_id] = generation
+        return generation
+
+    def tombstone_instance(self, instance_id: str):
+        return self.update_prefix_tree({"updates": [{"op_type": "tombstone_instance", "instance_id": instance_id}]})
+
+    def resync_instance(self, instance_id: str, paths: List[List[list]]):
+        return self.update_prefix_tree({"updates": [{"op_type": "resync_instance", "instance_id": instance_id, "paths": paths}]})
+
+    # ------------------------------
+    # 查询
+    # ------------------------------
+    def _generations_newest_first(self) -> List[Generation]:
+        with self._gens_lock:
+            return [self.young] + list(self.sealing) + list(self.frozen)
+
+    def match_instances_with_prefix(self, key_list: List[int], session_id: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        从最老的代往新叠加：本代的墓碑把更老的代给出的匹配截到墓碑处，本代的记录再把匹配延长。
+        session_id 只为和 MergePrefixTree 接口一致，分代索引不缓存会话游标
+        :return: {instance_id: {"match_length", "confidence", "score", "capped"}}
+        """
+        if 0 < self.max_index_depth < len(key_list):
+            key_list = key_list[:self.max_index_depth]
+        prompt = TokenKey.pack(key_list)
+        epochs = dict(self.generations)
+        coverage: Dict[str, int] = {}
+        for gen in reversed(self._generations_newest_first()):
+            live, dead = gen.walk(prompt, epochs)
+            for instance_id, offset in dead.items():
+                if coverage.get(instance_id, 0) > offset:
+                    coverage[instance_id] = offset
+            for instance_id, (match_length, _) in live.items():
+                if match_length > coverage.get(instance_id, 0):
+                    coverage[instance_id] = match_length
+        return {instance_id: {"match_length": match_length, "confidence": 1.0, "score": float(match_length),
+                              "capped": 0 < self.max_index_depth <= match_length}
+                for instance_id, match_length in coverage.items() if match_length > 0}
+
+    # ------------------------------
+    # 封存 / 合并 / 过期
+    # ------------------------------
+    def seal(self, on_switch=None) -> Optional[Generation]:
+        """
+        封存当前年轻代：换上新的年轻代，等分配给旧年轻代的任务执行完后把它变成不可变的一代。
+        :param on_switch: 在 _ingest_lock 内、切换年轻代时调用（快照在这里切换 WAL，切换点前后的写入分属旧代和 WAL 新文件）
+        :return: 封存的代，年轻代为空时不封存，返回 None
+        """
+        with self._seal_lock:  # 快照和后台线程都会封存，串行执行，封存顺序就是 frozen 里的新老顺序
+            with self._ingest_lock:
+                if on_switch is not None:
+                    on_switch()
+                gen = self.young
+                if gen.node_count == 0 and gen.pending == 0:
+                    return None
+                with self._gens_lock:
+                    self.young = Generation(next(self._gen_ids))
+                    self.sealing.insert(0, gen)
+            gen.wait_idle()
+            with gen.lock:
+                gen.frozen = True
+                gen.sealed_at = time.time()
+            with self._gens_lock:
+                self.sealing.remove(gen)
+                self.frozen.insert(0, gen)
+        self.sealed += 1
+        logger.info(f"[GenIndex] sealed generation {gen.gen_id}: {gen.node_count} nodes")
+        return gen
+
+    def _pick_merge(self) -> Optional[int]:
+        """选出要合并的相邻两代 frozen[i]（较新）和 frozen[i + 1]，没有时返回 None"""
+        frozen = self.frozen
+        for i in range(len(frozen) - 1):
+            if frozen[i].node_count >= frozen[i + 1].node_count * self.merge_ratio:
+                return i
+        if len(frozen) > self.max_generations:
+            return len(frozen) - 2
+        return None
+
+    def compact(self) -> int:
+        """合并到没有可合并的相邻代为止，返回合并次数"""
+        count = 0
+        while True:
+            with self._gens_lock:
+                i = self._pick_merge()
+                if i is None:
+                    return count
+                newer, older = self.frozen[i], self.frozen[i + 1]
+                bottom = i + 1 == len(self.frozen) - 1
+            merged = merge_generations(older, newer, next(self._gen_ids), dict(self.generations), bottom)
+            with self._gens_lock:
+                # 只有本线程会删改老代，快照只会在最前面插入新代，按对象重新定位
+                i = self.frozen.index(newer)
+                self.frozen[i:i + 2] = [merged]
+            self.merges += 1
+            count += 1
+            logger.info(f"[GenIndex] merged generations {older.gen_id}+{newer.gen_id} -> {merged.gen_id}: "
+                        f"{merged.node_count} nodes")
+
+    def expire(self, now: float = None) -> int:
+        """丢弃封存时间早于 now - max_age 的最老的几代，返回丢弃的代数"""
+        if self.max_age <= 0:
+            return 0
+        now = time.time() if now is None else now
+        dropped = 0
+        with self._gens_lock:
+            while self.frozen and self.frozen[-1].sealed_at < now - self.max_age:
+                gen = self.frozen.pop()
+                dropped += 1
+                logger.info(f"[GenIndex] expired generation {gen.gen_id}: {gen.node_count} nodes")
+        self.expired_generations += dropped
+        return dropped
+
+    def _maintenance_loop(self):
+        while not self._maintenance_stop.is_set():
+            self._maintenance_wakeup.wait(self.maintenance_interval)
+            self._maintenance_wakeup.clear()
+            if self._maintenance_stop.is_set():
+                break
+            try:
+                if self.young.node_count >= self.young_max_nodes:
+                    self.seal()
+                self.expire()
+                self.compact()
+            except Exception as e:
+                logger.warning(f"[GenIndex] maintenance failed: {e}")
+
+    def stop_maintenance(self):
+        self._maintenance_stop.set()
+        self._maintenance_wakeup.set()
+        self._maintenance_thread.join()
+
+    # ------------------------------
+    # 快照
+    # ------------------------------
+    def persisted_generations(self) -> List[Generation]:
+        """快照要引用的代（旧的在前）；需要调用方先 seal，年轻代里的内容由 WAL 覆盖"""
+        with self._gens_lock:
+            return list(reversed(self.frozen))
+
+    def restore(self, generations: List[Generation], epochs: Dict[str, int]):
+        """用快照清单里的各代（旧的在前）替换当前索引，随后由调用方回放 WAL"""
+        with self._gens_lock:
+            self.frozen = list(reversed(generations))
+            self.generations = dict(epochs)
+            next_id = max([gen.gen_id for gen in generations] + [0]) + 1
+            self._gen_ids = itertools.count(next_id)
+            self.young = Generation(next(self._gen_ids))
+
+    def tree_stats(self) -> Dict[str, Any]:
+        now = time.time()
+        gens = self._generations_newest_first()
+        return {
+            "mode": "generational",
+            "node_count": sum(gen.node_count for gen in gens),
+            "token_count": sum(gen.token_count for gen in gens),
+            "young_nodes": self.young.node_count,
+            "young_max_nodes": self.young_max_nodes,
+            "generations": [{"id": gen.gen_id, "nodes": gen.node_count, "tokens": gen.token_count,
+                             "age_seconds": round(now - gen.sealed_at, 1) if gen.frozen else 0.0,
+                             "persisted": gen.file is not None}
+                            for gen in gens],
+            "sealed": self.sealed,
+            "merges": self.merges,
+            "expired_generations": self.expired_generations,
+            "global_version": self.global_version,
+            "max_index_depth": self.max_index_depth,
+            "truncated_tokens": self.truncated_tokens,
+        }
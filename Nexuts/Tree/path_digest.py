@@ -0,0 +1,99 @@
+import hashlib
+import sys
+import threading
+from array import array
+from typing import Any, Dict, Iterable, List, Tuple
+
+# Sentry/KvCacheIndex/path_digest.py 是同一份实现，两边的哈希和分桶必须保持一致
+MASK = (1 << 64) - 1
+FANOUT_BITS = 4  # 每层 16 叉
+LEVELS = 3  # 第 0 层是根，第 3 层是叶子桶，共 4096 个叶子桶
+LEAF_BITS = FANOUT_BITS * LEVELS
+
+
+def _le_bytes(tokens) -> bytes:
+    if hasattr(tokens, "tobytes") and not isinstance(tokens, array):
+        data = array("I")
+        data.frombytes(tokens.tobytes())
+    else:
+        data = array("I", tokens)
+    if sys.byteorder != "little":
+        data.byteswap()
+    return data.tobytes()
+
+
+def path_hash(chunks: Iterable) -> int:
+    """完整路径（按顺序的若干段 token）的 64 位哈希，和路径在树里被切成几段无关"""
+    h = hashlib.blake2b(digest_size=8)
+    for chunk in chunks:
+        if chunk:
+            h.update(_le_bytes(chunk))
+    return int.from_bytes(h.digest(), "little")
+
+
+def leaf_bucket(h: int) -> int:
+    return h >> (64 - LEAF_BITS)
+
+
+class PathDigest:
+    """
+    单个实例的缓存内容摘要：内容用“极大路径”（实例在树上的叶子路径）集合表示，
+    按路径哈希的高位分到 4096 个叶子桶，每个桶维护 (哈希和, 个数)，上层桶按需汇总，构成固定形状的 Merkle 树。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sums = [0] * (1 << LEAF_BITS)
+        self.counts = [0] * (1 << LEAF_BITS)
+        self.members: Dict[int, Any] = {}  # 路径哈希 -> 节点
+        self.buckets: Dict[int, set] = {}  # 叶子桶 -> 路径哈希集合
+
+    def add(self, h: int, member: Any):
+        with self.lock:
+            if h in self.members:
+                self.members[h] = member
+                return
+            b = leaf_bucket(h)
+            self.sums[b] = (self.sums[b] + h) & MASK
+            self.counts[b] += 1
+            self.members[h] = member
+            self.buckets.setdefault(b, set()).add(h)
+
+    def discard(self, h: int):
+        with self.lock:
+            if self.members.pop(h, None) is None:
+                return
+            b = leaf_bucket(h)
+            self.sums[b] = (self.sums[b] - h) & MASK
+            self.counts[b] -= 1
+            self.buckets[b].discard(h)
+            if not self.buckets[b]:
+                del self.buckets[b]
+
+    def _summary(self, level: int, bucket: int) -> Tuple[int, int]:
+        width = 1 << (FANOUT_BITS * (LEVELS - level))
+        begin = bucket * width
+        return sum(self.sums[begin:begin + width]) & MASK, sum(self.counts[begin:begin + width])
+
+    def children(self, level: int, buckets: List[int]) -> Dict[str, Dict[str, Any]]:
+        """level 层的若干个桶：各自的摘要，以及 level+1 层 16 个子桶的摘要（叶子层没有子桶）"""
+        result = {}
+        with self.lock:
+            for bucket in buckets:
+                item = {"hash": list(self._summary(level, bucket)), "children": []}
+                if level < LEVELS:
+                    first = bucket << FANOUT_BITS
+                    item["children"] = [list(self._summary(level + 1, first + i)) for i in range(1 << FANOUT_BITS)]
+                result[str(bucket)] = item
+        return result
+
+    def members_in(self, leaf_buckets: List[int]) -> Dict[int, Any]:
+        with self.lock:
+            return {h: self.members[h] for b in leaf_buckets for h in self.buckets.get(b, ())}
+
+    def clear(self):
+        with self.lock:
+            self.sums = [0] * (1 << LEAF_BITS)
+            self.counts = [0] * (1 << LEAF_BITS)
+            self.members.clear()
+            self.buckets.clear()
@@ -0,0 +1,72 @@
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def prefix_digest(key, begin: int, end: int, digest: int = 0) -> int:
+    """
+    在 key[:begin] 的摘要 digest 上继续累加 key[begin:end]（key 是 TokenKey），得到 key[:end] 的摘要。
+    用来判断新 prompt 是否是上一轮 prompt 的延续，不必保存整段 prompt；crc32 可以增量计算，一轮只扫一遍新 prompt
+    """
+    return zlib.crc32(key.tail(begin)._bytes(end - begin), digest)
+
+
+class SessionCursor:
+    """一个会话上一次路由查询完整匹配到的位置"""
+    __slots__ = ("root", "path", "offset", "digest", "matched", "epochs")
+
+    def __init__(self, root, path: List[Any], offset: int, digest: int,
+                 matched: Dict[str, Tuple[int, Any]], epochs: Dict[str, int]):
+        self.root = root  # 查询时的根节点，加载快照替换 root 后游标作废
+        self.path = path  # 根以下完整匹配经过的节点，最后一个就是游标节点
+        self.offset = offset  # 游标节点末尾在 prompt 中的偏移
+        self.digest = digest  # prompt[:offset] 的 crc32
+        self.matched = matched  # instance_id -> (match_length, 最深匹配节点)，只含 prompt[:offset] 内的匹配
+        self.epochs = epochs  # instance_id -> 查询开始时该实例的记录变更序号
+
+
+class SessionCursorCache:
+    """session_id -> SessionCursor 的有界 LRU"""
+
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self._cursors: "OrderedDict[str, SessionCursor]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # 命中但树已变化（或 prompt 不是延续）而作废的游标
+
+    def get(self, session_id: str) -> Optional[SessionCursor]:
+        with self._lock:
+            cursor = self._cursors.get(session_id)
+            if cursor is None:
+                self.misses += 1
+                return None
+            self._cursors.move_to_end(session_id)
+            return cursor
+
+    def put(self, session_id: str, cursor: SessionCursor):
+        with self._lock:
+            self._cursors[session_id] = cursor
+            self._cursors.move_to_end(session_id)
+            while len(self._cursors) > self.capacity:
+                self._cursors.popitem(last=False)
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            if self._cursors.pop(session_id, None) is not None:
+                self.stale += 1
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def clear(self):
+        with self._lock:
+            self._cursors.clear()
+
+    def metrics(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._cursors), "capacity": self.capacity,
+                    "hits": self.hits, "misses": self.misses, "stale": self.stale}
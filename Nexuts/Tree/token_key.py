@@ -0,0 +1,133 @@
+from array import array
+from typing import Iterable, List, Union
+
+# uint32 token 数组；绝大多数平台上 'I' 就是 4 字节
+_TYPECODE = "I" if array("I").itemsize == 4 else "L"
+_ITEMSIZE = 4
+
+
+class TokenKey:
+    """
+    打包成 uint32 的 token 序列视图：(buffer, offset, length)。
+    切片只生成新的视图，不复制底层 buffer；前缀匹配用 bytes.startswith 在 C 层做 memcmp。
+    视图不可变，copy() 直接返回自身。
+    """
+    __slots__ = ("_buf", "_raw", "_tokens", "start", "length")
+
+    def __init__(self, buf: bytes, start: int = 0, length: int = None, _raw=None, _tokens=None):
+        self._buf = buf
+        self._raw = memoryview(buf) if _raw is None else _raw  # 按字节访问，用于 memcmp
+        self._tokens = self._raw.cast(_TYPECODE) if _tokens is None else _tokens  # 按 token 访问
+        self.start = start
+        self.length = len(self._tokens) - start if length is None else length
+
+    @classmethod
+    def pack(cls, tokens: Union["TokenKey", Iterable[int]]) -> "TokenKey":
+        if isinstance(tokens, TokenKey):
+            return tokens
+        return cls(array(_TYPECODE, tokens).tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "TokenKey":
+        return cls(bytes(data))
+
+    def __len__(self):
+        return self.length
+
+    def __bool__(self):
+        return self.length > 0
+
+    def __getitem__(self, item):
+        if type(item) is int:
+            if item < 0:
+                item += self.length
+            if not 0 <= item < self.length:
+                raise IndexError("TokenKey index out of range")
+            return self._tokens[self.start + item]
+        start, stop, step = item.indices(self.length)
+        if step != 1:
+            raise ValueError("TokenKey only supports contiguous slices")
+        return TokenKey(self._buf, self.start + start, max(stop - start, 0), self._raw, self._tokens)
+
+    # 热路径上的快捷方法，省去 __getitem__ 的参数解析
+    def first(self) -> int:
+        return self._tokens[self.start]
+
+    def head(self, n: int) -> "TokenKey":
+        return TokenKey(self._buf, self.start, min(n, self.length), self._raw, self._tokens)
+
+    def tail(self, n: int) -> "TokenKey":
+        n = min(n, self.length)
+        return TokenKey(self._buf, self.start + n, self.length - n, self._raw, self._tokens)
+
+    def span_equal(self, other: "TokenKey", begin: int, end: int) -> bool:
+        """self[begin:end] == other[begin:end]，两边都需要至少 end 个 token"""
+        if end > self.length or end > other.length:
+            return False
+        raw_begin = (other.start + begin) * _ITEMSIZE
+        return self._buf.startswith(other._raw[raw_begin:raw_begin + (end - begin) * _ITEMSIZE],
+                                    (self.start + begin) * _ITEMSIZE)
+
+    def _bytes(self, n: int = None) -> memoryview:
+        """前 n 个 token 对应的字节视图（不复制）"""
+        n = self.length if n is None else n
+        begin = self.start * _ITEMSIZE
+        return self._raw[begin:begin + n * _ITEMSIZE]
+
+    def match_length(self, other: "TokenKey") -> int:
+        """和 other 的公共前缀长度：先整段比较，不相等时对 memcmp 做二分"""
+        n = min(self.length, other.length)
+        if n == 0:
+            return 0
+        begin = self.start * _ITEMSIZE
+        if self._buf.startswith(other._bytes(n), begin):
+            return n
+        lo, hi = 0, n  # 前 lo 个相同，前 hi 个不同
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self._buf.startswith(other._bytes(mid), begin):
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def __eq__(self, other):
+        if not isinstance(other, TokenKey):
+            try:
+                other = TokenKey.pack(other)
+            except TypeError:
+                return NotImplemented
+        return self.length == other.length and self.match_length(other) == self.length
+
+    def __hash__(self):
+        return hash(self.tobytes())
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self) -> List[int]:
+        return self._tokens[self.start:self.start + self.length].tolist()
+
+    def tobytes(self) -> bytes:
+        return self._bytes().tobytes()
+
+    def copy(self) -> "TokenKey":
+        return self
+
+    def compact(self) -> "TokenKey":
+        """
+        存进树节点时调用：视图会让整段 prompt 的 buffer 一直活着（32k token 的 prompt 切出的 2 个 token 的叶子也占 128KB），
+        不是独占 buffer 的视图复制成只含自己这一段的新 buffer；只用于匹配的临时视图不需要
+        """
+        if self.start == 0 and self.length * _ITEMSIZE == len(self._raw):
+            return self
+        return TokenKey.from_bytes(self._bytes())
+
+    def __reduce__(self):
+        # 只序列化自己这一段，避免把共享的整段 buffer 一起写进快照
+        return TokenKey.from_bytes, (self.tobytes(),)
+
+    def __repr__(self):
+        tokens = self._tokens[self.start:self.start + min(self.length, 10)].tolist()
+        suffix = ", ..." if self.length > 10 else ""
+        return f"TokenKey({tokens}{suffix}, len={self.length})"
@@ -1,11 +1,21 @@
+import heapq
+import itertools
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 from typing import List, Any, Dict, Tuple, Optional
 import threading
-import concurrent.futures
 from wsgiref.util import request_uri
 
 from Tree.safe_dict import ThreadSafeDict
+from Tree.checkpoint_index import CheckpointIndex
+from Tree.partitioned_executor import PartitionedExecutor
+from Tree.path_digest import PathDigest, path_hash, leaf_bucket
+from Tree.session_cursor import SessionCursor, SessionCursorCache, prefix_digest
+from Tree.token_key import TokenKey
+from Tree.tree_stats import TreeStats
 from persistence.walmanager import WalManager
+from utils.logger import logger
 
 
 # TODO 添加反分词服务
@@ -15,12 +25,18 @@ class TreeNode:
     def __init__(self, id: Optional[int] = None):
         self.children = defaultdict(TreeNode)  # key: token(int) → value: TreeNode
         self.parent: Optional[TreeNode] = None
-        self.key: Optional[List[int]] = None  # 当前节点的token序列（如[101, 202, 303]）
+        self.key: Optional[TokenKey] = None  # 当前节点的token序列（打包的uint32视图，如[101, 202, 303]）
         self.value = ThreadSafeDict()  # key: pod标识 → value: 相关信息（用户自行维护）
         self.decode_string: Optional[List[str]] = None  # 反分词结果
         self.id = TreeNode.counter if id is None else id
         TreeNode.counter += 1
         self.lock = threading.RLock()  # 节点级读写锁
+        self.last_access = time.monotonic()  # 最近一次被写入/路由命中的时间，LRU淘汰依据
+        self.depth = 0  # 节点末尾在完整prompt中的token偏移，split不会改变已有节点的depth
+        self.path_hash: Optional[int] = None  # 根到节点末尾的完整路径哈希（反熵摘要用），节点的路径不会变，只算一次
+        self.confirmed: Dict[str, float] = {}  # instance_id -> 最近一次被 Sentry 上报确认的时间（time.monotonic），置信度衰减和 TTL 依据
+        self.generation: Dict[str, int] = {}  # instance_id -> 写入该记录时实例的代数，和实例当前代数不一致的记录视为已删除；代数为 0 时不存
+        self.checkpoints: Optional[List[Tuple[int, int]]] = None  # 落在本节点区间内的前缀检查点 [(偏移, 链式哈希)]，没有时不分配
 
         # 版本控制相关（核心保留）
         self.version = 0  # 节点最后修改的版本号
@@ -86,24 +102,111 @@ class TreeNode:
 
 
 class MergePrefixTree:  # 合并树
-    def __init__(self, wal_manager: WalManager = None, root: TreeNode = None):
+    INSERT_OPS = ("insert_node", "insert_token")
+    DELETE_OPS = ("delete_node", "delete_token")  # 只淘汰叶子，见 evict_prompt
+    RESYNC_OPS = ("resync_instance",)
+    TOMBSTONE_OPS = ("tombstone_instance",)
+    CHECKPOINT_MIN_SEGMENTS = 4  # prompt 至少覆盖这么多个检查点时才走检查点查找，短 prompt 直接逐节点匹配更快
+
+    def __init__(self,
+                 wal_manager: WalManager = None,
+                 root: TreeNode = None,
+                 max_nodes: int = 0,
+                 max_tokens: int = 0,
+                 evict_interval: float = 1.0,
+                 evict_low_watermark: float = 0.9,
+                 ingest_lanes: int = 16,
+                 content_digest: bool = False,
+                 confidence_half_life: float = 0,
+                 presence_ttl: float = 0,
+                 sweep_interval: float = 60,
+                 tombstone_gc_interval: float = 30,
+                 session_cache_size: int = 0,
+                 checkpoint_interval: int = 0,
+                 max_index_depth: int = 0):
+        """
+        :param max_nodes: 树节点数上限，0 表示不限制（默认）。超出后后台按 LRU 淘汰叶子，淘汰不写 WAL
+        :param max_tokens: 树中缓存 token 总数上限（所有节点 key 长度之和），0 表示不限制
+        :param evict_interval: 后台淘汰线程的检查周期（秒）
+        :param evict_low_watermark: 超出预算后淘汰到预算的多少比例为止，避免在阈值附近反复触发
+        :param ingest_lanes: 写入线程数，同一个 instance_id 的变更固定在同一个 lane 上按顺序执行
+        :param content_digest: 是否为每个实例维护内容摘要（和 Sentry 的 RadixTree 做反熵比对用）
+        :param confidence_half_life: 匹配置信度的半衰期（秒），距上次确认每过一个半衰期置信度减半，0 表示不衰减
+        :param presence_ttl: 实例记录超过这么久（秒）没有被再次确认就过期删除，0 表示不过期
+        :param sweep_interval: 过期清理线程的检查周期（秒）
+        :param tombstone_gc_interval: 回收已作废代数记录的后台线程检查周期（秒）
+        :param session_cache_size: 多轮会话的匹配游标缓存条数（LRU），0 表示不缓存
+        :param checkpoint_interval: 每隔多少个 token 记录一次前缀哈希检查点，长 prompt 路由时二分查找最长命中的检查点，0 表示不记录
+        :param max_index_depth: 最多索引 prompt 的前多少个 token，更深的部分写入时截掉，查询匹配到这个深度的记为“≥ 上限”，0 表示不限制
+        """
         if root is None:
             self.root = TreeNode()
         else:
             self.root = root
         self.wal_manager = wal_manager
-        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+        self._executor = PartitionedExecutor(num_lanes=ingest_lanes)
         self.global_version = 0  # 全局版本
         self.global_version_lock = threading.Lock()
 
         self.active_snapshots: bool = False
         self.snapshot_trigger_version = 0  # 触发快照时的锁定版本
+        self.snapshot_trigger_lsn = 0  # 触发快照时 WAL 已分配的最大 LSN，之后分配版本的变更 LSN 都比它大
 
         self.current_finish_version = 0  # 当前完成变更的version
         self.freeze_finished_version = 0  # 执行快照时冻结的finished_version
         self.completed_finish = set()
         self.finish_lock = threading.Lock()
 
+        # 内存预算（LRU淘汰）
+        self.max_nodes = int(max_nodes)
+        self.max_tokens = int(max_tokens)
+        self.evict_interval = float(evict_interval)
+        self.evict_low_watermark = float(evict_low_watermark)
+        self.stats = TreeStats()  # 节点数/token数/实例覆盖等统计，增量维护
+        # 实例内容摘要：instance_id -> PathDigest，成员是该实例的极大路径节点（实例持有、且没有子节点被该实例持有）
+        self.content_digest = bool(content_digest)
+        self.digests: Dict[str, PathDigest] = {}
+        self._digest_lock = threading.Lock()
+        self._swap_lock = threading.RLock()  # 整实例替换期间阻塞路由查询，查询只会看到替换前或替换后的状态
+        self._background_lock = threading.Lock()  # 后台淘汰/过期/回收每一轮持有，quiesced() 用它让这些线程停在两轮之间
+        self.checkpoint_index = CheckpointIndex(checkpoint_interval) if checkpoint_interval > 0 else None
+        # 索引深度上限：路由几乎不依赖第几万个 token 之后是否命中，截断后每条 prompt 的内存和写入开销有上界
+        self.max_index_depth = int(max_index_depth)
+        self.truncated_tokens = 0  # 写入时截掉的 token 数
+        self._changes: Optional[set] = None  # 增量快照：上次快照以来结构或记录变过的节点，track_changes() 之后才记录
+        self.recount()
+
+        self._evict_stop = threading.Event()
+        self._evict_thread = None
+        if self.max_nodes > 0 or self.max_tokens > 0:
+            self._evict_thread = threading.Thread(target=self._evict_loop, name="tree-lru-evict", daemon=True)
+            self._evict_thread.start()
+
+        # 实例记录的置信度衰减 & TTL：引擎的淘汰上报可能延迟或丢失，长时间未确认的记录降权直至过期
+        self.confidence_half_life = float(confidence_half_life)
+        self.presence_ttl = float(presence_ttl)
+        self.sweep_interval = float(sweep_interval)
+        self.expired_presences = 0
+        self._sweep_stop = threading.Event()
+        self._sweep_thread = None
+        if self.presence_ttl > 0:
+            self._sweep_thread = threading.Thread(target=self._sweep_loop, name="tree-presence-ttl", daemon=True)
+            self._sweep_thread.start()
+
+        # 实例代数：实例失联/注销时只把代数 +1（O(1)），旧代数写入的记录在查询时被忽略，由后台线程惰性回收
+        self.generations: Dict[str, int] = {}  # instance_id -> 当前代数，不在表里即 0
+        self.tombstoned: set = set()  # 代数变化后还没有完成回收的实例
+        self.collected_presences = 0
+        self.tombstone_gc_interval = float(tombstone_gc_interval)
+        self._gc_lock = threading.Lock()
+        self._gc_stop = threading.Event()
+        self._gc_thread = None
+
+        # 多轮会话的匹配游标：下一轮 prompt 是上一轮的延续时从游标处继续匹配，只走新增的 token
+        self.session_cursors = SessionCursorCache(session_cache_size) if session_cache_size > 0 else None
+        self._presence_clock = itertools.count(1)  # next() 在 CPython 里是原子的，并发变更也不会拿到相同序号
+        self.instance_epochs: Dict[str, int] = {}  # instance_id -> 该实例最近一次记录增删的序号，游标据此判断哪些实例要重新定位
+
     def on_task_finished(self, task_id):
         """变更任务完成时调用"""
         with self.finish_lock:
@@ -124,30 +227,222 @@ class MergePrefixTree:  # 合并树
     def freeze_trigger_version(self):  # 给外部调用
         with self.global_version_lock:
             self.snapshot_trigger_version = self.global_version
+            self.snapshot_trigger_lsn = self.wal_manager.last_lsn if self.wal_manager is not None else 0
             self.active_snapshots = True
         with self.finish_lock:
-            self.freeze_finished_version = self.current_finish_version  # 后续如果大于这个版本并且小于snapshot_trigger_version 的都将记录到
+            # 后续如果大于这个版本并且小于snapshot_trigger_version 的都将记录到；冻结后分配的版本可能已经完成，不能超过 trigger
+            self.freeze_finished_version = min(self.current_finish_version, self.snapshot_trigger_version)
         return self.snapshot_trigger_version, self.freeze_finished_version
 
+    @contextmanager
+    def quiesced(self):
+        """
+        期间没有线程在改树：ingest lane 执行完手上的任务后停下（队列保留），后台淘汰/过期/回收停在两轮之间。
+        fork 快照在这里 fork，子进程看到的是一棵结构完整的树。路由查询不受影响。
+        """
+        with self._background_lock:
+            self._executor.pause()
+            try:
+                yield
+            finally:
+                self._executor.resume()
+
+    def snapshot_point(self) -> Tuple[int, int, int]:
+        """
+        (已分配的最大版本, 连续完成到的版本, 已分配的最大 WAL LSN)，和 freeze_trigger_version 取法相同，
+        但不开启 old_info 缓存，给 quiesced() 里的 fork 快照用
+        """
+        with self.global_version_lock:
+            version = self.global_version
+            lsn = self.wal_manager.last_lsn if self.wal_manager is not None else 0
+        with self.finish_lock:
+            finish = min(self.current_finish_version, version)  # 之后分配的版本可能已经完成，不能超过 version
+        return version, finish, lsn
+
+    def track_changes(self):
+        """开始记录变更节点（增量快照用）"""
+        if self._changes is None:
+            self._changes = set()
+
+    def take_changes(self) -> set:
+        """取走上次调用以来变更过的节点，包括已经从树上摘下的；要和快照的一致点对齐时在 quiesced() 里调用"""
+        changes = self._changes
+        if changes is None:
+            return set()
+        self._changes = set()
+        return changes
+
+    @property
+    def pending_changes(self) -> int:
+        return len(self._changes) if self._changes is not None else 0
+
+    def _changed(self, node: TreeNode):
+        changes = self._changes
+        if changes is not None:
+            changes.add(node)  # set.add 在 GIL 下是原子的
+
     def update_prefix_tree(self, data: Dict[str, Any], write_wal=True):
+        """
+        一次 Sentry 推送（一个 batch）整体处理：
+        1. 顺序分配 version，同一临界区内整个 batch 的 WAL 作为一组入队（一次入队、一次落盘），
+           保证 LSN 顺序和 version 顺序一致，快照的 covered_lsn 依赖这一点
+        3. 按 instance_id 拆成子 batch，各自提交到该实例固定的 lane，按前缀排序后批量应用
+        :return: 各子 batch 的 future，不需要等待应用完成的调用方可以忽略（WAL 回放用它做背压）
+        """
+        updates = []
         for update_info in data["updates"]:
-            version = self._get_global_version()  # 为每一个node设置一个version
+            if update_info["op_type"] not in self.INSERT_OPS + self.DELETE_OPS + self.RESYNC_OPS + self.TOMBSTONE_OPS:
+                logger.warning("update prefix tree not support op_type:{}".format(update_info["op_type"]))
+                continue
+            if self.max_index_depth > 0:
+                update_info = self._bound_op(update_info)  # 先截断再写 WAL，回放时不需要再处理
+                if update_info is None:
+                    continue
+            updates.append(update_info)
+        if not updates:
+            return []
+        write_wal = write_wal and self.wal_manager is not None
+        pending = self.wal_manager.prepare_batch(updates) if write_wal else None  # 编码放在锁外
+        # version 和 LSN 在同一把锁里分配：LSN <= 冻结 LSN 的记录，version 一定 <= 冻结 version，
+        # 快照才能用 trigger_lsn - (trigger_version - finish_version) 估算已覆盖的 LSN
+        with self.global_version_lock:
+            first = self.global_version + 1
+            self.global_version += len(updates)  # 为每一个node设置一个version
             if write_wal:
-                self.wal_manager.append(update_info)  # 写WAL，异步非阻塞的，恢复是不写wal的
-            if update_info["op_type"] == "insert_node":
-                self._executor.submit(self.insert_prompt,
-                                      update_info["prompt"],
-                                      update_info["prompt_value"],
-                                      update_info["instance_id"],
-                                      version)
-            elif update_info["op_type"] == "delete_node":
-                self._executor.submit(self.evict_prompt,
-                                      update_info["prompt"],
-                                      update_info["length"],
-                                      update_info["instance_id"],
-                                      version)
-            else:
-                result = {"result": "failed", "message": "Not support"}
+                self.wal_manager.append_prepared(pending)  # 写WAL，异步非阻塞的，恢复是不写wal的
+        ops = list(zip(range(first, first + len(updates)), updates))
+        # 按实例拆分：同一实例的变更保持原有顺序进入同一个 lane，不同实例并行
+        ops_by_instance = defaultdict(list)
+        for version, update_info in ops:
+            ops_by_instance[update_info["instance_id"]].append((version, update_info))
+        return [self._executor.submit(instance_id, self.apply_batch, instance_ops)
+                for instance_id, instance_ops in ops_by_instance.items()]
+
+    def ingest_metrics(self) -> Dict[str, Any]:
+        """各写入 lane 的队列深度等指标"""
+        return self._executor.metrics()
+
+    def apply_batch(self, ops: List[Tuple[int, Dict[str, Any]]]):
+        """
+        批量应用一个 batch 的变更。删除作为屏障保持原有顺序，
+        相邻的插入按 prompt 排序（稳定排序），共享前缀的插入复用上一次匹配的路径。
+        """
+        run = []
+        for version, update_info in ops:
+            if update_info["op_type"] in self.INSERT_OPS:
+                run.append((version, update_info))
+                continue
+            if run:
+                self._apply_insert_run(run)
+                run = []
+            if update_info["op_type"] in self.RESYNC_OPS:
+                try:
+                    self.replace_instance(update_info["instance_id"], update_info.get("paths", []), version)
+                except Exception as e:
+                    logger.warning(f"[Tree] resync failed version:{version} error:{e}")
+                    self.on_task_finished(task_id=version)
+                continue
+            if update_info["op_type"] in self.TOMBSTONE_OPS:
+                self.bump_generation(update_info["instance_id"])
+                self.on_task_finished(task_id=version)
+                continue
+            try:
+                self.evict_prompt(self._op_prompt(update_info),
+                                  update_info["instance_id"],
+                                  update_info.get("length", 0),
+                                  version)
+            except Exception as e:
+                logger.warning(f"[Tree] evict failed version:{version} error:{e}")
+                self.on_task_finished(task_id=version)
+        if run:
+            self._apply_insert_run(run)
+
+    def _apply_insert_run(self, run: List[Tuple[int, Dict[str, Any]]], finish: bool = True):
+        run.sort(key=lambda item: self._op_prompt(item[1]))
+        prev_prompt = None
+        path: List[Tuple[TreeNode, int]] = []  # 上一次插入经过的 (节点, 该节点结束时的 prompt 偏移)
+        for version, update_info in run:
+            prompt = TokenKey.pack(self._op_prompt(update_info))  # 每个 prompt 只打包一次，后续都是视图
+            values = self._op_value(update_info)
+            instance_id = update_info["instance_id"]
+            try:
+                reused = self._reusable_path(path, prompt, prev_prompt)
+                start_node, offset = (reused[-1][0], reused[-1][1]) if reused else (self.root, 0)
+                now = time.monotonic()
+                begin = 0
+                for node, end in reused:
+                    with node.lock:
+                        self._set_presence(node, instance_id, values[begin:end])
+                        node.last_access = now
+                    begin = end
+                path = list(reused)
+                self._insert_from(start_node, prompt, values, instance_id, version, path, offset)
+                prev_prompt = prompt
+            except Exception as e:
+                logger.warning(f"[Tree] insert failed version:{version} error:{e}")
+                path, prev_prompt = [], None
+            if finish:
+                self.on_task_finished(task_id=version)
+
+    def _reusable_path(self, path: List[Tuple[TreeNode, int]], prompt: TokenKey, prev_prompt: Optional[TokenKey]):
+        """上一次插入路径中，完全落在两次 prompt 公共前缀内且结构未被并发修改的部分"""
+        if not path or prev_prompt is None:
+            return []
+        reused = []
+        parent, begin = self.root, 0
+        for node, end in path:
+            # 按节点整段比较（memcmp），不逐 token 匹配
+            if not prompt.span_equal(prev_prompt, begin, end):
+                break
+            # 期间若有其他线程 split 了路径上的节点，key 长度或父节点会变化，此时从这里开始重新匹配
+            if node.parent is not parent or node.key is None or len(node.key) != end - begin:
+                break
+            reused.append((node, end))
+            parent, begin = node, end
+        return reused
+
+    def _bound_op(self, update_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        按 max_index_depth 截断一条变更：插入只保留前 max_index_depth 个 token；
+        删除区间整个落在上限之后时丢弃（返回 None），否则只删上限以内的部分；全量同步的每条路径同样截断并去重
+        """
+        cap = self.max_index_depth
+        op_type = update_info["op_type"]
+        if op_type in self.RESYNC_OPS:
+            paths = {}
+            for prompt, values in update_info.get("paths", []):
+                if len(prompt) > cap:
+                    self.truncated_tokens += len(prompt) - cap
+                    prompt, values = prompt[:cap], values[:cap]
+                paths.setdefault(tuple(prompt), [prompt, values])  # 截断后共享前 cap 个 token 的路径只留一条
+            return dict(update_info, paths=list(paths.values()))
+        if op_type not in self.INSERT_OPS + self.DELETE_OPS:
+            return update_info
+        prompt = self._op_prompt(update_info)
+        if len(prompt) <= cap:
+            return update_info
+        bounded = {k: v for k, v in update_info.items() if k not in ("insert_key", "insert_value")}
+        bounded["prompt"] = prompt[:cap]
+        if op_type in self.INSERT_OPS:
+            bounded["prompt_value"] = self._op_value(update_info)[:cap]
+            self.truncated_tokens += len(prompt) - cap
+            return bounded
+        keep = max(len(prompt) - update_info.get("length", 0), 0)
+        if keep >= cap:
+            return None
+        bounded["length"] = cap - keep
+        return bounded
+
+    @staticmethod
+    def _op_prompt(update_info: Dict[str, Any]) -> list:
+        # Sentry 侧插入会被转换成 insert_token/insert_key，这里两种格式都接受
+        prompt = update_info.get("prompt")
+        return prompt if prompt is not None else update_info.get("insert_key", [])
+
+    @staticmethod
+    def _op_value(update_info: Dict[str, Any]) -> list:
+        value = update_info.get("prompt_value")
+        return value if value is not None else update_info.get("insert_value", [])
 
     def insert_prompt(self, key_list: list, value_list: list, instance_id: str, version: int):
         """
@@ -157,62 +452,112 @@ class MergePrefixTree:  # 合并树
         :param version:  暂时不用
         :return:
         """
+        self._insert_from(self.root, TokenKey.pack(key_list), value_list, instance_id, version)
+        self.on_task_finished(task_id=version)  # 第一个更新完成版本
+
+    def _insert_from(self, current_node: TreeNode, prompt: TokenKey, value_list: list, instance_id: str, version: int,
+                     path: Optional[List[Tuple[TreeNode, int]]] = None, offset: int = 0):
+        """
+        从 current_node 开始插入 prompt[offset:]，剩余部分用视图 + 偏移跟踪，不复制 key
+        :param path: 不为 None 时记录经过的 (节点, 结束偏移)，供批量插入复用
+        :param offset: 从完整 prompt 的第几个 token 开始插入
+        """
         # 如果存在 还要加入当前节点 在匹配过程中
-        current_node = self.root
-        while len(key_list) > 0 and key_list[0] in current_node.children.keys():
+        now = time.monotonic()
+        key_list = prompt.tail(offset)
+        leaf = None
+        while len(key_list) > 0:
             current_node.lock.acquire()
-            child_node = current_node.children[key_list[0]]
+            # 取子节点和挂新叶子都在父节点锁内完成：锁外判断 in 之后子节点可能已被删除（defaultdict 会凭空造出空节点），
+            # 也可能已被并发插入挂上了同一个首 token 的子节点（直接赋值会把那棵子树覆盖掉）
+            child_node = current_node.children.get(key_list.first())
+            if child_node is None:
+                # 还有剩余，那么就需要构建一个新的子节点
+                leaf = TreeNode()
+                leaf.key = key_list.compact()  # 不持有整段 prompt 的 buffer
+                leaf.depth = current_node.depth + len(key_list)
+                leaf.value[instance_id] = value_list[offset:]
+                leaf.confirmed[instance_id] = now
+                self._tag_generation(leaf, instance_id)
+                leaf.parent = current_node  # 更新父节点关系
+                leaf.last_access = now
+                parent_was_leaf = not current_node.children
+                current_node.children[key_list.first()] = leaf  # 在父节点下添加新的子节点
+                self._changed(leaf)
+                current_node.lock.release()
+                break
             child_node.lock.acquire()
+            child_node.last_access = now
             length = self._match_length(key_list, child_node.key)  # 看看key_list 和value_list 有多长是相同的
             if length < len(child_node.key):
-                # split node  split 并不改变树，所以也不影响version
-                new_node = TreeNode()
-                with new_node.lock:
-                    if self.active_snapshots:
-                        new_node.version = child_node.version  # 如果位于执行快照期间version不变
-                    else:
-                        new_node.version = version  #
-
-                new_node.key = child_node.key[:length] # 新节点的key
-                child_node.key = child_node.key[length:] # 就节点的key 做split
-                for keys, values in child_node.value.items():
-                    child_node.value[keys] = values[length:]  # 新的节点拿 length的
-                    new_node.value[keys] = values[:length]  # 原节点只有剩下的
-                new_node.parent = child_node.parent  # 新的节点父节点是当前节点的父节点
-                child_node.parent.children[key_list[0]] = new_node  # 原来的父节点指向新的节点
-                child_node.parent = new_node  # 当前节点的父节点更改为新的节点
-                new_node.children[child_node.key[0]] = new_node  # 新节点的子节点是当前节点，但是需要更换索引，也就是现在的child_node.key[0]
+                new_node = self._split_node(child_node, length, version)
+                self._set_presence(new_node, instance_id, value_list[offset:offset + length])  # 匹配上的部分当前实例也持有
+                new_node.last_access = now
 
                 child_node.lock.release()  # 释放锁
                 current_node.lock.release()  # 释放锁
-
-                key_list = key_list[:length]  # 更新剩余prompt
-                value_list = value_list[:length]  # 更新剩余prompt对应的value
                 current_node = new_node  # 更新现在的节点为 new_node
             else:
                 # child_node的value 加入一个instance_id value_list，无论是否存在都直接修改
-                child_node.value[instance_id] = value_list[:length]
-
-                value_list = value_list[length:]  # 更新剩下的value
-                key_list = key_list[length:]  # 更新剩下的key
+                self._set_presence(child_node, instance_id, value_list[offset:offset + length])
 
                 child_node.lock.release()  # 释放子节点的锁
                 current_node.lock.release()  # 释放父节点的锁
                 current_node = child_node  # 更新current_node
 
-        if len(key_list) > 0:
-            # 还有剩余，那么就需要构建一个新的子节点
-            with current_node.lock:  # 这里用with就可以了
-                new_node = TreeNode()
-                new_node.key = key_list
-                new_node.value[instance_id] = value_list
-                new_node.parent = current_node  # 更新父节点关系
-                current_node.children[key_list[0]] = new_node  # 在父节点下添加新的子节点
+            offset += length
+            key_list = key_list.tail(length)  # 更新剩余prompt（视图）
+            if path is not None:
+                path.append((current_node, offset))
 
-        self.on_task_finished(task_id=version)  # 第一个更新完成版本
+        if leaf is not None:
+            if self.checkpoint_index is not None:
+                self._index_leaf(leaf, prompt)
+            self.stats.node_added(leaf.depth, len(key_list), parent_was_leaf)
+            self.stats.presence_added(instance_id, len(key_list))
+            self._presence_changed(instance_id)
+            self._digest_gained(leaf, instance_id)
+            if path is not None:
+                path.append((leaf, offset + len(key_list)))
+
+    def _split_node(self, child_node: TreeNode, length: int, version: int) -> TreeNode:
+        """
+        在 length 处把 child_node 切成 [new_node(前半) -> child_node(后半)]，调用方需持有 child_node 及其父节点的锁
+        :return: 新的前半节点
+        """
+        # split node  split 并不改变树，所以也不影响version
+        new_node = TreeNode()
+        with new_node.lock:
+            if self.active_snapshots:
+                new_node.version = child_node.version  # 如果位于执行快照期间version不变
+            else:
+                new_node.version = version  #
+        new_node.last_access = child_node.last_access
+
+        first_token = child_node.key[0]
+        new_node.key = child_node.key.head(length).compact() # 新节点的key，两半各自独立的 buffer
+        child_node.key = child_node.key.tail(length).compact() # 就节点的key 做split
+        for keys, values in child_node.value.items():
+            child_node.value[keys] = values[length:]  # 新的节点拿 length的
+            new_node.value[keys] = values[:length]  # 原节点只有剩下的
+        new_node.confirmed = dict(child_node.confirmed)
+        new_node.generation = dict(child_node.generation)
+        new_node.parent = child_node.parent  # 新的节点父节点是当前节点的父节点
+        new_node.depth = child_node.depth - len(child_node.key)
+        child_node.parent.children[first_token] = new_node  # 原来的父节点指向新的节点
+        child_node.parent = new_node  # 当前节点的父节点更改为新的节点
+        new_node.children[child_node.key[0]] = child_node  # 新节点的子节点是当前节点，但是需要更换索引，也就是现在的child_node.key[0]
+        self._changed(new_node)
+        self._changed(child_node)
+        if self.checkpoint_index is not None:
+            self.checkpoint_index.split(new_node, child_node)
+        self.stats.node_split(new_node.depth)  # split 只增加节点数，token 总数和实例覆盖都不变
+        return new_node
 
     @staticmethod
     def _match_length(key_value, node_value):
+        if isinstance(key_value, TokenKey) and isinstance(node_value, TokenKey):
+            return key_value.match_length(node_value)  # memcmp，不逐个比较
         length = 0
         while length < len(node_value) and length < len(key_value):
             if key_value[length] == node_value[length]:
@@ -222,71 +567,364 @@ class MergePrefixTree:  # 合并树
         return length
 
     def evict_prompt(self, key_list: list, instance_id: str, delete_length: int, version: int):
-        # 删除逻辑是 删除有的，如果没找到，并不会报错
-        # 在推理实例中并不是完整的删除一整条路径，而是删除叶子节点
+        """
+        推理实例淘汰了 key_list 末尾 delete_length 个token（删除的是叶子节点），
+        把 instance_id 在这段区间上的记录去掉；没有任何实例持有且没有子节点的节点会被删除。
+        删除逻辑是 删除有的，如果没找到，并不会报错
+        前提：和 Sentry 的 RadixTree 一样只淘汰叶子，即 key_list[keep:] 下该实例没有其他路径。
+        这里只清理 key_list 路径上的节点，GenerationalPrefixIndex 清理偏移 keep 处的整棵子树，
+        两者只在满足这个前提时结果一致
+        """
+        key_list = TokenKey.pack(key_list)
+        keep = max(len(key_list) - delete_length, 0)
         current_node = self.root
-        int
-        match_count = 0
-        while len(key_list) > 0 and key_list[0] in current_node.children.keys():
-
+        offset = 0
+        touched = []
+        while offset < len(key_list):
             current_node.lock.acquire()
-            child_node = current_node.children[key_list[0]]
-            child_node.lock.acquire()
-            length = self._match_length(key_list, child_node.key)
-            match_count += length
-            if not instance_id in child_node.value.keys():  # 如果这个节点里面并没有这个节点的信息
-                break  # 那就是未找到
-            if match_count <= delete_length:
-                child_node.lock.release()
+            locked_node = child_node = current_node.children.get(key_list[offset])  # 锁内取，避免 defaultdict 造出空节点
+            if child_node is None:
+                current_node.lock.release()
+                break
+            locked_node.lock.acquire()
+            length = self._match_length(key_list[offset:], child_node.key)
+            if instance_id not in child_node.value.keys() or length == 0:  # 如果这个节点里面并没有这个节点的信息
+                locked_node.lock.release()
                 current_node.lock.release()
+                break  # 那就是未找到
+            if offset < keep < offset + len(child_node.key):
+                # 删除区间从节点中间开始，先 split，前半段保留，下一轮处理后半段
+                child_node = self._split_node(child_node, keep - offset, version)
+                length = min(length, keep - offset)
+            elif offset >= keep:
+                self._drop_presence(child_node, instance_id)  # 删除这个value
+                touched.append(child_node)
+            locked_node.lock.release()
+            current_node.lock.release()
+            if length < len(child_node.key):
+                break
+            offset += length
+            current_node = child_node
 
-                key_list = key_list[:length]  # 截断key_list
-                current_node = child_node
-            else:
-                index = delete - (match_count - length)
-                if len(child_node.value) == 1:  # 只有这一个节点用于它
-                    if index == 0:
-                        # 删除整个节点及其所有子节点
-                        child_node.lock.release()
-                        current_node.lock.release()
-                        self._delete_next_all_node(current_node) # 删除这个节点及其所有子节点
-
-                        pass
-                    else:
-                        # TODO 删除这个节点后面所有的节点（注意要释放内存）
-                        child_node.key = child_node.key[:index]
-                        child_node.value[instance_id] = child_node.value[instance_id][:index]
-                        child_node.lock.release()
-                        current_node.lock.release()
-                        for key, value in child_node.children.items():
-                            self._delete_next_all_node(value)
-
-                else: # 有两个及以上节点拥有该Key
-                    if index == 0:
-                        del child_node.value[instance_id] # 删除这个value
-                        # TODO 删除这个节点后面所有节点里面 instace_id的信息（理论上不会有这一步）
-                    else:
-                        # TODO Split
-                        new_node = TreeNode()
-                        new_node.key = child_node.key[:index]
-                        child_node.key = child_node.key[index:]
-                        for keys, values in child_node.value.items():
-                            child_node.value[keys] = values[index:]  # 新的节点拿 length的
-                            new_node.value[keys] = values[:index]  # 原节点只有剩下的
+        # 从深到浅清理已经没有实例持有的叶子节点
+        for node in reversed(touched):
+            self._remove_if_empty_leaf(node)
+        self.on_task_finished(task_id=version)
+
+    # ------------------------------
+    # 整实例替换（重连后的全量同步）
+    # ------------------------------
+    @staticmethod
+    def image_paths(tree_info: Dict[str, Any]) -> List[List[list]]:
+        """把 Sentry /v1/radixtree/full 形状的树（key/value/children 嵌套）展开成极大路径 [[prompt, prompt_value], ...]"""
+        paths = []
+        stack = [(tree_info, [], [])]
+        while stack:
+            node, prompt, values = stack.pop()
+            prompt = prompt + list(node.get("key") or [])
+            values = values + list(node.get("value") or [])
+            children = node.get("children") or []
+            if not children and prompt:
+                paths.append([prompt, values])
+            for child in children:
+                stack.append((child, prompt, values))
+        return paths
+
+    def resync_instance(self, instance_id: str, paths: List[List[list]]):
+        """
+        用一份完整镜像替换实例在树上的全部记录。整个镜像作为一条 WAL 记录写入，
+        替换任务进入该实例的 lane，和它前后的增量变更保持顺序。返回替换任务的 future
+        """
+        return self.update_prefix_tree({"updates": [{"op_type": "resync_instance", "instance_id": instance_id, "paths": paths}]})
+
+    def replace_instance(self, instance_id: str, paths: List[List[list]], version: int):
+        """先在旁路把镜像整理成排好序的插入序列，再在 _swap_lock 内清掉旧记录、写入新记录"""
+        run = [(version, {"op_type": "insert_node", "instance_id": instance_id, "prompt": prompt, "prompt_value": values})
+               for prompt, values in paths if prompt]
+        run.sort(key=lambda item: item[1]["prompt"])
+        with self._swap_lock:
+            dropped = self._drop_instance(instance_id)
+            self._apply_insert_run(run, finish=False)
+            # 新镜像里没有的节点此时已经没有该实例，从深到浅清理空叶子
+            for node in reversed(dropped):
+                self._remove_if_empty_leaf(node)
+        logger.info(f"[Tree] resync instance {instance_id}: dropped {len(dropped)} nodes, inserted {len(run)} paths")
+        self.on_task_finished(task_id=version)
+
+    def _drop_instance(self, instance_id: str) -> List[TreeNode]:
+        """去掉实例在所有节点上的记录，返回先序遍历顺序的节点列表（实例的记录是前缀闭合的，只需沿持有的子节点向下）"""
+        dropped = []
+        stack = [child for child in list(self.root.children.values()) if child.value.get(instance_id) is not None]
+        while stack:
+            node = stack.pop()
+            with node.lock:
+                self._drop_presence(node, instance_id)
+            dropped.append(node)
+            stack.extend(child for child in list(node.children.values()) if child.value.get(instance_id) is not None)
+        return dropped
+
+    def _remove_if_empty_leaf(self, node: TreeNode) -> bool:
+        parent = node.parent
+        if parent is None:
+            return False
+        with parent.lock, node.lock:
+            if node.children or len(node.value) > 0 or node.parent is not parent or not node.key:
+                return False
+            if parent.children.get(node.key[0]) is not node:
+                return False
+            del parent.children[node.key[0]]
+            node.parent = None
+            parent_became_leaf = not parent.children
+            self._changed(node)
+        if self.checkpoint_index is not None:
+            self.checkpoint_index.remove(node)
+        self.stats.node_removed(node.depth, len(node.key), parent_became_leaf)
+        return True
+
+    def _set_presence(self, node: TreeNode, instance_id: str, value):
+        """
+        设置实例在节点上的 value，实例第一次出现在该节点时计入覆盖统计；调用方持有 node.lock。
+        旧代数的记录直接被覆盖成当前代数（覆盖统计里已经算过，只需要重新进入摘要）
+        """
+        gained = node.value.get(instance_id) is None
+        revived = not gained and not self.is_live(node, instance_id)
+        node.value[instance_id] = value
+        node.confirmed[instance_id] = time.monotonic()
+        self._changed(node)
+        self._tag_generation(node, instance_id)
+        if gained:
+            self.stats.presence_added(instance_id, len(node.key))
+        if gained or revived:
+            self._presence_changed(instance_id)
+            self._digest_gained(node, instance_id)
 
-                        new_node.parent = child_node.parent  # 新的节点父节点是当前节点的父节点
-                        child_node.parent = new_node  # 当前节点的父节点更改为新的节点
+    def _drop_presence(self, node: TreeNode, instance_id: str):
+        node.confirmed.pop(instance_id, None)
+        node.generation.pop(instance_id, None)
+        if node.value.pop(instance_id, None) is not None:
+            self._changed(node)
+            self.stats.presence_removed(instance_id, len(node.key))
+            self._presence_changed(instance_id)
+            self._digest_lost(node, instance_id, node.parent)
 
-                        child_node.parent.children[key_list[0]] = new_node  # 原来的父节点指向新的节点
-                        new_node.children[child_node.key[0]] = new_node  # 新节点的子节点是当前节点，但是需要更换索引，也就是现在的child_node.key[0]
+    def _presence_changed(self, instance_id: str):
+        self.instance_epochs[instance_id] = next(self._presence_clock)
 
-                        child_node.lock.release()  # 释放锁
-                        current_node.lock.release()  # 释放锁
+    # ------------------------------
+    # 实例代数（惰性删除）
+    # ------------------------------
+    def _tag_generation(self, node: TreeNode, instance_id: str):
+        generation = self.generations.get(instance_id, 0)
+        if generation:
+            node.generation[instance_id] = generation
+        else:
+            node.generation.pop(instance_id, None)
 
-                        key_list = key_list[index:]  # 更新剩余prompt
-                        current_node = new_node  # 更新现在的节点为 new_node
+    def is_live(self, node: TreeNode, instance_id: str) -> bool:
+        """实例在节点上有记录，且记录是当前代数写入的"""
+        return node.value.get(instance_id) is not None and \
+            node.generation.get(instance_id, 0) == self.generations.get(instance_id, 0)
 
-                        match_count = match_count - length + index # 继续进入下次循环，进入循环之前重置下match_count
+    def live_value(self, node: TreeNode) -> Dict[str, Any]:
+        """节点上当前代数的记录（快照只保存这些）"""
+        return {instance_id: value for instance_id, value in node.value.items() if self.is_live(node, instance_id)}
+
+    def tombstone_instance(self, instance_id: str):
+        """
+        实例失联或注销：作废它在树上的全部记录。作为一条 WAL 记录写入，进入该实例的 lane，
+        和它之前的增量变更保持顺序；执行时只是代数 +1，不遍历树。返回作废任务的 future
+        """
+        return self.update_prefix_tree({"updates": [{"op_type": "tombstone_instance", "instance_id": instance_id}]})
+
+    def bump_generation(self, instance_id: str) -> int:
+        """实例代数 +1，旧记录立即对查询不可见，摘要清空，等待后台回收"""
+        with self._gc_lock:
+            generation = self.generations.get(instance_id, 0) + 1
+            self.generations[instance_id] = generation
+            self.tombstoned.add(instance_id)
+            self._presence_changed(instance_id)
+            if self._gc_thread is None:
+                self._gc_thread = threading.Thread(target=self._gc_loop, name="tree-tombstone-gc", daemon=True)
+                self._gc_thread.start()
+        if self.content_digest:
+            with self._digest_lock:
+                self.digests[instance_id] = PathDigest()
+        logger.info(f"[Tree] instance {instance_id} tombstoned, generation:{generation}")
+        return generation
+
+    def _gc_loop(self):
+        while not self._gc_stop.wait(self.tombstone_gc_interval):
+            if not self.tombstoned:
+                continue
+            try:
+                with self._background_lock:
+                    self.collect_tombstones()
+            except Exception as e:
+                logger.warning(f"[Tree] tombstone gc failed: {e}")
+
+    def stop_tombstone_gc(self):
+        self._gc_stop.set()
+        if self._gc_thread:
+            self._gc_thread.join()
+            self._gc_thread = None
+
+    def collect_tombstones(self) -> int:
+        """
+        遍历一遍树，删除旧代数的记录，没有实例持有的叶子随之删除（先子后父）。
+        遍历期间又被作废的实例留到下一轮。
+        :return: 本次回收的 (节点, 实例) 记录数
+        """
+        with self._gc_lock:
+            pending = set(self.tombstoned)
+        if not pending:
+            return 0
+        order = []
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node.children.values())
+
+        collected = 0
+        for node in reversed(order):
+            stale = [instance_id for instance_id in list(node.value.keys())
+                     if instance_id in pending and not self.is_live(node, instance_id)]
+            if stale:
+                with node.lock:
+                    for instance_id in stale:
+                        if node.value.get(instance_id) is not None and not self.is_live(node, instance_id):
+                            self._drop_presence(node, instance_id)
+                            collected += 1
+            # 没有记录的内部节点在子节点被回收后也会变成空叶子（实例复活后又淘汰了前缀，旧代数的子孙还挂在下面）
+            if stale or len(node.value) == 0:
+                self._remove_if_empty_leaf(node)
+        with self._gc_lock:
+            self.tombstoned -= pending
+            self.collected_presences += collected
+        logger.info(f"[Tree] collected {collected} tombstoned presences of {len(pending)} instances, "
+                    f"node_count:{self.node_count}")
+        return collected
+
+    # ------------------------------
+    # 实例内容摘要（反熵）
+    # ------------------------------
+    def _node_path_hash(self, node: TreeNode) -> int:
+        if node.path_hash is None:
+            chunks = []
+            current = node
+            while current is not None and current is not self.root:
+                chunks.append(current.key)
+                current = current.parent
+            chunks.reverse()
+            node.path_hash = path_hash(chunks)
+        return node.path_hash
+
+    def _held_by_child(self, node: TreeNode, instance_id: str) -> bool:
+        return any(self.is_live(child, instance_id) for child in list(node.children.values()))
+
+    def instance_digest(self, instance_id: str) -> PathDigest:
+        with self._digest_lock:
+            digest = self.digests.get(instance_id)
+            if digest is None:
+                digest = self.digests[instance_id] = PathDigest()
+            return digest
+
+    def _digest_gained(self, node: TreeNode, instance_id: str):
+        """实例开始持有 node：父节点不再是极大路径，node 在没有子节点被该实例持有时成为极大路径"""
+        if not self.content_digest:
+            return
+        digest = self.instance_digest(instance_id)
+        with self._digest_lock:
+            parent = node.parent
+            if parent is not None and parent.path_hash is not None:
+                digest.discard(parent.path_hash)
+            if not self._held_by_child(node, instance_id):
+                digest.add(self._node_path_hash(node), node)
+
+    def _digest_lost(self, node: TreeNode, instance_id: str, parent: Optional[TreeNode]):
+        """实例不再持有 node（或 node 被删除）：父节点在没有其他子节点被该实例持有时重新成为极大路径"""
+        if not self.content_digest:
+            return
+        digest = self.instance_digest(instance_id)
+        with self._digest_lock:
+            if node.path_hash is not None:
+                digest.discard(node.path_hash)
+            if parent is not None and parent is not self.root and self.is_live(parent, instance_id) \
+                    and not self._held_by_child(parent, instance_id):
+                digest.add(self._node_path_hash(parent), parent)
+
+    def rebuild_digests(self):
+        """全量重建所有实例的摘要（加载快照替换 root 后调用）"""
+        if not self.content_digest:
+            return
+        with self._digest_lock:
+            for digest in self.digests.values():
+                digest.clear()
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            for instance_id in node.value.keys():
+                if self.is_live(node, instance_id) and not self._held_by_child(node, instance_id):
+                    self.instance_digest(instance_id).add(self._node_path_hash(node), node)
+            stack.extend(node.children.values())
+
+    def digest_children(self, instance_id: str, level: int, buckets: List[int]) -> Dict[str, Dict[str, Any]]:
+        return self.instance_digest(instance_id).children(level, buckets)
+
+    def _node_prompt(self, node: TreeNode) -> List[int]:
+        chunks = []
+        current = node
+        while current is not None and current is not self.root:
+            chunks.append(current.key.tolist())
+            current = current.parent
+        return [token for chunk in reversed(chunks) for token in chunk]
+
+    def reconcile_ops(self, instance_id: str, leaf_buckets: List[int], remote_paths: List[Dict[str, Any]],
+                      confirmed: Optional[set] = None) -> Tuple[set, List[Dict[str, Any]]]:
+        """
+        对比若干叶子桶内本地和 Sentry 的极大路径，生成修复操作（先删除多余的，再插入缺失的）。
+        :param remote_paths: Sentry 返回的 [{"hash", "prompt", "prompt_value"}]
+        :param confirmed: 只修复在这个集合里的路径哈希（上一轮也不一致的），None 表示全部修复
+        :return: (本轮不一致的路径哈希集合, 修复操作列表)
+        """
+        local = self.instance_digest(instance_id).members_in(leaf_buckets)
+        remote = {int(item["hash"]): item for item in remote_paths if leaf_bucket(int(item["hash"])) in set(leaf_buckets)}
+        extra = [h for h in local if h not in remote]
+        missing = [h for h in remote if h not in local]
+        diff = set(extra) | set(missing)
+        if confirmed is not None:
+            extra = [h for h in extra if h in confirmed]
+            missing = [h for h in missing if h in confirmed]
+
+        ops = []
+        # 多余的极大路径：从叶子往上一直删到还有其他子节点被该实例持有的祖先为止；
+        # 同一批里共享前缀的多余路径共同计数，祖先的所有持有子节点都要删时祖先一起删
+        remaining: Dict[int, int] = {}
+        for h in extra:
+            node = local[h]
+            if node.parent is None:  # 已经被删除
+                continue
+            prompt = self._node_prompt(node)
+            current = node
+            while True:
+                parent = current.parent
+                if parent is None or parent is self.root or not self.is_live(parent, instance_id):
+                    break
+                if parent.id not in remaining:
+                    remaining[parent.id] = sum(1 for child in list(parent.children.values())
+                                               if self.is_live(child, instance_id))
+                remaining[parent.id] -= 1
+                if remaining[parent.id] > 0:
+                    break
+                current = parent
+            keep = current.depth - len(current.key)
+            ops.append({"op_type": "delete_node", "instance_id": instance_id,
+                        "prompt": prompt, "length": len(prompt) - keep})
+        for h in missing:
+            item = remote[h]
+            ops.append({"op_type": "insert_node", "instance_id": instance_id,
+                        "prompt": item["prompt"], "prompt_value": item["prompt_value"]})
+        return diff, ops
 
 
     def _delete_next_all_node(self, node: TreeNode):
@@ -320,3 +958,469 @@ class MergePrefixTree:  # 合并树
                         self._evict_prompt_by_instance(value, instace_id)
                     # node.lock.release() 加在这里可能会死锁
 
+
+    # ------------------------------
+    # 路由查询
+    # ------------------------------
+    def search_instances_with_prefix(self, key_list: List[int]) -> List[str]:
+        """搜索包含指定前缀的所有实例ID，命中路径上的节点会刷新 last_access"""
+        with self._swap_lock:
+            return self._search_instances_with_prefix(key_list)
+
+    def _search_instances_with_prefix(self, key_list: List[int]) -> List[str]:
+        matched_instances = set()
+        now = time.monotonic()
+        node = self.root
+        remaining_key = TokenKey.pack(key_list)
+        while remaining_key:
+            child = node.children.get(remaining_key.first())
+            if child is None:
+                return list(matched_instances)
+            child.last_access = now
+            length = self._match_length(remaining_key, child.key)
+            if length < len(child.key):
+                # 部分匹配，收集该节点的实例
+                self._collect_instances_from_node(child, matched_instances)
+                return list(matched_instances)
+            # 完全匹配，继续搜索剩余key（视图，不复制）
+            remaining_key = remaining_key.tail(length)
+            node = child
+        # 收集该节点及所有子节点的实例
+        self._collect_instances_from_node(node, matched_instances)
+        return list(matched_instances)
+
+    def confidence(self, node: TreeNode, instance_id: str, now: float = None) -> float:
+        """实例在节点上记录的置信度：距最近一次确认每过一个半衰期减半"""
+        if self.confidence_half_life <= 0:
+            return 1.0
+        now = time.monotonic() if now is None else now
+        age = max(now - node.confirmed.get(instance_id, now), 0.0)
+        return 0.5 ** (age / self.confidence_half_life)
+
+    def match_instances_with_prefix(self, key_list: List[int], session_id: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        沿查询路径给每个实例打分：match_length 是实例在路径上覆盖的 token 数，
+        score = match_length * 最深匹配节点上的置信度。命中路径上的节点会刷新 last_access
+        设置了 max_index_depth 时只匹配 prompt 的前 max_index_depth 个 token，匹配到上限的实例 capped 为 True（实际命中 ≥ 上限）
+        :param session_id: 多轮会话标识。上一轮的游标仍然有效且本轮 prompt 是上一轮的延续时，从游标处继续匹配
+        :return: {instance_id: {"match_length", "confidence", "score", "capped"}}
+        """
+        if 0 < self.max_index_depth < len(key_list):
+            key_list = key_list[:self.max_index_depth]
+        with self._swap_lock:
+            now = time.monotonic()
+            prompt = TokenKey.pack(key_list)
+            use_cursor = session_id is not None and self.session_cursors is not None
+            epochs = dict(self.instance_epochs) if use_cursor else None  # 查询开始前取，期间的变更下一轮会被发现
+            cursor = self._resume_cursor(session_id, prompt) if use_cursor else None
+            if cursor is None and not use_cursor and self.checkpoint_index is not None \
+                    and len(prompt) >= self.checkpoint_index.interval * self.CHECKPOINT_MIN_SEGMENTS:
+                found = self._checkpoint_match(prompt, now)
+                if found is not None:
+                    return self._score_matches(found.items(), now)
+            if cursor is None:
+                node, offset, path, matched, digest = self.root, 0, [], {}, 0
+            else:
+                node, offset, path, matched, digest = cursor.path[-1], cursor.offset, list(cursor.path), cursor.matched, cursor.digest
+                node.last_access = now
+            start = offset
+
+            partial: Dict[str, Tuple[int, TreeNode]] = {}  # 最后一个部分匹配节点上的实例，不进游标
+            remaining_key = prompt.tail(offset)
+            while remaining_key:
+                child = node.children.get(remaining_key.first())
+                if child is None:
+                    break
+                child.last_access = now
+                length = self._match_length(remaining_key, child.key)
+                hit = partial if length < len(child.key) else matched
+                for instance_id in child.value.keys():
+                    if child.generation.get(instance_id, 0) != self.generations.get(instance_id, 0):
+                        continue  # 旧代数的记录，等待回收
+                    hit[instance_id] = (offset + length, child)
+                if length < len(child.key):
+                    break
+                offset += length
+                path.append(child)
+                remaining_key = remaining_key.tail(length)
+                node = child
+
+            if use_cursor and path:
+                digest = prefix_digest(prompt, start, offset, digest)
+                self.session_cursors.put(session_id, SessionCursor(self.root, path, offset, digest, dict(matched), epochs))
+            return self._score_matches(itertools.chain(matched.items(), partial.items()), now)
+
+    def _score_matches(self, matches, now: float) -> Dict[str, Dict[str, float]]:
+        """[(instance_id, (match_length, 最深匹配节点))] -> {instance_id: {"match_length", "confidence", "score", "capped"}}"""
+        result: Dict[str, Dict[str, float]] = {}
+        for instance_id, (match_length, match_node) in matches:
+            confidence = self.confidence(match_node, instance_id, now)
+            result[instance_id] = {"match_length": match_length, "confidence": confidence,
+                                   "score": match_length * confidence,
+                                   "capped": 0 < self.max_index_depth <= match_length}
+        return result
+
+    def _resume_cursor(self, session_id: str, prompt: TokenKey) -> Optional[SessionCursor]:
+        """
+        取出会话游标并校验：root 没有被替换、游标节点还在树上（只有叶子会被删除，游标节点在则整条路径都在）、
+        本轮 prompt 以上一轮匹配过的前缀开头。之后有记录增删的实例在缓存路径上重新定位最深匹配。
+        """
+        cursor = self.session_cursors.get(session_id)
+        if cursor is None:
+            return None
+        if cursor.root is not self.root or cursor.path[-1].parent is None or len(prompt) < cursor.offset \
+                or prefix_digest(prompt, 0, cursor.offset) != cursor.digest:
+            self.session_cursors.invalidate(session_id)
+            return None
+        matched = dict(cursor.matched)
+        for instance_id, epoch in list(self.instance_epochs.items()):
+            if cursor.epochs.get(instance_id) == epoch:
+                continue
+            found = self._deepest_on_path(cursor.path, instance_id)
+            if found is None:
+                matched.pop(instance_id, None)
+            else:
+                matched[instance_id] = found
+        self.session_cursors.hit()
+        return SessionCursor(cursor.root, cursor.path, cursor.offset, cursor.digest, matched, cursor.epochs)
+
+    def _deepest_on_path(self, path: List[TreeNode], instance_id: str) -> Optional[Tuple[int, TreeNode]]:
+        """
+        实例在缓存路径上的最深匹配。实例的记录是前缀闭合的，沿路径单调，所以二分；
+        缓存之后路径上的节点可能被 split 过，两个相邻缓存节点之间多出的前半节点再逐个检查
+        """
+        lo, hi = 0, len(path)  # path[:lo] 被持有，path[hi:] 不被持有
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.is_live(path[mid], instance_id):
+                lo = mid + 1
+            else:
+                hi = mid
+        lower = path[lo - 1] if lo > 0 else self.root
+        if lo < len(path):
+            current = path[lo].parent
+            while current is not None and current is not lower:
+                if self.is_live(current, instance_id):
+                    return current.depth, current
+                current = current.parent
+        if lower is self.root:
+            return None
+        return lower.depth, lower
+
+    # ------------------------------
+    # 前缀检查点（长 prompt 路由）
+    # ------------------------------
+    def _nearest_checkpoint(self, node: TreeNode) -> Tuple[int, int]:
+        """node 及其祖先上最靠后的检查点 (偏移, 哈希)，没有时是起点 (0, 0)"""
+        current = node
+        while current is not None and current is not self.root:
+            checkpoints = current.checkpoints
+            if checkpoints:
+                return checkpoints[-1]
+            current = current.parent
+        return 0, 0
+
+    def _index_leaf(self, leaf: TreeNode, prompt: TokenKey):
+        """新叶子区间内的检查点：从最近的祖先检查点开始，沿插入的 prompt 链式计算"""
+        start = leaf.depth - len(leaf.key)
+        offset, g = self._nearest_checkpoint(leaf.parent)
+        entries = [entry for entry in self.checkpoint_index.extend(offset, g, prompt, leaf.depth) if entry[0] > start]
+        self.checkpoint_index.add(leaf, entries)
+
+    def rebuild_checkpoints(self):
+        """全量重建检查点索引（加载快照替换 root 后调用）"""
+        index = self.checkpoint_index
+        if index is None:
+            return
+        index.clear()
+        stack = [(child, 0, 0, b"") for child in self.root.children.values()]
+        while stack:
+            node, offset, g, carry = stack.pop()
+            node.checkpoints = None
+            entries, carry = index.scan(offset, g, carry + bytes(node.key._bytes()))
+            index.add(node, entries)
+            if entries:
+                offset, g = entries[-1]
+            stack.extend((child, offset, g, carry) for child in node.children.values())
+
+    def _checkpoint_node(self, j: int, g: int) -> Optional[TreeNode]:
+        """第 j 个检查点所在的节点；并发 split/删除期间记录可能暂时不准，校验节点仍在树上且区间包含该偏移"""
+        offset = j * self.checkpoint_index.interval
+        node = self.checkpoint_index.get(offset, g)
+        if node is None or node.parent is None or node.key is None:
+            return None
+        if not node.depth - len(node.key) < offset <= node.depth:
+            return None
+        return node
+
+    def _walk_from(self, node: TreeNode, pos: int, prompt: TokenKey, stop: int, now: float) -> List[Tuple[TreeNode, int]]:
+        """从 node 区间内的偏移 pos 处沿 prompt 往下匹配，返回 [(节点, 匹配到的末尾偏移)]，到包含 stop 的节点或分叉为止"""
+        steps = []
+        if node is not self.root:
+            start = node.depth - len(node.key)
+            end = pos + self._match_length(prompt.tail(pos), node.key.tail(pos - start))
+            node.last_access = now
+            steps.append((node, end))
+            if end < node.depth or end >= stop:
+                return steps
+            pos = end
+        while pos < len(prompt):
+            child = node.children.get(prompt[pos])
+            if child is None:
+                break
+            child.last_access = now
+            length = self._match_length(prompt.tail(pos), child.key)
+            steps.append((child, pos + length))
+            if length < len(child.key) or pos + length >= stop:
+                break
+            pos += length
+            node = child
+        return steps
+
+    def _checkpoint_match(self, prompt: TokenKey, now: float) -> Optional[Dict[str, Tuple[int, TreeNode]]]:
+        """
+        长 prompt 的路由匹配：一次扫描算出 prompt 每个检查点的哈希，二分找到树上存在的最长检查点，
+        每个实例再在检查点上二分（实例的记录前缀闭合，沿路径单调）定位到所在的段，最后只在这一段内逐节点匹配。
+        检查点查找不到（或并发修改导致不一致）时返回 None，由调用方逐节点匹配。
+        :return: {instance_id: (match_length, 最深匹配节点)}
+        """
+        interval = self.checkpoint_index.interval
+        hashes = self.checkpoint_index.prompt_hashes(prompt, len(prompt) // interval)
+        nodes: Dict[int, Optional[TreeNode]] = {}
+
+        def node_at(j: int) -> Optional[TreeNode]:
+            if j not in nodes:
+                nodes[j] = self._checkpoint_node(j, hashes[j - 1])
+            return nodes[j]
+
+        lo, hi = 0, len(hashes)  # 树上存在长度 j*interval 的前缀时，更短的检查点也都存在
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if node_at(mid) is not None:
+                lo = mid
+            else:
+                hi = mid - 1
+        if lo == 0 or node_at(1) is None:
+            return None
+
+        walks: Dict[int, List[Tuple[TreeNode, int]]] = {}
+
+        def walk(j: int) -> List[Tuple[TreeNode, int]]:
+            if j not in walks:
+                stop = (j + 1) * interval if j < lo else len(prompt) + 1
+                walks[j] = self._walk_from(node_at(j) if j else self.root, j * interval, prompt, stop, now)
+            return walks[j]
+
+        candidates = set()
+        for node, _ in walk(0):
+            candidates.update(instance_id for instance_id in node.value.keys() if self.is_live(node, instance_id))
+        matched: Dict[str, Tuple[int, TreeNode]] = {}
+        for instance_id in candidates:
+            a = 0
+            if self.is_live(node_at(1), instance_id):
+                a, b = 1, lo
+                while a < b:
+                    mid = (a + b + 1) // 2
+                    node = node_at(mid)
+                    if node is None:
+                        return None
+                    if self.is_live(node, instance_id):
+                        a = mid
+                    else:
+                        b = mid - 1
+            for node, end in reversed(walk(a)):
+                if self.is_live(node, instance_id):
+                    matched[instance_id] = (end, node)
+                    break
+        return matched
+
+    def _collect_instances_from_node(self, node: TreeNode, instances: set):
+        """收集节点及其子节点的所有实例ID（忽略旧代数的记录）"""
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            instances.update(instance_id for instance_id in current.value.keys()
+                             if current.generation.get(instance_id, 0) == self.generations.get(instance_id, 0))
+            stack.extend(current.children.values())
+
+    # ------------------------------
+    # 内存预算 & LRU 淘汰
+    # ------------------------------
+    def recount(self):
+        """全量重建统计信息、节点 depth 和实例摘要（加载快照替换 root 后调用）"""
+        stats = TreeStats()
+        self.root.depth = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            tokens = len(node.key) if node.key else 0
+            if node is not self.root:
+                node.depth = node.parent.depth + tokens
+            stats.node_count += 1
+            stats.token_count += tokens
+            if node.children:
+                stats.internal_count += 1
+            stats.depth_histogram[stats.depth_bucket(node.depth)] += 1
+            for instance_id in node.value.keys():
+                stats.instance_tokens[instance_id] += tokens
+                node.confirmed.setdefault(instance_id, time.monotonic())  # 快照里没有确认时间，按加载时刻算
+            stack.extend(node.children.values())
+        stats.evicted_nodes = getattr(getattr(self, "stats", None), "evicted_nodes", 0)
+        self.stats = stats
+        self.rebuild_digests()
+        self.rebuild_checkpoints()
+
+    @property
+    def node_count(self) -> int:
+        return self.stats.node_count
+
+    @property
+    def token_count(self) -> int:
+        return self.stats.token_count
+
+    def tree_stats(self) -> Dict[str, Any]:
+        """O(1) 读取增量维护的统计信息，不遍历树"""
+        result = self.stats.snapshot()
+        result["max_nodes"] = self.max_nodes
+        result["max_tokens"] = self.max_tokens
+        result["global_version"] = self.global_version
+        result["expired_presences"] = self.expired_presences
+        result["tombstoned_instances"] = len(self.tombstoned)
+        result["collected_presences"] = self.collected_presences
+        if self.session_cursors is not None:
+            result["session_cursors"] = self.session_cursors.metrics()
+        if self.checkpoint_index is not None:
+            result["checkpoints"] = len(self.checkpoint_index)
+        if self.max_index_depth > 0:
+            result["max_index_depth"] = self.max_index_depth
+            result["truncated_tokens"] = self.truncated_tokens
+        return result
+
+    # ------------------------------
+    # 实例记录过期（TTL）
+    # ------------------------------
+    def _sweep_loop(self):
+        while not self._sweep_stop.wait(self.sweep_interval):
+            try:
+                with self._background_lock:
+                    self.expire_presences()
+            except Exception as e:
+                logger.warning(f"[Tree] presence ttl sweep failed: {e}")
+
+    def stop_sweeper(self):
+        self._sweep_stop.set()
+        if self._sweep_thread:
+            self._sweep_thread.join()
+            self._sweep_thread = None
+
+    def expire_presences(self, now: float = None) -> int:
+        """
+        删除超过 presence_ttl 未被确认的实例记录，没有实例持有的叶子随之删除。
+        同一次插入会刷新整条路径的确认时间，所以祖先不会比子孙先过期，记录仍然是前缀闭合的。
+        注意：过期不写 WAL，和 LRU 淘汰一样，恢复回放后由后续清理再次过期。
+        :return: 本次过期的 (节点, 实例) 记录数
+        """
+        if self.presence_ttl <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        deadline = now - self.presence_ttl
+        order = []
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node.children.values())
+
+        expired = 0
+        for node in reversed(order):  # 先子后父，叶子清空后可以直接删除
+            stale = [instance_id for instance_id, ts in list(node.confirmed.items()) if ts < deadline]
+            if not stale:
+                continue
+            with node.lock:
+                for instance_id in stale:
+                    if node.confirmed.get(instance_id, now) < deadline:
+                        self._drop_presence(node, instance_id)
+                        expired += 1
+            self._remove_if_empty_leaf(node)
+        self.expired_presences += expired
+        if expired:
+            logger.info(f"[Tree] expired {expired} stale presences, node_count:{self.node_count}")
+        return expired
+
+    def over_budget(self) -> bool:
+        return (0 < self.max_nodes < self.node_count) or (0 < self.max_tokens < self.token_count)
+
+    def _evict_loop(self):
+        while not self._evict_stop.wait(self.evict_interval):
+            if self.over_budget():
+                try:
+                    with self._background_lock:
+                        self.evict_lru()
+                except Exception as e:
+                    logger.warning(f"[Tree] lru evict failed: {e}")
+
+    def stop_evict(self):
+        self._evict_stop.set()
+        if self._evict_thread:
+            self._evict_thread.join()
+            self._evict_thread = None
+
+    def evict_lru(self) -> int:
+        """
+        淘汰最久未访问的叶子节点，直到节点数/token数回落到 预算*evict_low_watermark 以下。
+        叶子被删除后如果父节点变成叶子，父节点会重新参与排序。
+        注意：预算淘汰不写 WAL，恢复回放后若仍超预算会被再次淘汰。
+        :return: 本次淘汰的节点数
+        """
+        node_target = int(self.max_nodes * self.evict_low_watermark) if self.max_nodes > 0 else None
+        token_target = int(self.max_tokens * self.evict_low_watermark) if self.max_tokens > 0 else None
+
+        def satisfied():
+            if node_target is not None and self.node_count > node_target:
+                return False
+            if token_target is not None and self.token_count > token_target:
+                return False
+            return True
+
+        leaves = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self.root:
+                leaves.append((node.last_access, node.id, node))
+        heapq.heapify(leaves)
+
+        evicted = 0
+        while leaves and not satisfied():
+            _, _, leaf = heapq.heappop(leaves)
+            parent = leaf.parent
+            if parent is None:
+                continue
+            with parent.lock, leaf.lock:
+                # 加锁后再确认：期间可能有新的插入挂到这个叶子下面
+                if leaf.children or leaf.parent is not parent or not leaf.key:
+                    continue
+                if parent.children.get(leaf.key[0]) is not leaf:
+                    continue
+                del parent.children[leaf.key[0]]
+                leaf.parent = None
+                parent_became_leaf = not parent.children
+                self._changed(leaf)
+                presence = {instance_id: len(leaf.key) for instance_id in leaf.value.keys()}
+            if self.checkpoint_index is not None:
+                self.checkpoint_index.remove(leaf)
+            self.stats.node_removed(leaf.depth, len(leaf.key), parent_became_leaf, presence)
+            for instance_id in presence:
+                self._presence_changed(instance_id)
+                self._digest_lost(leaf, instance_id, parent)
+            evicted += 1
+            if parent is not self.root and not parent.children:
+                heapq.heappush(leaves, (parent.last_access, parent.id, parent))
+
+        with self.stats.lock:
+            self.stats.evicted_nodes += evicted
+        if evicted:
+            logger.info(f"[Tree] lru evicted {evicted} nodes, node_count:{self.node_count} token_count:{self.token_count}")
+        return evicted
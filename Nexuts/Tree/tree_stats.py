@@ -0,0 +1,88 @@
+import threading
+from collections import defaultdict
+from typing import Any, Dict
+
+
+class TreeStats:
+    """
+    前缀树统计信息，全部在变更时增量维护，查询不遍历树。
+    depth 指节点末尾在 prompt 中的 token 偏移（split 不会改变已有节点的 depth），按 2 的幂分桶。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.node_count = 0
+        self.token_count = 0  # 所有节点 key 长度之和
+        self.internal_count = 0  # 至少有一个子节点的节点数，用于计算平均扇出
+        self.evicted_nodes = 0  # 累计被预算淘汰的节点数
+        self.instance_tokens: Dict[str, int] = defaultdict(int)  # instance_id -> 该实例覆盖的 token 数
+        self.depth_histogram: Dict[int, int] = defaultdict(int)  # 分桶上界 -> 节点数
+
+    @staticmethod
+    def depth_bucket(depth: int) -> int:
+        bucket = 1
+        while bucket < depth:
+            bucket <<= 1
+        return bucket
+
+    # ------------------------------
+    # 节点
+    # ------------------------------
+    def node_added(self, depth: int, tokens: int, parent_became_internal: bool):
+        with self.lock:
+            self.node_count += 1
+            self.token_count += tokens
+            self.depth_histogram[self.depth_bucket(depth)] += 1
+            if parent_became_internal:
+                self.internal_count += 1
+
+    def node_split(self, depth: int):
+        """split 出的前半节点：新增一个内部节点，token 总数不变"""
+        with self.lock:
+            self.node_count += 1
+            self.internal_count += 1
+            self.depth_histogram[self.depth_bucket(depth)] += 1
+
+    def node_removed(self, depth: int, tokens: int, parent_became_leaf: bool, presence: Dict[str, int] = None):
+        with self.lock:
+            self.node_count -= 1
+            self.token_count -= tokens
+            bucket = self.depth_bucket(depth)
+            self.depth_histogram[bucket] -= 1
+            if self.depth_histogram[bucket] <= 0:
+                del self.depth_histogram[bucket]
+            if parent_became_leaf:
+                self.internal_count -= 1
+            for instance_id, n in (presence or {}).items():
+                self._sub_instance(instance_id, n)
+
+    # ------------------------------
+    # 实例覆盖
+    # ------------------------------
+    def presence_added(self, instance_id: str, tokens: int):
+        with self.lock:
+            self.instance_tokens[instance_id] += tokens
+
+    def presence_removed(self, instance_id: str, tokens: int):
+        with self.lock:
+            self._sub_instance(instance_id, tokens)
+
+    def _sub_instance(self, instance_id: str, tokens: int):
+        self.instance_tokens[instance_id] -= tokens
+        if self.instance_tokens[instance_id] <= 0:
+            del self.instance_tokens[instance_id]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "node_count": self.node_count,
+                "token_count": self.token_count,
+                "internal_count": self.internal_count,
+                "avg_fanout": round((self.node_count - 1) / self.internal_count, 3) if self.internal_count else 0.0,
+                "evicted_nodes": self.evicted_nodes,
+                "instance_tokens": dict(self.instance_tokens),
+                "depth_histogram": {str(k): v for k, v in sorted(self.depth_histogram.items())},
+            }
@@ -6,9 +6,10 @@ from curl_cffi import requests
 from utils.logger import logger
 from typing import List 
 
-# from Tree.tree import MergePrefixTree
-from Tree.Persist import MergePrefixTree
+from Tree.tree import MergePrefixTree
+from Tree.generational_index import GenerationalPrefixIndex
 from Sentry_manager.Sentry import Sentry
+from Sentry_manager.anti_entropy import AntiEntropy
 from persistence.snap_manager import SnapshotManager
 from persistence.walmanager import WalManager
 from persistence.sqlite_storage import SQLiteStorage
@@ -48,18 +49,86 @@ class InformationCenter:
         wal_manager_path = nexuts_config.get('WalManager_dir', "/data/nexuts/wal_dir")
         snapshot_dir = nexuts_config.get("snapshot_dir", "/data/snapshots") # "/data/snapshots"
         snapshot_interval_seconds = nexuts_config.get("snapshot_interval_seconds", 600) # 10分钟一次
+        # bfs：在线遍历（写入方缓存 old_info）；fork：短暂暂停写入后 fork，子进程写快照
         resume = nexuts_config.get('resume', True) # 是否是异常恢复的
-
-
-        self.wal_manager = WalManager(walmanager_path=wal_manager_path)
-        self.tree = MergePrefixTree(wal_manager=self.wal_manager)
-
+        # 前缀树内存预算，超出后按LRU淘汰叶子节点。max_nodes/max_tokens 默认 0 关闭，需显式开启（如 "max_nodes": 2000000）：
+        # 预算淘汰会静默丢掉仍在用的路由记录，且不写 WAL，重启回放后的树在再次淘汰前和线上不一致
+        tree_budget = nexuts_config.get("tree_budget", {})
+        anti_entropy = nexuts_config.get("anti_entropy", {}) # 和 Sentry 的 RadixTree 定期做摘要比对
+        presence_ttl = nexuts_config.get("presence_ttl", {}) # 实例缓存记录的置信度衰减和过期，默认 0 关闭，需显式开启
+        # 置信度加权后的匹配长度低于这个值的实例不参与缓存感知路由
+        self.min_match_length = nexuts_config.get("cache_aware_routing", {}).get("min_match_length", 0)
+        # 得分不低于最高分的这个比例的实例才参与负载均衡，1.0 表示只在命中最长前缀的实例之间选
+        self.match_score_ratio = nexuts_config.get("cache_aware_routing", {}).get("match_score_ratio", 1.0)
+        # 多轮会话匹配游标缓存的条数，0 表示不缓存
+        session_cache_size = nexuts_config.get("cache_aware_routing", {}).get("session_cache_size", 0)
+        # 长 prompt 每隔多少 token 建一个前缀检查点，0 表示不建
+        checkpoint_interval = nexuts_config.get("cache_aware_routing", {}).get("checkpoint_interval", 0)
+        # 分代索引：新写入进小的年轻代，后台合并成不可变的老代，快照只写新封存的代，过期按整代丢弃
+        generational = nexuts_config.get("generational_index", {})
+        if generational.get("enabled", False) and anti_entropy.get("enabled", False):
+            logger.warning("generational_index does not maintain content digests, anti_entropy disabled")
+            anti_entropy = dict(anti_entropy, enabled=False)
+
+
+        # WAL 落盘策略：batch 每批 fdatasync；interval 按时间/字节数合并 fdatasync；os 只写页缓存
+        # WAL 按 segment_size 分段，快照完成后整段删除被覆盖的旧段
+        wal_config = nexuts_config.get("wal", {})
+        self.wal_manager = WalManager(walmanager_path=wal_manager_path,
+                                      segment_size=wal_config.get("segment_size", 64 << 20),
+                                      preallocate=wal_config.get("preallocate", False),
+                                      durability=wal_config.get("durability", "batch"),
+                                      sync_interval_ms=wal_config.get("sync_interval_ms", 10),
+                                      sync_bytes=wal_config.get("sync_bytes", 4 << 20))
+        if generational.get("enabled", False):
+            self.tree = GenerationalPrefixIndex(
+                wal_manager=self.wal_manager,
+                young_max_nodes=generational.get("young_max_nodes", 50000),
+                max_generations=generational.get("max_generations", 8),
+                merge_ratio=generational.get("merge_ratio", 0.5),
+                max_age=generational.get("max_age_seconds", 0),
+                maintenance_interval=generational.get("maintenance_interval_seconds", 1.0),
+                ingest_lanes=nexuts_config.get("ingest_lanes", 16),
+                max_index_depth=tree_budget.get("max_index_depth", 0))
+        else:
+            self.tree = MergePrefixTree(
+                wal_manager=self.wal_manager,
+                max_nodes=tree_budget.get("max_nodes", 0),
+                max_tokens=tree_budget.get("max_tokens", 0),
+                evict_interval=tree_budget.get("evict_interval_seconds", 1.0),
+                evict_low_watermark=tree_budget.get("evict_low_watermark", 0.9),
+                ingest_lanes=nexuts_config.get("ingest_lanes", 16),
+                content_digest=anti_entropy.get("enabled", False),
+                confidence_half_life=presence_ttl.get("confidence_half_life_seconds", 0),
+                presence_ttl=presence_ttl.get("ttl_seconds", 0),
+                sweep_interval=presence_ttl.get("sweep_interval_seconds", 60),
+                session_cache_size=session_cache_size,
+                checkpoint_interval=checkpoint_interval,
+                max_index_depth=tree_budget.get("max_index_depth", 0))
+
+        delta_config = nexuts_config.get("snapshot_delta", {})
+        schedule_config = nexuts_config.get("snapshot_schedule", {})
         self.snapshot_manager = SnapshotManager(
             tree=self.tree,
             wal_manager=self.wal_manager,
             snapshot_dir=snapshot_dir,
             interval_seconds=snapshot_interval_seconds,
-            resume=resume) # 这个启动后会读取快照并恢复
+            resume=resume,
+            replay_chunk_records=wal_config.get("replay_chunk_records", 4096),
+            replay_inflight_chunks=wal_config.get("replay_inflight_chunks", 4),
+            mode=nexuts_config.get("snapshot_mode", "bfs"),  # fork 需要显式开启，snapshot_workers 只在 fork 下生效
+            delta_snapshots=delta_config.get("enabled", False),
+            full_snapshot_every=delta_config.get("full_every", 20),
+            merge_deltas_after=delta_config.get("merge_after", 4),
+            max_delta_ratio=delta_config.get("max_change_ratio", 0.3),
+            codec=nexuts_config.get("snapshot_codec", "lz4"),
+            block_nodes=nexuts_config.get("snapshot_block_nodes", 16384),
+            workers=nexuts_config.get("snapshot_workers", 1),
+            rto_seconds=schedule_config.get("rto_seconds", 0),
+            min_interval_seconds=schedule_config.get("min_interval_seconds", 10),
+            max_duty=schedule_config.get("max_duty", 0.25),
+            check_seconds=schedule_config.get("check_seconds", 1),
+            replay_bytes_per_second=schedule_config.get("replay_bytes_per_second", 32 << 20)) # 这个启动后会读取快照并恢复
 
 
         # SQLiteStorage
@@ -70,6 +139,14 @@ class InformationCenter:
             self._recover_from_db() # 恢复注册的Sentry
         else:
             self.db.clear_all() # 清除
+
+        self.anti_entropy = None
+        if anti_entropy.get("enabled", False):
+            self.anti_entropy = AntiEntropy(
+                tree=self.tree,
+                list_sentries=self._online_prefill_instances,
+                interval_seconds=anti_entropy.get("interval_seconds", 60),
+                timeout_seconds=anti_entropy.get("timeout_seconds", 3))
         # TODO 恢复树从 wal和snapshot里面
  
     def is_system_balanced(self, threshold: float = 0.3) -> bool:  
@@ -95,15 +172,16 @@ class InformationCenter:
         # 如果最大负载和最小负载差异小于阈值，认为均衡  
         return (max_load - min_load) < threshold
     
-    def find_worker_by_cache(self, prompt_tokens: List[int]) -> Optional[str]:  
-        """基于前缀匹配查找包含缓存的worker"""  
-        # 在 MergePrefixTree 中查找匹配的实例  
-        matched_instances = self.tree.search_instances_with_prefix(prompt_tokens)  
+    def find_worker_by_cache(self, prompt_tokens: List[int], session_id: Optional[str] = None) -> Optional[str]:  
+        """基于前缀匹配查找包含缓存的worker，带 session_id 时多轮对话从上一轮的匹配位置继续"""  
+        # 在 MergePrefixTree 中查找匹配的实例，匹配长度按记录的置信度衰减，久未确认的缓存记录不再胜出
+        match_scores = self.tree.match_instances_with_prefix(prompt_tokens, session_id=session_id)
+        matched_instances = self._best_matched_instances(match_scores)
         
         if not matched_instances:  
             return None  
         
-        # 从匹配的实例中选择负载最低的  
+        # 从命中前缀最长的实例中选择负载最低的  
         available_matched = []  
         for instance_id in matched_instances:
              # 确保是prefill实例  
@@ -129,6 +207,17 @@ class InformationCenter:
         
         return None
 
+    def _best_matched_instances(self, match_scores: Dict[str, Dict[str, float]]) -> List[str]:
+        """
+        只保留得分是最高分（或不低于最高分的 match_score_ratio）且不低于 min_match_length 的实例，
+        否则只命中几个 token 的实例会和命中整段前缀的实例同等参与负载均衡，缓存的前缀被浪费
+        """
+        scores = {instance_id: match["score"] for instance_id, match in match_scores.items() if match["score"] > 0}
+        if not scores:
+            return []
+        threshold = max(max(scores.values()) * self.match_score_ratio, self.min_match_length)
+        return [instance_id for instance_id, score in scores.items() if score >= threshold]
+
     async def get_instance_metrics(self, instance_id: str) -> Optional[Dict[str, float]]:
         """
         获取指定实例的实时metrics信息。
@@ -187,8 +276,10 @@ class InformationCenter:
             self.sentry_instance[sentry_id].stop()  # 先停止这个函数
             for key in self.sentry_instance[sentry_id].prefill_list.keys():
                 with self.lock_instances:
-                    # 设置为不可调度  # TODO self.tree 需要什么变化吗？直接清除的话，不太合适，做线程计时器吧，如果比如10分钟无法连上就删除
+                    # 设置为不可调度
                     self.instances_status[key] = False
+                # 树上的记录只作废（代数 +1，O(1)），由后台惰性回收；重连后 Sentry 会整体 resync
+                self.tree.tombstone_instance(key)
 
             for key in self.sentry_instance[sentry_id].decode_list.keys():
                 with self.lock_instances:
@@ -208,6 +299,48 @@ class InformationCenter:
                 self.tree.update_prefix_tree(sentry_info)
                 return {"result": "ok"}
 
+    def resync_instance(self, data: Dict[str, Any]):
+        """
+        实例重连后的全量同步：用完整镜像整体替换该实例在前缀树上的记录
+        data: {"sentry_id", "instance_id", "tree": /v1/radixtree/full 形状的树} 或 {"sentry_id", "instance_id", "paths": [[prompt, prompt_value], ...]}
+        """
+        sentry_id, instance_id = data.get("sentry_id"), data.get("instance_id")
+        with self.lock_sentry_instance:
+            sentry = self.sentry_instance.get(sentry_id)
+            if sentry is None or instance_id not in sentry.prefill_list:
+                logger.info(f"[Resync] sentry={sentry_id}, instance={instance_id} not registered")
+                return {"result": "failed", "message": "instance not registered"}
+        paths = data.get("paths")
+        if paths is None:
+            paths = self.tree.image_paths(data.get("tree") or {})
+        self.tree.resync_instance(instance_id, paths)
+        logger.info(f"[Resync] sentry={sentry_id}, instance={instance_id}, paths={len(paths)} enqueued")
+        return {"result": "ok", "paths": len(paths)}
+
+    def get_tree_stats(self):
+        """前缀树规模统计（增量维护，不遍历树）"""
+        return self.tree.tree_stats()
+
+    def get_ingest_metrics(self):
+        """前缀树写入 lane 的队列深度"""
+        return self.tree.ingest_metrics()
+
+    def get_wal_metrics(self):
+        """WAL 落盘策略、实际批大小、提交延迟，启动时回放的进度和速度，以及快照调度状态"""
+        return dict(self.wal_manager.get_metrics(), replay=self.snapshot_manager.replay_progress,
+                    snapshot_schedule=self.snapshot_manager.schedule_status())
+
+    def _online_prefill_instances(self):
+        with self.lock_sentry_instance:
+            return [(sentry, [iid for iid in sentry.prefill_list.keys() if self.instances_status.get(iid, False)])
+                    for sentry in self.sentry_instance.values() if sentry.running]
+
+    def get_anti_entropy_metrics(self):
+        """反熵比对的请求数、流量、修复数"""
+        if self.anti_entropy is None:
+            return {"enabled": False}
+        return dict(self.anti_entropy.metrics, enabled=True)
+
     def register_instance(self, data: Dict[str, Any]):
         """
         data: RegisterRequest.dict()
@@ -295,9 +428,10 @@ class InformationCenter:
 
         self.sentry_instance[sentry_id].prefill_list.pop(instance_id, None)  # 实例信息删除
         self.sentry_instance[sentry_id].decode_list.pop(instance_id, None)  # 实例信息删除
-        del self.instances_status[instance_id]  # 状态删除
+        self.instances_status.pop(instance_id, None)  # 状态删除
 
-        # TODO delete instance tree，同时删除的操作要记录到wal中
+        # 作废该实例在树上的记录，作废操作写入 WAL，恢复时同样生效
+        self.tree.tombstone_instance(instance_id)
         return {"result": "ok"}
 
 
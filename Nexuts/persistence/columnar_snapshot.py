@@ -0,0 +1,455 @@
+import gc
+import json
+import mmap
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # lz4 不可用时退回 zlib
+    lz4_frame = None
+
+from Tree.tree import TreeNode
+from Tree.token_key import TokenKey
+from utils.logger import logger
+
+# 列式快照文件布局（小端）：
+#   _MAGIC | 块 ... | 尾部元数据 JSON | 尾部元数据长度(u32) | _MAGIC
+# 每块是最多 block_nodes 个节点的各列（按 8 字节对齐拼接）整体压缩后的字节，边遍历边写出，写快照的内存只有当前这一块。
+# 尾部元数据：lsn、节点数、实例名表、压缩算法、每块的 [文件偏移, 存储长度, 原始长度, 节点数, {列名: [块内偏移, typecode, 元素个数]}]
+# 全量快照：节点按 BFS 顺序编号（跨块全局编号），父节点编号总是小于子节点，一遍顺序扫描就能挂回父节点
+# 增量快照（kind=delta）：同样的列，只有上次快照以来变过的节点，parent 列存父节点 id；被删除节点的 id 单独一块，
+# 元数据里记录基准快照、序号区间和期间代数变化过的实例
+# 旧版（_MAGIC_V1）是文件头元数据 + 一整块不压缩的列，仍然可以读
+_MAGIC = b"NXCOLS2\n"
+_MAGIC_V1 = b"NXCOLS1\n"
+_META_LEN = struct.Struct("<I")
+_ALIGN = 8
+DEFAULT_BLOCK_NODES = 16384
+
+# 压缩算法：name -> (compress, decompress)；none 的块在读取时直接是 mmap 上的视图
+_CODECS = {
+    "none": (None, None),
+    "zlib": (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if lz4_frame is not None:
+    _CODECS["lz4"] = (lz4_frame.compress, lz4_frame.decompress)
+
+
+def resolve_codec(name: str) -> str:
+    if name in _CODECS:
+        return name
+    logger.warning(f"snapshot codec {name} is not available, falling back to zlib")
+    return "zlib"
+
+_I32 = "i" if array("i").itemsize == 4 else "l"
+_U32 = "I" if array("I").itemsize == 4 else "L"
+_I64 = "q"
+
+# 一条节点记录：(父节点编号, id, version, key, {instance_id: value}, decode_string)，根节点的父节点编号为 -1；
+# 增量快照里第一项是父节点 id
+NodeRecord = Tuple[int, int, int, Optional[TokenKey], Optional[Dict[str, Any]], Optional[List[str]]]
+
+
+def _align(n: int) -> int:
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class _Columns:
+    """写快照时按列累积节点记录"""
+
+    def __init__(self, parent_typecode: str = _I32, instances: Dict[str, int] = None):
+        self.parent = array(parent_typecode)
+        self.node_id = array(_I64)
+        self.version = array(_I64)
+        self.key_offset = array(_I64, [0])  # CSR：第 i 个节点的 key 是 tokens[key_offset[i]:key_offset[i + 1]]
+        self.tokens = array(_U32)
+        self.pres_offset = array(_I64, [0])  # CSR：第 i 个节点的实例记录是 pres_*[pres_offset[i]:pres_offset[i + 1]]
+        self.pres_instance = array(_I32)  # 实例名表里的编号
+        self.value_offset = array(_I64, [0])  # CSR：第 p 条实例记录的 value 是 values[value_offset[p]:value_offset[p + 1]]
+        self.values = array(_I64)
+        self.instances: Dict[str, int] = {} if instances is None else instances  # 实例名表跨块共享
+        self.extra_values: Dict[int, Any] = {}  # 不是整数列表的 value，按块内实例记录编号 pickle
+        self.decode_strings: Dict[int, List[str]] = {}  # 块内节点编号 -> decode_string
+
+    def add(self, parent_index: int, node_id: int, version: int, key, value, decode_string):
+        index = len(self.parent)
+        self.parent.append(parent_index)
+        self.node_id.append(node_id)
+        self.version.append(version)
+        if key:
+            if isinstance(key, TokenKey):
+                self.tokens.frombytes(key.tobytes())
+            else:
+                self.tokens.extend(key)
+        self.key_offset.append(len(self.tokens))
+        if value:
+            for instance_id, instance_value in value.items():
+                if instance_value is None:
+                    continue
+                presence = len(self.pres_instance)
+                slot = self.instances.get(instance_id)
+                if slot is None:
+                    slot = self.instances[instance_id] = len(self.instances)
+                self.pres_instance.append(slot)
+                if type(instance_value) is list:
+                    try:
+                        self.values.extend(instance_value)
+                    except (TypeError, OverflowError):  # 不是 int64 能装下的整数列表
+                        del self.values[self.value_offset[-1]:]
+                        self.extra_values[presence] = instance_value
+                else:
+                    self.extra_values[presence] = instance_value
+                self.value_offset.append(len(self.values))
+        self.pres_offset.append(len(self.pres_instance))
+        if decode_string:
+            self.decode_strings[index] = decode_string
+
+    @staticmethod
+    def _narrow(values: array) -> array:
+        """value 通常是 uint32 能装下的 KV cache 索引，能收窄就按 4 字节写"""
+        try:
+            return array(_U32, values)
+        except OverflowError:
+            return values
+
+    def sections(self) -> Dict[str, array]:
+        extras = pickle.dumps({"values": self.extra_values, "decode_strings": self.decode_strings},
+                              protocol=pickle.HIGHEST_PROTOCOL)
+        return {
+            "parent": self.parent,
+            "node_id": self.node_id,
+            "version": self.version,
+            "key_offset": self.key_offset,
+            "tokens": self.tokens,
+            "pres_offset": self.pres_offset,
+            "pres_instance": self.pres_instance,
+            "value_offset": self.value_offset,
+            "values": self._narrow(self.values),
+            "extras": array("B", extras),
+        }
+
+
+class SnapshotWriter:
+    """边遍历边写：攒满 block_nodes 个节点就把这一块的列压缩写出，close() 时写尾部元数据"""
+
+    def __init__(self, f, codec: str = "zlib", block_nodes: int = DEFAULT_BLOCK_NODES, parent_typecode: str = _I32):
+        self.f = f
+        self.codec = resolve_codec(codec)
+        self._compress = _CODECS[self.codec][0]
+        self.block_nodes = max(int(block_nodes), 1)
+        self._parent_typecode = parent_typecode
+        self.instances: Dict[str, int] = {}
+        self.blocks = []
+        self.node_count = 0
+        self._columns = _Columns(parent_typecode, self.instances)
+        f.write(_MAGIC)
+        self._offset = len(_MAGIC)
+
+    def add(self, parent: int, node_id: int, version: int, key, value, decode_string):
+        self._columns.add(parent, node_id, version, key, value, decode_string)
+        if len(self._columns.parent) >= self.block_nodes:
+            self._flush()
+
+    def add_column(self, name: str, column: array):
+        """单独一块的附加列（增量快照的删除列表）"""
+        self._flush()
+        self._write_block({name: column}, 0)
+
+    def _flush(self):
+        nodes = len(self._columns.parent)
+        if nodes:
+            self._write_block(self._columns.sections(), nodes)
+            self.node_count += nodes
+            self._columns = _Columns(self._parent_typecode, self.instances)
+
+    def _write_block(self, sections: Dict[str, array], nodes: int):
+        layout = {}
+        parts = []
+        offset = 0
+        for name, column in sections.items():
+            if sys.byteorder != "little" and column.itemsize > 1:
+                column.byteswap()
+            data = column.tobytes()
+            layout[name] = [offset, column.typecode, len(column)]
+            parts.append(data)
+            parts.append(b"\0" * (_align(len(data)) - len(data)))
+            offset = _align(offset + len(data))
+        raw = b"".join(parts)
+        stored = self._compress(raw) if self._compress is not None else raw
+        self.f.write(stored)
+        self.blocks.append([self._offset, len(stored), len(raw), nodes, layout])
+        self._offset += len(stored)
+
+    def close(self, meta: Dict[str, Any]) -> int:
+        """写出剩下的节点和尾部元数据，返回节点数"""
+        self._flush()
+        meta = dict(meta, node_count=self.node_count, instances=list(self.instances), codec=self.codec,
+                    blocks=self.blocks)
+        footer = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        self.f.write(footer + _META_LEN.pack(len(footer)) + _MAGIC)
+        return self.node_count
+
+
+def write_snapshot(f, records: Iterable[NodeRecord], lsn: int, codec: str = "zlib",
+                   block_nodes: int = DEFAULT_BLOCK_NODES) -> int:
+    """按 BFS 顺序的节点记录流式写出列式快照，返回节点数；调用方负责临时文件、fsync 和 rename"""
+    writer = SnapshotWriter(f, codec, block_nodes)
+    for record in records:
+        writer.add(*record)
+    return writer.close({"kind": "full", "lsn": lsn})
+
+
+def write_delta(f, delta: "Delta", codec: str = "zlib", block_nodes: int = DEFAULT_BLOCK_NODES) -> int:
+    """写出增量快照，返回记录的节点数（更新 + 删除）"""
+    writer = SnapshotWriter(f, codec, block_nodes, parent_typecode=_I64)
+    for record in delta.records.values():
+        writer.add(*record)
+    writer.add_column("deleted", array(_I64, sorted(delta.deleted)))
+    writer.close({"kind": "delta", "lsn": delta.lsn, "base": delta.base, "first_seq": delta.first_seq,
+                  "last_seq": delta.last_seq, "tombstoned": delta.tombstoned})
+    return len(delta.records) + len(delta.deleted)
+
+
+def is_columnar(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(_MAGIC)) in (_MAGIC, _MAGIC_V1)
+
+
+def load_snapshot(path: str) -> Tuple[Optional[TreeNode], int]:
+    """
+    mmap 文件，数值列直接 cast 成 memoryview（不复制）；token 列整段读成一个 bytes，所有节点的 key 都是它上面的视图。
+    一遍顺序扫描建节点并挂到父节点下。返回 (root, lsn)
+    """
+    return _read(path, _build)
+
+
+def read_delta(path: str) -> "Delta":
+    return _read(path, _parse_delta)
+
+
+def _read(path: str, parse):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    gc_enabled = gc.isenabled()
+    gc.disable()  # 建树只分配不释放，百万级节点时分代回收反复扫描整个堆比建树本身还慢
+    try:
+        return parse(_Sections(mm))
+    finally:
+        if gc_enabled:
+            gc.enable()
+        try:
+            mm.close()
+        except BufferError:  # 异常路径上 traceback 还引用着列视图，映射留给 GC 回收
+            pass
+
+
+class _Block:
+    """一块解压后的列（不压缩时是 mmap 上的零拷贝视图）"""
+
+    def __init__(self, data, layout: Dict[str, list]):
+        self.raw = {}
+        for name, (offset, typecode, count) in layout.items():
+            end = offset + count * array(typecode).itemsize
+            if end > len(data):
+                raise ValueError(f"columnar snapshot truncated in section {name}")
+            self.raw[name] = (data[offset:end], typecode)
+
+    def column(self, name: str):
+        data, typecode = self.raw[name]
+        if sys.byteorder != "little" and array(typecode).itemsize > 1:
+            values = array(typecode, data.tobytes())
+            values.byteswap()
+            return memoryview(values)
+        return data.cast(typecode)
+
+
+class _Sections:
+    """解析文件元数据，逐块解压取列"""
+
+    def __init__(self, mm):
+        view = memoryview(mm)
+        magic = bytes(mm[:len(_MAGIC)])
+        if magic == _MAGIC_V1:
+            (meta_len,) = _META_LEN.unpack_from(mm, len(_MAGIC))
+            meta_start = len(_MAGIC) + _META_LEN.size
+            self.meta = json.loads(mm[meta_start:meta_start + meta_len].decode("utf-8"))
+            base = _align(meta_start + meta_len)
+            self.meta["codec"] = "none"
+            self.meta["blocks"] = [[base, len(mm) - base, len(mm) - base, self.meta["node_count"], self.meta["sections"]]]
+        elif magic == _MAGIC:
+            tail = len(mm) - len(_MAGIC) - _META_LEN.size
+            if tail < len(_MAGIC) or mm[tail + _META_LEN.size:] != _MAGIC:
+                raise ValueError("columnar snapshot is incomplete")
+            (meta_len,) = _META_LEN.unpack_from(mm, tail)
+            self.meta = json.loads(mm[tail - meta_len:tail].decode("utf-8"))
+        else:
+            raise ValueError("not a columnar snapshot")
+        self._view = view
+        self._decompress = _CODECS[self.meta["codec"]][1] if self.meta["codec"] in _CODECS else None
+        if self.meta["codec"] != "none" and self._decompress is None:
+            raise ValueError(f"snapshot codec {self.meta['codec']} is not available")
+
+    def blocks(self):
+        for offset, stored, raw_length, nodes, layout in self.meta["blocks"]:
+            data = self._view[offset:offset + stored]
+            if self._decompress is not None:
+                data = memoryview(self._decompress(data))
+                if len(data) != raw_length:
+                    raise ValueError("columnar snapshot block is corrupt")
+            yield nodes, _Block(data, layout)
+
+    def column(self, name: str) -> List[int]:
+        """所有块里这一列的值拼起来（增量快照的删除列表）"""
+        values = []
+        for _, block in self.blocks():
+            if name in block.raw:
+                values.extend(block.column(name).tolist())
+        return values
+
+    def records(self):
+        """逐个产出节点记录，key 是所在块 token 列上的视图"""
+        instances = self.meta["instances"]
+        for node_count, block in self.blocks():
+            if not node_count:
+                continue
+            parent = block.column("parent")
+            node_id = block.column("node_id")
+            version = block.column("version")
+            key_offset = block.column("key_offset")
+            pres_offset = block.column("pres_offset")
+            pres_instance = block.column("pres_instance")
+            value_offset = block.column("value_offset")
+            values = block.column("values")
+            extras = pickle.loads(block.raw["extras"][0])
+            token_buf = bytes(block.column("tokens"))  # TokenKey 需要 bytes 做 memcmp，每块复制一次
+            token_raw = memoryview(token_buf)
+            tokens = token_raw.cast(_U32)
+            extra_values = extras["values"]
+            decode_strings = extras["decode_strings"]
+            for i in range(node_count):
+                start, end = key_offset[i], key_offset[i + 1]
+                key = TokenKey(token_buf, start, end - start, token_raw, tokens) if end > start else None
+                value = {}
+                for p in range(pres_offset[i], pres_offset[i + 1]):
+                    if p in extra_values:
+                        value[instances[pres_instance[p]]] = extra_values[p]
+                    else:
+                        value[instances[pres_instance[p]]] = values[value_offset[p]:value_offset[p + 1]].tolist()
+                yield parent[i], node_id[i], version[i], key, value, decode_strings.get(i)
+
+
+def _build(sections: _Sections) -> Tuple[Optional[TreeNode], int]:
+    meta = sections.meta
+    if meta.get("kind", "full") != "full":
+        raise ValueError("not a full snapshot")
+    nodes = []
+    max_id = 0
+    for parent_index, node_id, version, key, value, decode_string in sections.records():
+        node = TreeNode(id=node_id)
+        node.version = version
+        node.key = key
+        node.decode_string = decode_string
+        if value:
+            node.value._dict.update(value)  # 节点还没发布，不用走锁
+        if parent_index >= 0:
+            parent_node = nodes[parent_index]
+            parent_node.children[key.first()] = node
+            node.parent = parent_node
+        nodes.append(node)
+        if node_id > max_id:
+            max_id = node_id
+    if not nodes:
+        return None, meta["lsn"]
+    TreeNode.counter = max(TreeNode.counter, max_id + 1)  # 之后新建的节点 id 不和快照里的重复
+    return nodes[0], meta["lsn"]
+
+
+# ------------------------------
+# 增量快照
+# ------------------------------
+class Delta:
+    """
+    基准快照之后第 first_seq..last_seq 次增量的合计：records 是 id -> 节点在增量时刻的状态（父节点用 id），
+    deleted 是期间被摘下的节点 id，tombstoned 是期间代数变化过的实例（它们在未变更节点上的旧记录要丢掉）
+    """
+
+    def __init__(self, base: str, first_seq: int, last_seq: int, lsn: int,
+                 records: Dict[int, NodeRecord] = None, deleted: set = None, tombstoned: List[str] = None):
+        self.base = base
+        self.first_seq = first_seq
+        self.last_seq = last_seq
+        self.lsn = lsn
+        self.records = records if records is not None else {}
+        self.deleted = deleted if deleted is not None else set()
+        self.tombstoned = tombstoned if tombstoned is not None else []
+
+    def merge(self, later: "Delta"):
+        """把紧接着的下一段增量并进来，结果等价于依次应用两段"""
+        if later.tombstoned:
+            for record in self.records.values():
+                for instance_id in later.tombstoned:
+                    record[4].pop(instance_id, None)
+            self.tombstoned.extend(i for i in later.tombstoned if i not in self.tombstoned)
+        self.records.update(later.records)
+        for node_id in later.deleted:
+            self.records.pop(node_id, None)
+            self.deleted.add(node_id)
+        self.last_seq = later.last_seq
+        self.lsn = later.lsn
+
+    def apply(self, root: TreeNode, nodes: Dict[int, TreeNode]):
+        """
+        应用到已加载的树上；nodes 是 id -> 节点的索引，会随之更新。
+        先丢掉作废实例的旧记录，再把要更新的节点全部从原父节点摘下、改好后按新的父节点挂回，最后摘掉删除的节点
+        """
+        if self.tombstoned:
+            for node in nodes.values():
+                for instance_id in self.tombstoned:
+                    node.value._dict.pop(instance_id, None)
+        for node_id, record in self.records.items():
+            node = nodes.get(node_id)
+            if node is None:
+                node = nodes[node_id] = TreeNode(id=node_id)
+            elif node is not root:
+                _detach(node)
+            _, _, node.version, key, value, node.decode_string = record
+            if node is not root:
+                node.key = key
+            node.value._dict = dict(value) if value else {}
+            node.generation = {}
+        for node_id, record in self.records.items():
+            if record[0] < 0:
+                continue
+            parent = nodes.get(record[0])
+            if parent is None:
+                raise ValueError(f"delta {self.first_seq}-{self.last_seq}: parent {record[0]} of node {node_id} not found")
+            node = nodes[node_id]
+            parent.children[node.key.first()] = node
+            node.parent = parent
+        for node_id in self.deleted:
+            node = nodes.pop(node_id, None)
+            if node is not None and node is not root:
+                _detach(node)
+        if self.records:
+            TreeNode.counter = max(TreeNode.counter, max(self.records) + 1)
+
+
+def _detach(node: TreeNode):
+    parent = node.parent
+    if parent is not None and node.key and parent.children.get(node.key.first()) is node:
+        del parent.children[node.key.first()]
+    node.parent = None
+
+
+def _parse_delta(sections: _Sections) -> Delta:
+    meta = sections.meta
+    if meta.get("kind") != "delta":
+        raise ValueError("not a delta snapshot")
+    records = {record[1]: record for record in sections.records()}
+    return Delta(meta["base"], meta["first_seq"], meta["last_seq"], meta["lsn"], records,
+                 set(sections.column("deleted")), list(meta.get("tombstoned", [])))
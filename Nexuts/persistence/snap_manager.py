@@ -1,13 +1,19 @@
+import gc
+import json
 import os
 import threading
 import pickle
 from datetime import datetime
 import time
 from collections import deque
+from concurrent.futures import wait
 from os import chown
 
 from Tree.tree import MergePrefixTree, TreeNode
+from Tree.generational_index import Generation, GenerationalPrefixIndex
 from Tree.safe_dict import ThreadSafeDict
+from Tree.token_key import TokenKey
+from persistence import columnar_snapshot
 from persistence.walmanager import WalManager
 from utils.logger import logger
 
@@ -19,12 +25,80 @@ class SnapshotManager:
                  wal_manager: WalManager,
                  snapshot_dir: str,
                  interval_seconds: int = 600,
-                 resume: bool = True):
+                 resume: bool = True,
+                 replay_chunk_records: int = 4096,
+                 replay_inflight_chunks: int = 4,
+                 mode: str = "bfs",
+                 delta_snapshots: bool = False,
+                 full_snapshot_every: int = 20,
+                 merge_deltas_after: int = 4,
+                 max_delta_ratio: float = 0.3,
+                 codec: str = "lz4",
+                 block_nodes: int = columnar_snapshot.DEFAULT_BLOCK_NODES,
+                 workers: int = 1,
+                 rto_seconds: float = 0,
+                 min_interval_seconds: float = 10,
+                 max_duty: float = 0.25,
+                 check_seconds: float = 1,
+                 replay_bytes_per_second: float = 32 << 20):
+        """
+        :param mode: bfs（默认）在线遍历，写快照期间和变更并发；fork 需要显式开启（snapshot_mode: "fork"），
+                     在静默点 fork 出子进程序列化写时复制的镜像，暂停只有 fork 本身，但子进程期间被改的页会复制，内存峰值更高
+        :param delta_snapshots: 两次全量快照之间只写上次快照以来变过的节点（增量快照），I/O 和暂停时长随变更量而不是树的大小增长
+        :param full_snapshot_every: 连续这么多次增量之后做一次全量快照，作为新的基准
+        :param merge_deltas_after: 基准之后的增量文件达到这么多个时，后台合并成一个，缩短恢复时的增量链
+        :param max_delta_ratio: 变更节点数超过树节点数的这个比例时直接做全量快照
+        :param codec: 快照块的压缩算法（lz4 / zlib / none），边遍历边按块压缩写出
+        :param block_nodes: 每块的节点数，写快照时额外的内存只有一块
+        :param workers: fork 模式下全量快照按根节点的子树分给这么多个子进程并行序列化，各写一个分段文件，清单把它们串起来
+        :param rto_seconds: 恢复时间目标：估计的 WAL 回放时间（未被快照覆盖的 WAL 字节 / 回放速度）达到它就做快照，
+                            interval_seconds 变成两次快照的最长间隔；0 表示按 interval_seconds 定时
+        :param min_interval_seconds: 两次快照的最短间隔，写入高峰时限制快照频率
+        :param max_duty: 快照耗时占墙钟时间的上限，上次快照耗时 / max_duty 之内不再做快照
+        :param check_seconds: rto_seconds 生效时检查一次是否该做快照的周期
+        :param replay_bytes_per_second: 启动时没有测到回放速度（WAL 太短）时用的估计值
+        """
         self.tree = tree
         self.wal_manager = wal_manager
 
         self.snapshot_dir = snapshot_dir
         self.interval_seconds = interval_seconds
+        self.snapshot_lsn = 0  # 加载的快照覆盖到的 WAL LSN，恢复时只回放之后的记录
+        self.replay_chunk_records = max(int(replay_chunk_records), 1)
+        self.replay_inflight_chunks = max(int(replay_inflight_chunks), 1)
+        self.replay_progress = {"state": "idle"}
+        # bfs：在线加锁遍历，写入期间缓存 old_info；fork：暂停写入后 fork，子进程序列化写时复制的树，父进程立即恢复
+        if mode == "fork" and not hasattr(os, "fork"):
+            logger.warning("os.fork is not available, falling back to bfs snapshots")
+            mode = "bfs"
+        self.mode = mode
+        self.last_snapshot = {}  # 最近一次快照：模式、写入暂停时长、总耗时
+        # 增量快照链：基准全量快照文件名 + 之后的增量序号；基准为 None 时下一次必须做全量
+        self.delta_snapshots = bool(delta_snapshots) and isinstance(tree, MergePrefixTree)
+        self.full_snapshot_every = max(int(full_snapshot_every), 1)
+        self.merge_deltas_after = max(int(merge_deltas_after), 2)
+        self.max_delta_ratio = float(max_delta_ratio)
+        self.codec = columnar_snapshot.resolve_codec(codec)
+        self.block_nodes = max(int(block_nodes), 1)
+        self.workers = max(int(workers), 1)
+        if self.workers > 1 and self.mode != "fork":  # 在线 BFS 受 GIL 限制，多线程没有收益
+            logger.warning("parallel snapshot serialization needs snapshot_mode fork, using one worker")
+            self.workers = 1
+        # 自适应调度：没有新的 WAL 就跳过；估计回放时间超过 rto_seconds 时提前做，受最短间隔和耗时占比限制
+        self.rto_seconds = float(rto_seconds)
+        self.min_interval_seconds = float(min_interval_seconds)
+        self.max_duty = min(max(float(max_duty), 0.01), 1.0)
+        self.check_seconds = max(float(check_seconds), 0.1)
+        self.replay_bytes_per_second = max(float(replay_bytes_per_second), 1.0)
+        self._wal_mark = 0  # 上次快照开始时 WAL 累计写入的字节数，之后写入的都要回放
+        self._wal_backlog = 0  # 启动时回放的、还没被新快照覆盖的 WAL 字节数
+        self._last_snapshot_end = time.monotonic()
+        self._last_snapshot_seconds = 0.0
+        self._base = None
+        self._delta_seq = 0
+        self._snapshot_generations = {}  # 上次快照时各实例的代数，增量里记下期间变过的实例
+        if self.delta_snapshots:
+            self.tree.track_changes()
         self._lock = threading.RLock()
         self._stop_event = threading.Event()
         self._thread = None
@@ -32,18 +106,60 @@ class SnapshotManager:
         self.start_auto_snapshot()
         if resume:  
             self.load_snapshot()  
-            wal_recover = self.wal_manager.load_resume_records() # 加载wal日志  
-            for ops_info in wal_recover:  
-                # 将WAL记录包装成update_prefix_tree期望的格式  
-                wrapped_ops_info = {  
-                    "updates": [ops_info]  # WAL记录包装在updates列表中  
-                }  
-                self.tree.update_prefix_tree(wrapped_ops_info, write_wal=False) # 不写wal了
-
-
-    def _snapshot_filename(self) -> str:
+            self.replay_wal()  # 回放快照之后的wal日志
+
+
+    def replay_wal(self):
+        """
+        流式回放快照之后的 WAL：按块读出记录，每块整体交给 update_prefix_tree，按实例拆到固定的 lane 并行应用，
+        同一实例的记录保持 WAL 顺序。最多 replay_inflight_chunks 块在执行，读盘和应用重叠，内存不随 WAL 长度增长。
+        """
+        progress = {
+            "state": "running",
+            "after_lsn": self.snapshot_lsn,
+            "total_bytes": sum(os.path.getsize(path) for path in self.wal_manager.replay_segments(self.snapshot_lsn)),
+            "bytes_read": 0,
+            "records_read": 0,
+            "records_applied": 0,
+            "elapsed_seconds": 0.0,
+            "ops_per_second": 0.0,
+        }
+        self.replay_progress = progress
+        start = last_log = time.monotonic()
+        inflight = deque()  # 每块的 futures
+
+        def finish_oldest():
+            futures, count = inflight.popleft()
+            wait(futures)
+            progress["records_applied"] += count
+
+        for chunk in self.wal_manager.iter_records(after_lsn=self.snapshot_lsn, chunk_records=self.replay_chunk_records,
+                                                   progress=progress):
+            inflight.append((self.tree.update_prefix_tree({"updates": chunk}, write_wal=False), len(chunk)))  # 不写wal了
+            while len(inflight) > self.replay_inflight_chunks:
+                finish_oldest()
+            now = time.monotonic()
+            progress["elapsed_seconds"] = round(now - start, 3)
+            progress["ops_per_second"] = round(progress["records_applied"] / max(now - start, 1e-6), 1)
+            if now - last_log >= 5:
+                last_log = now
+                logger.info(f"WAL replay: {progress['bytes_read']}/{progress['total_bytes']} bytes, "
+                            f"{progress['records_applied']} records, {progress['ops_per_second']} ops/s")
+        while inflight:
+            finish_oldest()
+        elapsed = time.monotonic() - start
+        progress["elapsed_seconds"] = round(elapsed, 3)
+        progress["ops_per_second"] = round(progress["records_applied"] / max(elapsed, 1e-6), 1)
+        progress["state"] = "done"
+        self._wal_backlog = progress["bytes_read"]
+        if progress["bytes_read"] >= 1 << 20:  # 太短的 WAL 测出来的速度不准，沿用配置的估计值
+            self.replay_bytes_per_second = progress["bytes_read"] / max(elapsed, 1e-6)
+        logger.info(f"WAL replay done: {progress['records_applied']} records after lsn {self.snapshot_lsn} "
+                    f"in {progress['elapsed_seconds']}s, {progress['ops_per_second']} ops/s")
+
+    def _snapshot_filename(self, suffix: str = ".cols") -> str:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        return f"snapshot_{timestamp}.pkl"
+        return f"snapshot_{timestamp}{suffix}"
 
     def _snapshot_path(self, filename: str) -> str:
         return os.path.join(self.snapshot_dir, filename)
@@ -62,56 +178,73 @@ class SnapshotManager:
 
     def _auto_snapshot_loop(self):
         while not self._stop_event.is_set():
-            self._stop_event.wait(self.interval_seconds)
-            self.take_snapshot()
+            self._stop_event.wait(self.check_seconds if self.rto_seconds > 0 else self.interval_seconds)
+            if self._snapshot_due():
+                self.take_snapshot()
+
+    def pending_wal_bytes(self) -> int:
+        """恢复时要回放的 WAL 字节数：上次快照之后写入的 + 启动时回放过、还没被快照覆盖的"""
+        return self._wal_backlog + self.wal_manager.metrics["written_bytes"] - self._wal_mark
+
+    def estimated_replay_seconds(self) -> float:
+        return self.pending_wal_bytes() / self.replay_bytes_per_second
+
+    def _snapshot_due(self) -> bool:
+        if self.pending_wal_bytes() <= 0:  # 上次快照之后没有任何变更
+            return False
+        if self.rto_seconds <= 0:
+            return True
+        since = time.monotonic() - self._last_snapshot_end
+        if since < max(self.min_interval_seconds, self._last_snapshot_seconds / self.max_duty):
+            return False
+        return since >= self.interval_seconds or self.estimated_replay_seconds() >= self.rto_seconds
+
+    def schedule_status(self) -> dict:
+        """快照调度状态，和 WAL 指标一起对外暴露"""
+        return {
+            "rto_seconds": self.rto_seconds,
+            "pending_wal_bytes": self.pending_wal_bytes(),
+            "replay_bytes_per_second": round(self.replay_bytes_per_second, 1),
+            "estimated_replay_seconds": round(self.estimated_replay_seconds(), 3),
+            "seconds_since_snapshot": round(time.monotonic() - self._last_snapshot_end, 3),
+            "last_snapshot_seconds": round(self._last_snapshot_seconds, 3),
+        }
 
     # ------------------------------
     # BFS方式收集快照
     # ------------------------------
     def _serialize_tree_bfs(self, root: TreeNode, snapshot_version: int):
+        """按 BFS 顺序产出列式快照的节点记录 (父节点编号, id, version, key, value, decode_string)"""
         if not root:
-            return list()
+            return
         queue = deque()
-        node_list = []
         parent_node = root.parent
-        queue.append((root, parent_node))
+        queue.append((root, parent_node, -1))
+        index = 0
 
         while queue:
-            node, parent_node = queue.popleft()
+            node, parent_node, parent_index = queue.popleft()
             if parent_node is not None:
                 parent_node.lock.acquire()
             node.lock.acquire()
-            # 保存旧信息
-            children_ids = [child.id for child in node.children.values()] # 这个地方记录的是 节点的id
             if node.version <= snapshot_version:  # 直接记录，小于快照版本
-                node_node = {
-                    "id": node.id,
-                    "key": node.key.copy() if node.key else None,
-                    "value": node.value.copy() if node.value else None,
-                    "decode_string": node.decode_string.copy() if node.decode_string else None,
-                    "children": children_ids,
-                    "version": node.version  # TODO 是不是不用recover的时候这个东西了？
-                }
-                node_list.append(node_node)
-            else:  # 如果版本大于
-                node_node = {
-                    "id": node.old_info.id,
-                    "key": node.old_info.key.copy() if node.old_info else None,
-                    "value": node.old_info.value.copy() if node.old_info else None,
-                    "decode_string": node.old_info.decode_string.copy() if node.old_info.decode_string else None,
-                    "children": children_ids,
-                    "version": node.old_info.version  #
-                }
-                node_list.append(node_node)
+                record = (parent_index, node.id, node.version, node.key,
+                          self.tree.live_value(node) if node.value else None,  # 旧代数的记录不进快照
+                          node.decode_string.copy() if node.decode_string else None)
+            else:  # 快照开始后被改过，用缓存的旧状态
+                old_info = node.old_info or {}
+                record = (parent_index, node.id, old_info.get("version", node.version), old_info.get("key", node.key),
+                          old_info.get("value"), old_info.get("decode_string"))
+            children = list(node.children.values())
 
             if parent_node is not None:
                 parent_node.lock.release()
             node.lock.release()
 
-            for child in node.children.values():
-                queue.append((child, node))
-
-        return node_list
+            yield record
+            for child in children:
+                queue.append((child, node, index))
+            index += 1
 
 
     # ------------------------------
@@ -119,44 +252,441 @@ class SnapshotManager:
     # ------------------------------
     def take_snapshot(self) -> str:
         with self._lock:
+            wal_mark = self.wal_manager.metrics["written_bytes"]  # 快照开始前写入的记录都会被覆盖
+            start = time.monotonic()
+            path = self._take_snapshot()
+            self._last_snapshot_end = time.monotonic()
+            self._last_snapshot_seconds = self._last_snapshot_end - start
+            if path is not None:
+                self._wal_mark = wal_mark
+                self._wal_backlog = 0
+            return path
+
+    def _take_snapshot(self) -> str:
+        if isinstance(self.tree, GenerationalPrefixIndex):
+            return self._take_generation_snapshot()
+        with self._lock:
+            if self._delta_due():
+                return self._take_delta_snapshot()
+            self._base = None  # 全量快照成功之前，增量链作废
+            if self.mode == "fork":
+                return self._take_fork_snapshot()
+            self._reset_changes()  # 在冻结版本之前取走：之后的变更要么在快照里，要么进下一次增量
             snapshot_trigger_version, freeze_finish_version = self.tree.freeze_trigger_version()  # 执行快照时的版本、finish（完成变更）版本
             assert (snapshot_trigger_version - freeze_finish_version) >= 0, "error version in {snapshot_trigger_version - freeze_finish_version}"
-            result_holder = {}  # 存放 snapshot_data
+            result_holder = {}  # 存放写好的节点数
             done_event = threading.Event()
+            filename = self._snapshot_filename()
+            temp_path = self._snapshot_path(filename + ".tmp")
+            final_path = self._snapshot_path(filename)
+            # 冻结时 LSN 不超过 snapshot_trigger_lsn 的记录版本都不超过 trigger，其中还没完成（可能不在快照里）的最多
+            # snapshot_trigger_version - freeze_finish_version 条，快照只算覆盖到它们之前，恢复时从这里往后回放
+            covered_lsn = max(0, self.tree.snapshot_trigger_lsn - (snapshot_trigger_version - freeze_finish_version))
+
             def bfs_job():
-                snapshot_data = self._serialize_tree_bfs(self.tree.root, snapshot_trigger_version) #
-                result_holder["data"] = snapshot_data
-                done_event.set()
+                try:
+                    with open(temp_path, "wb") as f:  # 边遍历边按块压缩写出
+                        result_holder["count"] = columnar_snapshot.write_snapshot(
+                            f, self._serialize_tree_bfs(self.tree.root, snapshot_trigger_version), covered_lsn,
+                            self.codec, self.block_nodes)
+                        f.flush()
+                        os.fsync(f.fileno())
+                except Exception as e:
+                    result_holder["error"] = e
+                finally:
+                    done_event.set()
 
             threading.Thread(target=bfs_job, daemon=True).start()
 
-            # 将log.logs的 snapshot_trigger_version - freeze_finish_version 行，重定向输入到 log2.logs 里面
-            logger.info("snapshot_trigger_version:{} freeze_finish_version:{}".format(snapshot_trigger_version, freeze_finish_version))
-            self.wal_manager.rotate(line_n=snapshot_trigger_version - freeze_finish_version)  # 更换记录文件，同时记录在执行快照期间发生的变更
+            logger.info("snapshot_trigger_version:{} freeze_finish_version:{} covered_lsn:{}".format(
+                snapshot_trigger_version, freeze_finish_version, covered_lsn))
+            self.wal_manager.roll()  # 切到新的 WAL 段，快照完成后整段删除被覆盖的旧段
 
-            filename = self._snapshot_filename()
+            done_event.wait()  # 阻塞直到后台 BFS 完成
+            # 生成快照后需要将   tree.active_snapshots 改成false
+            self.tree.active_snapshots = False
+            if "error" in result_holder:
+                logger.error(f"snapshot {final_path} failed: {result_holder['error']}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return None
+            os.replace(temp_path, final_path)
+            logger.info(f"snapshot {final_path}: {result_holder['count']} nodes, covered_lsn:{covered_lsn}")
+
+            self.wal_manager.truncate(covered_lsn)  # 删除记录全部被快照覆盖的 WAL 段
+            self._cleanup_old_snapshots(final_path)
+            self._start_chain(filename)
+            return final_path
+
+
+    # ------------------------------
+    # fork 快照：子进程里是 fork 时刻的写时复制镜像，不加锁遍历
+    # ------------------------------
+    def _serialize_tree_image(self, root: TreeNode, subtrees=None, root_value: bool = True):
+        """
+        只在 fork 出的子进程里调用：子进程只有这一个线程、树不会再变；锁可能在 fork 时被别的线程持有，一个都不能取。
+        subtrees 不为 None 时只序列化根节点和这些子树（分段快照），root_value 为 False 时根节点不带 value
+        """
+        generations = self.tree.generations
+        queue = deque([(root, -1)])
+        index = 0
+        while queue:
+            node, parent_index = queue.popleft()
+            values = node.value._dict if node.value is not None and (root_value or index) else None
+            yield (parent_index, node.id, node.version, node.key,
+                   {instance_id: value for instance_id, value in values.items()  # 旧代数的记录不进快照
+                    if value is not None and node.generation.get(instance_id, 0) == generations.get(instance_id, 0)}
+                   if values else None,
+                   node.decode_string)
+            for child in (subtrees if index == 0 and subtrees is not None else node.children.values()):
+                queue.append((child, index))
+            index += 1
+
+    def _section_filename(self, filename: str, worker: int) -> str:
+        return f"{os.path.splitext(filename)[0]}.{worker:03d}.sec"
+
+    def _write_sections(self, filename: str, covered_lsn: int):
+        """
+        只在 fork 出的子进程里调用：根节点的子树轮流分给 workers 份，再 fork 出 workers - 1 个孙进程（子进程单线程，
+        fork 安全），每份在各自进程里写一个分段文件（根节点 + 这份子树），全部成功后写清单
+        """
+        root = self.tree.root
+        parts = [list(root.children.values())[worker::self.workers] for worker in range(self.workers)]
+        sections = [self._section_filename(filename, worker) for worker in range(self.workers)]
+
+        def write_part(worker: int):
+            path = self._snapshot_path(sections[worker])
+            with open(path + ".tmp", "wb") as f:
+                columnar_snapshot.write_snapshot(f, self._serialize_tree_image(root, parts[worker], worker == 0),
+                                                 covered_lsn, self.codec, self.block_nodes)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+        pids = []
+        for worker in range(1, self.workers):
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    write_part(worker)
+                    code = 0
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        try:
+            write_part(0)
+        finally:
+            failed = [pid for pid in pids if os.waitpid(pid, 0)[1] != 0]
+        if failed:
+            for section in sections:
+                for path in (self._snapshot_path(section), self._snapshot_path(section) + ".tmp"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            raise RuntimeError(f"snapshot section workers {failed} failed")
+        temp_path = self._snapshot_path(filename + ".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"lsn": covered_lsn, "sections": sections}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._snapshot_path(filename))
+
+    def _load_sections(self, path: str):
+        """按清单加载各分段，把各段根节点下的子树挂到第一段的根节点上，返回 (root, lsn)"""
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        root = None
+        for section in manifest["sections"]:
+            section_root, _ = columnar_snapshot.load_snapshot(self._snapshot_path(section))
+            if root is None:
+                root = section_root
+            elif section_root is not None:
+                for token, child in section_root.children.items():
+                    root.children[token] = child
+                    child.parent = root
+        return root, manifest["lsn"]
+
+    def _take_fork_snapshot(self) -> str:
+        with self._lock:
+            filename = self._snapshot_filename(".parts" if self.workers > 1 else ".cols")
             temp_path = self._snapshot_path(filename + ".tmp")
             final_path = self._snapshot_path(filename)
+            start = time.monotonic()
+            with self.tree.quiesced():
+                snapshot_trigger_version, finish_version, trigger_lsn = self.tree.snapshot_point()
+                # 和 bfs 模式一样：还没完成的版本对应的记录可能不在镜像里，覆盖点往前让出这么多条
+                covered_lsn = max(0, trigger_lsn - (snapshot_trigger_version - finish_version))
+                self._reset_changes()
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        gc.disable()
+                        if self.workers > 1:
+                            self._write_sections(filename, covered_lsn)
+                        else:
+                            with open(temp_path, "wb") as f:
+                                columnar_snapshot.write_snapshot(f, self._serialize_tree_image(self.tree.root),
+                                                                 covered_lsn, self.codec, self.block_nodes)
+                                f.flush()
+                                os.fsync(f.fileno())
+                            os.replace(temp_path, final_path)
+                        code = 0
+                    finally:
+                        os._exit(code)  # 不跑父进程注册的退出清理，也不碰日志线程
+            paused = time.monotonic() - start
+
+            self.wal_manager.roll()  # 切到新的 WAL 段，子进程写完后整段删除被覆盖的旧段
+            _, status = os.waitpid(pid, 0)
+            elapsed = time.monotonic() - start
+            self.last_snapshot = {"mode": "fork", "workers": self.workers, "pause_ms": round(paused * 1000, 3),
+                                  "duration_ms": round(elapsed * 1000, 3), "covered_lsn": covered_lsn}
+            if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+                logger.error(f"fork snapshot child {pid} failed, status {status}")
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return None
+            logger.info(f"fork snapshot {final_path}: ingest paused {self.last_snapshot['pause_ms']}ms, "
+                        f"total {self.last_snapshot['duration_ms']}ms, covered_lsn:{covered_lsn}")
+
+            self.wal_manager.truncate(covered_lsn)  # 删除记录全部被快照覆盖的 WAL 段
+            self._cleanup_old_snapshots(final_path)
+            self._start_chain(filename)
+            return final_path
 
-            done_event.wait()  # 阻塞直到后台 BFS 完成
-            snapshot_data = result_holder["data"]
-
+    # ------------------------------
+    # 增量快照：quiesced() 里取走变更节点并抓取它们的状态，代价和变更量成正比
+    # ------------------------------
+    def _delta_due(self) -> bool:
+        if not self.delta_snapshots or self._base is None or self._delta_seq >= self.full_snapshot_every:
+            return False
+        return self.tree.pending_changes <= self.max_delta_ratio * max(self.tree.node_count, 1)
+
+    def _reset_changes(self):
+        if self.delta_snapshots:
+            self.tree.take_changes()
+            self._snapshot_generations = dict(self.tree.generations)
+
+    def _start_chain(self, filename: str):
+        if self.delta_snapshots:
+            self._base = filename
+            self._delta_seq = 0
+
+    def _delta_filename(self, first_seq: int, last_seq: int) -> str:
+        return f"{os.path.splitext(self._base)[0]}.{first_seq:06d}-{last_seq:06d}.delta"
+
+    def _delta_files(self, base: str):
+        """基准快照的增量文件，按 (last_seq, first_seq) 排序：[(first_seq, last_seq, 文件名)]"""
+        prefix = os.path.splitext(base)[0] + "."
+        files = []
+        for fname in os.listdir(self.snapshot_dir):
+            if fname.startswith(prefix) and fname.endswith(".delta"):
+                try:
+                    first_seq, last_seq = (int(x) for x in fname[len(prefix):-len(".delta")].split("-"))
+                except ValueError:
+                    continue
+                files.append((first_seq, last_seq, fname))
+        files.sort(key=lambda item: (item[1], item[0]))
+        return files
+
+    @staticmethod
+    def _delta_chain(files):
+        """要依次应用的增量：跳过已被合并文件覆盖的（合并中途退出留下的原文件），序号接不上时停下"""
+        applied = 0
+        for first_seq, last_seq, fname in files:
+            if last_seq <= applied:
+                continue
+            if first_seq > applied + 1:
+                logger.error(f"delta snapshot chain broken before {fname}, applied up to seq {applied}")
+                return
+            yield fname
+            applied = last_seq
+
+    def _capture_delta(self, delta, changes: set, generations: dict):
+        """读出变更节点的状态，调用方保证期间没有写入（quiesced() 里或 fork 出的子进程里），不取节点锁"""
+        root = self.tree.root
+        for node in changes:
+            if node.parent is None and node is not root:  # 已经从树上摘下
+                delta.deleted.add(node.id)
+                continue
+            values = node.value._dict
+            delta.records[node.id] = (node.parent.id if node.parent is not None else -1, node.id, node.version, node.key,
+                                      {instance_id: value for instance_id, value in values.items()  # 旧代数的记录不进快照
+                                       if value is not None and
+                                       node.generation.get(instance_id, 0) == generations.get(instance_id, 0)},
+                                      node.decode_string)
+
+    def _write_delta(self, path: str, delta):
+        with open(path, "wb") as f:
+            columnar_snapshot.write_delta(f, delta, self.codec, self.block_nodes)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _take_delta_snapshot(self) -> str:
+        tree = self.tree
+        seq = self._delta_seq + 1
+        filename = self._delta_filename(seq, seq)
+        temp_path = self._snapshot_path(filename + ".tmp")
+        final_path = self._snapshot_path(filename)
+        start = time.monotonic()
+        pid = None
+        with tree.quiesced():
+            version, finish, trigger_lsn = tree.snapshot_point()
+            covered_lsn = max(0, trigger_lsn - (version - finish))
+            changes = tree.take_changes()
+            generations = dict(tree.generations)
+            delta = columnar_snapshot.Delta(self._base, seq, seq, covered_lsn, tombstoned=[
+                instance_id for instance_id, generation in generations.items()
+                if self._snapshot_generations.get(instance_id, 0) != generation])
+            if self.mode == "fork":  # 和全量一样在子进程里读写时复制的镜像，暂停只有 fork 本身
+                pid = os.fork()
+                if pid == 0:
+                    code = 1
+                    try:
+                        gc.disable()
+                        self._capture_delta(delta, changes, generations)
+                        self._write_delta(temp_path, delta)
+                        code = 0
+                    finally:
+                        os._exit(code)
+            else:
+                self._capture_delta(delta, changes, generations)
+        paused = time.monotonic() - start
+
+        self.wal_manager.roll()
+        try:
+            if pid is not None:
+                _, status = os.waitpid(pid, 0)
+                if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+                    raise RuntimeError(f"child {pid} failed, status {status}")
+            else:
+                self._write_delta(temp_path, delta)
+            os.replace(temp_path, final_path)
+        except Exception as e:
+            logger.error(f"delta snapshot {final_path} failed: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self._base = None  # 变更已经取走，只能用下一次全量补上
+            return None
+        self._delta_seq = seq
+        self._snapshot_generations = generations
+        elapsed = time.monotonic() - start
+        self.last_snapshot = {"mode": "delta", "seq": seq, "nodes": len(changes), "pause_ms": round(paused * 1000, 3),
+                              "duration_ms": round(elapsed * 1000, 3), "covered_lsn": covered_lsn}
+        logger.info(f"delta snapshot {final_path}: {len(changes)} nodes, ingest paused {self.last_snapshot['pause_ms']}ms, "
+                    f"total {self.last_snapshot['duration_ms']}ms, covered_lsn:{covered_lsn}")
+
+        self.wal_manager.truncate(covered_lsn)
+        if len(self._delta_files(self._base)) >= self.merge_deltas_after:
+            threading.Thread(target=self.merge_deltas, args=(self._base,), name="snapshot-delta-merge",
+                             daemon=True).start()
+        return final_path
+
+    def merge_deltas(self, base: str) -> str:
+        """把基准之后的增量合并成一个文件，只读写增量文件本身，不碰树"""
+        with self._lock:
+            if base != self._base:
+                return None
+            files = self._delta_files(base)
+            if len(files) < 2:
+                return None
+            chain = list(self._delta_chain(files))
+            merged = columnar_snapshot.read_delta(self._snapshot_path(chain[0]))
+            for fname in chain[1:]:
+                merged.merge(columnar_snapshot.read_delta(self._snapshot_path(fname)))
+            filename = self._delta_filename(merged.first_seq, merged.last_seq)
+            temp_path = self._snapshot_path(filename + ".tmp")
+            final_path = self._snapshot_path(filename)
             with open(temp_path, "wb") as f:
-                pickle.dump(snapshot_data, f)
+                count = columnar_snapshot.write_delta(f, merged, self.codec, self.block_nodes)
+                f.flush()
+                os.fsync(f.fileno())
             os.replace(temp_path, final_path)
+            for _, _, fname in files:
+                if fname != filename:
+                    os.remove(self._snapshot_path(fname))
+            logger.info(f"merged {len(files)} delta snapshots into {filename}: {count} nodes")
+            return final_path
 
-            # 生成快照后需要将   tree.active_snapshots 改成false
-            self.tree.active_snapshots = False
+    def _apply_deltas(self, base_path: str, root: TreeNode):
+        """依次应用基准快照之后的增量"""
+        files = self._delta_files(os.path.basename(base_path))
+        if not files:
+            return
+        nodes = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            nodes[node.id] = node
+            stack.extend(node.children.values())
+        applied = 0
+        for fname in self._delta_chain(files):
+            delta = columnar_snapshot.read_delta(self._snapshot_path(fname))
+            delta.apply(root, nodes)
+            applied = delta.last_seq
+            self.snapshot_lsn = delta.lsn
+        logger.info(f"Applied delta snapshots up to seq {applied}, lsn:{self.snapshot_lsn}")
 
-            self.wal_manager.commit_new_log()  # 删除旧文件，更新文件的名字
-            self._cleanup_old_snapshots(final_path)
+    # ------------------------------
+    # 分代索引的快照：清单 + 每代一个文件，已经持久化的代不重复写
+    # ------------------------------
+    def _take_generation_snapshot(self) -> str:
+        with self._lock:
+            # 封存年轻代的同时切换 WAL 段：切换前的变更（LSN <= covered）都在被封存的代里，之后的只在 WAL 里
+            switch = {}
+            self.tree.seal(on_switch=lambda: switch.update(lsn=self.wal_manager.roll()))
+            covered_lsn = switch["lsn"]
+            epochs = dict(self.tree.generations)  # 封存的代执行完之后取，代里的记录不会比它新
+            generations = self.tree.persisted_generations()
+            written = 0
+            for gen in generations:
+                if gen.file is None:
+                    filename = f"generation_{gen.gen_id}.gen"
+                    gen.dump(self._snapshot_path(filename))
+                    gen.file = filename
+                    written += 1
+
+            filename = self._snapshot_filename(".manifest")
+            temp_path = self._snapshot_path(filename + ".tmp")
+            final_path = self._snapshot_path(filename)
+            with open(temp_path, "wb") as f:
+                pickle.dump({"generations": [gen.file for gen in generations], "epochs": epochs, "lsn": covered_lsn}, f)
+            os.replace(temp_path, final_path)
+
+            self.wal_manager.truncate(covered_lsn)
+            self._cleanup_old_generations(final_path, {gen.file for gen in generations})
+            logger.info(f"generation snapshot {final_path}: {len(generations)} generations, {written} written")
             return final_path
 
+    def _cleanup_old_generations(self, keep_manifest: str, keep_files: set):
+        for fname in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, fname)
+            stale_manifest = fname.endswith(".manifest") and path != keep_manifest
+            stale_generation = fname.endswith(".gen") and fname not in keep_files
+            if stale_manifest or stale_generation:
+                try:
+                    os.remove(path)
+                except Exception as e:
+                    logger.warning(f"Failed to remove old snapshot {path}: {e}")
+
+    def _load_generation_snapshot(self):
+        manifests = sorted(f for f in os.listdir(self.snapshot_dir) if f.endswith(".manifest"))
+        if not manifests:
+            logger.info(f"No generation snapshot found at {self.snapshot_dir}")
+            return
+        with open(self._snapshot_path(manifests[-1]), "rb") as f:
+            manifest = pickle.load(f)
+        generations = [Generation.load(self._snapshot_path(fname)) for fname in manifest["generations"]]
+        self.tree.restore(generations, manifest.get("epochs", {}))
+        self.snapshot_lsn = manifest.get("lsn", 0)
+        logger.info(f"Loaded generation snapshot {manifests[-1]}: {len(generations)} generations")
 
     def _cleanup_old_snapshots(self, keep_file: str):
         for fname in os.listdir(self.snapshot_dir):
             path = os.path.join(self.snapshot_dir, fname)
-            if path != keep_file and fname.endswith(".pkl"):
+            stale_delta = fname.endswith((".delta", ".sec")) and not fname.startswith(
+                os.path.splitext(os.path.basename(keep_file))[0] + ".")
+            if path != keep_file and (fname.endswith((".pkl", ".cols", ".parts")) or stale_delta):
                 try:
                     os.remove(path)
                 except Exception as e:
@@ -164,41 +694,65 @@ class SnapshotManager:
 
 
     # ------------------------------
-    # BFS迭代恢复树
+    # 恢复树：列式快照 mmap 后一遍扫描重建，旧版本的 pickle 快照按 BFS 迭代恢复
     # ------------------------------
     def load_snapshot(self, path: str = None) -> MergePrefixTree:
+        if isinstance(self.tree, GenerationalPrefixIndex):
+            self._load_generation_snapshot()
+            return
         if path is None:
-            pkl_files = [f for f in os.listdir(self.snapshot_dir) if f.endswith(".pkl")]
-            if not pkl_files:
+            snapshot_files = [f for f in os.listdir(self.snapshot_dir) if f.endswith((".cols", ".parts", ".pkl"))]
+            if not snapshot_files:
                 logger.info(f"No snapshot found at {self.snapshot_dir}")
                 return
-            pkl_files.sort()
-            path = os.path.join(self.snapshot_dir, pkl_files[-1])
+            snapshot_files.sort(key=lambda f: os.path.splitext(f)[0])  # 文件名里是时间戳
+            path = os.path.join(self.snapshot_dir, snapshot_files[-1])
+
+        start = time.monotonic()
+        if path.endswith(".parts") or columnar_snapshot.is_columnar(path):
+            if path.endswith(".parts"):
+                root_node, self.snapshot_lsn = self._load_sections(path)
+            else:
+                root_node, self.snapshot_lsn = columnar_snapshot.load_snapshot(path)
+            if root_node is not None:
+                self._apply_deltas(path, root_node)
+        else:
+            root_node = self._load_pickle_snapshot(path)
+        if root_node is None:
+            return
+        self.tree.root = root_node
+        self.tree.recount()  # 替换root后重新统计节点数，供内存预算使用
+        logger.info(f"Loaded snapshot {path}: {self.tree.node_count} nodes, lsn:{self.snapshot_lsn}, "
+                    f"{time.monotonic() - start:.3f}s")
 
+    def _load_pickle_snapshot(self, path: str):
         with open(path, "rb") as f:
             snapshot_data = pickle.load(f)
 
-        logger.info(f"Loading snapshot snapshot_data {snapshot_data}")
         # BFS迭代恢复树
         if snapshot_data is None:
-            return
+            return None
+        if isinstance(snapshot_data, dict):  # 旧版本快照只有节点列表，没有 LSN，恢复时回放全部 WAL
+            self.snapshot_lsn = snapshot_data.get("lsn", 0)
+            snapshot_data = snapshot_data["nodes"]
         node_map = {}
         node_children_map = {}
         root_node = None
         for i, node_info in enumerate(snapshot_data):
             new_node = TreeNode(id=node_info["id"])
             new_node.version = node_info.get("version", 0)
-            new_node.key = node_info.get("key", None)
+            new_node.key = TokenKey.pack(node_info["key"]) if node_info.get("key") is not None else None
             new_node.value = ThreadSafeDict()
             new_node.decode_string = node_info.get("decode_string", None)
             if node_info.get("value") is not None:
                 for k, v in node_info.get("value", {}).items():
-                    root_node.value[k] = v
+                    new_node.value[k] = v
             node_map[new_node.id] = new_node
             node_children_map[new_node.id] = node_info.get("children", [])
             if i == 0:
                 root_node = new_node
-        node_map[root_node.id] = root_node
+        if root_node is None:
+            return None
 
         queue = deque()
         queue.append((root_node, node_children_map[root_node.id]))
@@ -212,4 +766,4 @@ class SnapshotManager:
                 parent_node.children[key_index0] = child_node
                 child_node.parent = parent_node
                 queue.append((child_node, node_children_map[child_node.id]))
-        self.tree.root = root_node
+        return root_node
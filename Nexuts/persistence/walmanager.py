@@ -1,145 +1,439 @@
 import os
+import sys
+import gc
 import json
+import struct
 import threading
 import collections
 import time
-from typing import Optional, Any, List
+import zlib
+from array import array
+from typing import Optional, Any, Iterator, List, Tuple
+
+from utils.logger import logger
 
 _fdatasync = getattr(os, "fdatasync", os.fsync)
 
+# Binary record format. Every WAL file starts with _MAGIC, followed by frames:
+#   header: payload length (u32) | record type (u8) | LSN (u64) | CRC32 (u32), little-endian
+#   payload: `length` bytes
+# The CRC covers payload + type + LSN, so a torn tail or a flipped bit anywhere in the frame is detected
+# exactly, instead of being guessed from newlines.
+_MAGIC = b"NXWAL01\n"
+_HEADER = struct.Struct("<IBQI")
+_TYPE_LSN = struct.Struct("<BQ")
+_U32 = "I" if array("I").itemsize == 4 else "L"
+
+REC_JSON = 1  # dict without token lists, JSON encoded
+REC_TOKENS = 2  # dict whose non-empty uint32 lists (prompt / prompt_value ...) are packed arrays, the rest JSON
+REC_TEXT = 3  # str
+REC_BYTES = 4  # bytes
+
+# Durability policies for records appended without sync / future:
+DURABILITY_BATCH = "batch"  # fdatasync after every flushed batch
+DURABILITY_INTERVAL = "interval"  # fdatasync once sync_interval_ms elapsed or sync_bytes accumulated since the last one
+DURABILITY_OS = "os"  # only write(), the OS decides when pages hit disk (rotate / close still sync)
+DURABILITY_MODES = (DURABILITY_BATCH, DURABILITY_INTERVAL, DURABILITY_OS)
+
+_SEGMENT_SUFFIX = ".wal"
+_LEGACY_LOGS = ("log.logs", "log2.logs")  # single-file layout of older versions, replayed in this order
+
+
+def segment_name(first_lsn: int) -> str:
+    """Segments are named after the first LSN they hold, so name order is LSN order."""
+    return f"{first_lsn:020d}{_SEGMENT_SUFFIX}"
+
+
+def encode_record(record: Any) -> Tuple[int, bytes]:
+    """record -> (record type, payload)"""
+    if isinstance(record, dict):
+        arrays = []
+        rest = {}
+        for key, value in record.items():
+            if type(value) is list and value:
+                try:
+                    arrays.append((key, array(_U32, value)))
+                    continue
+                except (TypeError, OverflowError):  # not a uint32 list, keep it in the JSON part
+                    pass
+            rest[key] = value
+        text = json.dumps(rest, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        if not arrays:
+            return REC_JSON, text
+        parts = [struct.pack("<IB", len(text), len(arrays)), text]
+        for key, values in arrays:
+            name = key.encode("utf-8")
+            if sys.byteorder != "little":
+                values.byteswap()
+            parts.append(struct.pack("<BI", len(name), len(values)))
+            parts.append(name)
+            parts.append(values.tobytes())
+        return REC_TOKENS, b"".join(parts)
+    if isinstance(record, str):
+        return REC_TEXT, record.encode("utf-8")
+    if isinstance(record, (bytes, bytearray)):
+        return REC_BYTES, bytes(record)
+    raise TypeError("record must be dict/str/bytes")
+
+
+def decode_record(rec_type: int, payload) -> Any:
+    if rec_type == REC_JSON:
+        return json.loads(str(payload, "utf-8"))
+    if rec_type == REC_TOKENS:
+        text_len, count = struct.unpack_from("<IB", payload, 0)
+        pos = 5
+        record = json.loads(str(payload[pos:pos + text_len], "utf-8"))
+        pos += text_len
+        for _ in range(count):
+            name_len, length = struct.unpack_from("<BI", payload, pos)
+            pos += 5
+            key = bytes(payload[pos:pos + name_len]).decode("utf-8")
+            pos += name_len
+            values = array(_U32)
+            values.frombytes(payload[pos:pos + length * 4])
+            if sys.byteorder != "little":
+                values.byteswap()
+            pos += length * 4
+            record[key] = values.tolist()
+        return record
+    if rec_type == REC_TEXT:
+        text = bytes(payload).decode("utf-8")
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
+    if rec_type == REC_BYTES:
+        return bytes(payload)
+    raise ValueError(f"unknown wal record type {rec_type}")
+
+
+def frame_record(rec_type: int, lsn: int, payload: bytes, payload_crc: int = None) -> bytes:
+    """payload_crc: zlib.crc32(payload) computed in advance (outside the enqueue lock)"""
+    if payload_crc is None:
+        payload_crc = zlib.crc32(payload)
+    crc = zlib.crc32(_TYPE_LSN.pack(rec_type, lsn), payload_crc)
+    return _HEADER.pack(len(payload), rec_type, lsn, crc) + payload
+
+
+class WalScan:
+    """Result of scanning one WAL file: valid frames, where they end, and the first bad frame if any"""
+    __slots__ = ("frames", "valid_end", "error", "corrupt", "zero_tail")
+
+    def __init__(self):
+        self.frames: List[Tuple[int, int, memoryview, int, int]] = []  # (lsn, type, payload, frame begin, frame end)
+        self.valid_end = 0
+        self.error: Optional[str] = None
+        self.corrupt = False  # checksum mismatch, as opposed to a torn (short) tail
+        self.zero_tail = False  # hit the preallocated, never written part of a segment: no more data
+
+
+def scan_frames(data: bytes, verify: bool = True, start: int = len(_MAGIC)) -> WalScan:
+    """Parse frames from `start` (right after the magic by default). Stops at the first torn or corrupt frame
+    (its length can't be trusted); a torn "tail" of a partial buffer just means more data has to be read."""
+    result = WalScan()
+    view = memoryview(data)
+    pos = start
+    result.valid_end = pos
+    size = len(data)
+    while pos < size:
+        if size - pos < _HEADER.size:
+            result.error = f"torn header at offset {pos} ({size - pos} bytes)"
+            break
+        length, rec_type, lsn, crc = _HEADER.unpack_from(data, pos)
+        if lsn == 0 and length == 0 and crc == 0:  # preallocated, never written part of a segment (LSNs start at 1)
+            result.zero_tail = True
+            break
+        end = pos + _HEADER.size + length
+        if end > size:
+            result.error = f"torn record at offset {pos} (lsn {lsn}, {size - pos} of {end - pos} bytes)"
+            break
+        payload = view[pos + _HEADER.size:end]
+        if verify and zlib.crc32(_TYPE_LSN.pack(rec_type, lsn), zlib.crc32(payload)) != crc:
+            result.corrupt = True
+            result.error = f"checksum mismatch at offset {pos} (lsn {lsn}, {size - end} bytes after it)"
+            break
+        result.frames.append((lsn, rec_type, payload, pos, end))
+        pos = end
+        result.valid_end = end
+    return result
+
+
+class WalWriteError(OSError):
+    """The write or fdatasync of a batch failed: its records are not (durably) in the WAL."""
+
 
 class _WalEntry:
-    __slots__ = ("data", "event")
-    def __init__(self, data: bytes):
+    __slots__ = ("data", "event", "count", "durable", "lsn", "enqueued", "error")
+    def __init__(self, data: bytes, count: int = 0, durable: bool = False, lsn: int = 0):
         self.data = data
         self.event = threading.Event()
+        self.count = count  # number of records in data
+        self.durable = durable  # a waiter needs this entry on disk: forces an fdatasync for its batch in any mode
+        self.lsn = lsn  # LSN of the last record in data
+        self.enqueued = time.monotonic()
+        self.error: Optional[BaseException] = None  # set before event when the batch failed to be written / synced
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """True once released; raises WalWriteError if the batch was not made durable."""
+        if not self.event.wait(timeout=timeout):
+            return False
+        if self.error is not None:
+            raise WalWriteError(f"wal write failed for lsn <= {self.lsn}: {self.error}") from self.error
+        return True
+
+
+class WalFuture:
+    """Handle of an appended record (group). Released once it is durable; all futures of one flushed batch are
+    released together by the same fdatasync."""
+    __slots__ = ("_entry",)
+
+    def __init__(self, entry: _WalEntry):
+        self._entry = entry
+
+    @property
+    def lsn(self) -> int:
+        return self._entry.lsn
+
+    def done(self) -> bool:
+        return self._entry.event.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """True once durable, False on timeout; raises WalWriteError if the write or fdatasync failed."""
+        return self._entry.wait(timeout)
+
+
+class _PendingRecord:
+    """Encoded before taking the queue lock; the LSN is assigned (and the frame built) in queue order"""
+    __slots__ = ("rec_type", "payload", "crc")
+    def __init__(self, record: Any):
+        self.rec_type, self.payload = encode_record(record)
+        self.crc = zlib.crc32(self.payload)
 
 
 class WalManager:
+    """
+    Segmented write-ahead log. Records get monotonically increasing LSNs and are appended to the active segment,
+    which is rolled over once it reaches segment_size. A snapshot records the LSN it covers; truncation deletes
+    the segments whose records are all covered, nothing is ever copied or rewritten.
+    """
     def __init__(self,
                  walmanager_path: str = "/data/nexuts/wal_dir",
-                 log_path: str = "log.logs",
-                 rotated_path: str = "log2.logs",
+                 segment_size: int = 64 << 20,
+                 preallocate: bool = False,
                  flush_interval: float = 0.01,
-                 max_batch: int = 4096):
-        self.log_path = os.path.join(walmanager_path, log_path)
-        self.rotated_path = os.path.join(walmanager_path, rotated_path)
-
+                 max_batch: int = 4096,
+                 durability: str = DURABILITY_BATCH,
+                 sync_interval_ms: float = 10.0,
+                 sync_bytes: int = 4 << 20):
+        self.wal_dir = walmanager_path
+        self.segment_size = int(segment_size)
+        # fallocate the whole segment up front: appends then don't grow the file, fdatasync has less metadata to flush
+        self.preallocate = bool(preallocate) and hasattr(os, "posix_fallocate")
 
         self.flush_interval = float(flush_interval)
         self.max_batch = int(max_batch)
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"durability must be one of {DURABILITY_MODES}")
+        self.durability = durability
+        self.sync_interval = float(sync_interval_ms) / 1000.0
+        self.sync_bytes = int(sync_bytes)
+        self._unsynced_bytes = 0  # written since the last fdatasync, guarded by _file_lock
+        self._last_sync = time.monotonic()
 
         # queue + cond
         self._q = collections.deque()  # deque[_WalEntry]
         self._q_lock = threading.Lock()
         self._q_cond = threading.Condition(self._q_lock)
 
-        # file lock + fd
-        self._file_lock = threading.Lock()
-        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
-        self._fd = os.open(self.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
-
-        # flusher thread
-        self._stop_flag = False
-        self._flusher = threading.Thread(target=self._flusher_loop, name="wal-flusher", daemon=True)
-        self._flusher.start()
-
         self.metrics = {
             "append_count": 0,
             "sync_count": 0,
             "fsync_count": 0,
             "written_bytes": 0,
             "batches": 0,
+            "batch_records": 0,  # records over all flushed batches, / batches = achieved batch size
+            "max_batch_records": 0,
+            "durable_commits": 0,  # entries a waiter asked to be durable
+            "segments_created": 0,
+            "segments_deleted": 0,
+            "write_errors": 0,  # batches whose write failed, their waiters got WalWriteError
+            "sync_errors": 0,  # failed fdatasync calls
         }
+        self._commit_latencies = collections.deque(maxlen=4096)  # enqueue -> durable, seconds, recent durable entries
+
+        # file lock + active segment: fd, first LSN, write offset
+        self._file_lock = threading.Lock()
+        os.makedirs(self.wal_dir, exist_ok=True)
+        self.last_lsn = 0  # last assigned LSN, guarded by _q_cond
+        self._fd = -1
+        self._segment_lsn = 0
+        self._offset = 0
+        self._upgrade_legacy()
+        self._open_tail()
+        self._written_lsn = self.last_lsn  # last LSN handed to write(), guarded by _file_lock
+
+        # flusher thread
+        self._stop_flag = False
+        self._flusher = threading.Thread(target=self._flusher_loop, name="wal-flusher", daemon=True)
+        self._flusher.start()
 
     # -------------------------
     # public API
     # -------------------------
     def append(self, record: Any, sync: bool = False, timeout: Optional[float] = None) -> bool:
-        data = self._normalize(record)
-        entry = _WalEntry(data)
+        """sync=True waits until the record is durable, whatever the durability mode; raises WalWriteError if the
+        write or fdatasync failed."""
+        entry = self._enqueue([_PendingRecord(record)], durable=sync)
+        return self._wait_sync(entry, timeout) if sync else True
+
+    def append_batch(self, records: List[Any], sync: bool = False, timeout: Optional[float] = None) -> bool:
+        """A group of records is enqueued as one entry: written contiguously and made durable by one fdatasync."""
+        if not records:
+            return True
+        return self.append_prepared(self.prepare_batch(records), sync, timeout)
+
+    @staticmethod
+    def prepare_batch(records: List[Any]) -> List[_PendingRecord]:
+        """Encode records (and checksum the payloads) without touching the queue. Callers that must assign LSNs
+        inside their own critical section encode first and only hold their lock around append_prepared."""
+        return [_PendingRecord(record) for record in records]
+
+    def append_prepared(self, pending: List[_PendingRecord], sync: bool = False,
+                        timeout: Optional[float] = None) -> bool:
+        """Enqueue records encoded by prepare_batch. LSNs are assigned here, in call order."""
+        if not pending:
+            return True
+        entry = self._enqueue(pending, durable=sync)
+        return self._wait_sync(entry, timeout) if sync else True
+
+    def append_async(self, record: Any) -> WalFuture:
+        """Non-blocking append that returns a future released when the record is durable."""
+        return WalFuture(self._enqueue([_PendingRecord(record)], durable=True))
+
+    def append_batch_async(self, records: List[Any]) -> WalFuture:
+        return WalFuture(self._enqueue([_PendingRecord(record) for record in records], durable=True))
+
+    def get_metrics(self) -> dict:
+        """Counters plus achieved batch size and commit latency (enqueue -> durable) of the current durability mode."""
+        metrics = dict(self.metrics)
+        batches = metrics["batches"]
+        metrics["avg_batch_records"] = round(metrics["batch_records"] / batches, 2) if batches else 0.0
+        metrics["avg_batch_bytes"] = round(metrics["written_bytes"] / batches, 1) if batches else 0.0
+        latencies = sorted(self._commit_latencies)
+        if latencies:
+            metrics["commit_latency_ms"] = {
+                "avg": round(sum(latencies) / len(latencies) * 1000, 3),
+                "p50": round(latencies[len(latencies) // 2] * 1000, 3),
+                "p99": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3),
+            }
+        metrics["durability"] = self.durability
+        metrics["sync_interval_ms"] = self.sync_interval * 1000
+        metrics["sync_bytes"] = self.sync_bytes
+        metrics["unsynced_bytes"] = self._unsynced_bytes
+        metrics["last_lsn"] = self.last_lsn
+        metrics["segment_size"] = self.segment_size
+        metrics["preallocate"] = self.preallocate
+        metrics["active_segment"] = segment_name(self._segment_lsn)
+        metrics["segments"] = len(self.segments())
+        return metrics
+
+    def load_resume_records(self, after_lsn: int = 0) -> List[Any]:
+        """Load the records with LSN > after_lsn (the LSN covered by the loaded snapshot) without modifying files."""
+        result = []
+        for chunk in self.iter_records(after_lsn):
+            result.extend(chunk)
+        return result
+
+    def iter_records(self, after_lsn: int = 0, chunk_records: int = 4096, read_size: int = 4 << 20,
+                     progress: Optional[dict] = None) -> Iterator[List[Any]]:
+        """Stream the records with LSN > after_lsn in LSN order, `chunk_records` at a time. Segments are read
+        `read_size` bytes at a time, so memory stays bounded whatever the WAL length. Segments that end at or
+        before after_lsn are not opened. progress["bytes_read"] / progress["records_read"] are updated as it goes."""
+        chunk = []
+        for path in self.replay_segments(after_lsn):
+            for frames in self._iter_segment_frames(path, read_size, progress):
+                if frames[0][0] <= after_lsn:
+                    frames = [frame for frame in frames if frame[0] > after_lsn]
+                chunk.extend(self._decode_frames(frames))
+                if progress is not None:
+                    progress["records_read"] = progress.get("records_read", 0) + len(frames)
+                while len(chunk) >= chunk_records:
+                    yield chunk[:chunk_records]
+                    chunk = chunk[chunk_records:]
+        if chunk:
+            yield chunk
+
+    def replay_segments(self, after_lsn: int = 0) -> List[str]:
+        """Paths of the segments that may hold records with LSN > after_lsn"""
+        segments = self.segments()
+        return [path for i, (_, path) in enumerate(segments)
+                if i + 1 == len(segments) or segments[i + 1][0] - 1 > after_lsn]
+
+    def _frame(self, pending: _PendingRecord) -> bytes:
+        """Caller holds _q_cond, so LSNs follow queue (= file) order."""
+        self.last_lsn += 1
+        return frame_record(pending.rec_type, self.last_lsn, pending.payload, pending.crc)
+
+    def _enqueue(self, pending: List[_PendingRecord], durable: bool) -> _WalEntry:
         with self._q_cond:
+            data = b"".join(self._frame(item) for item in pending)
+            entry = _WalEntry(data, len(pending), durable, self.last_lsn)
             self._q.append(entry)
             self._q_cond.notify()
-        self.metrics["append_count"] += 1
+        self.metrics["append_count"] += len(pending)
         self.metrics["written_bytes"] += len(data)
-        if sync:
-            ok = entry.event.wait(timeout=timeout)
-            if ok:
-                self.metrics["sync_count"] += 1
-            return ok
-        return True
-
-    def load_resume_records(self):
-        """Load all records from log.logs and log2.logs without modifying files."""
-        result = []
-
-        # read log.logs
-        if os.path.exists(self.log_path):
-            result.extend(self._read_and_parse_all(self.log_path))
-
-        # read log2.logs if exists
-        if os.path.exists(self.rotated_path):
-            result.extend(self._read_and_parse_all(self.rotated_path))
-
-        return result
+        return entry
 
+    def _wait_sync(self, entry: _WalEntry, timeout: Optional[float]) -> bool:
+        ok = entry.wait(timeout)
+        if ok:
+            self.metrics["sync_count"] += 1
+        return ok
 
     def _barrier_flush(self):
-        """Insert a sentinel entry and wait until it's persisted, used before rotate/commit."""
+        """Insert a sentinel entry and wait until everything queued before it is written, used before roll."""
         entry = _WalEntry(b"")
         with self._q_cond:
             self._q.append(entry)
             self._q_cond.notify()
         entry.event.wait()
 
-    def rotate(self, new_path: Optional[str] = None, line_n: int = 0):
-        """Switch active writing file to new_path (default rotated_path).
-        Optionally copy last `line_n` lines from current log to new log at head.
-        """
-        new_path = new_path or self.rotated_path
+    def roll(self) -> int:
+        """Flush the queue and start a new segment. Returns the last LSN before the switch: everything up to it is
+        written (and synced unless durability is os), everything after it goes to the new segment."""
         self._barrier_flush()
         with self._file_lock:
+            if self._offset > len(_MAGIC):
+                self._roll_locked()
+            return self._written_lsn
+
+    def truncate(self, covered_lsn: int) -> int:
+        """Delete the segments whose records are all <= covered_lsn (already in a durable snapshot).
+        The active segment is never deleted. Returns the number of deleted segments."""
+        segments = self.segments()
+        deleted = 0
+        for (first_lsn, path), (next_lsn, _) in zip(segments, segments[1:]):
+            if next_lsn - 1 > covered_lsn:
+                break
             try:
-                _fdatasync(self._fd)
-            except Exception:
-                pass
-            try:
-                os.close(self._fd)
-            except Exception:
-                pass
-
-            parent = os.path.dirname(new_path) or "."
-            os.makedirs(parent, exist_ok=True)
-
-            prepend_data = b""
-            if line_n > 0 and os.path.exists(self.log_path):
-                lines = self._read_complete_lines(self.log_path)
-                last_lines = lines[-line_n:] if line_n <= len(lines) else lines
-                prepend_data = b"".join(last_lines)
-
-            with open(new_path, "wb") as f:
-                if prepend_data:
-                    f.write(prepend_data)
-
-            self._fd = os.open(new_path, os.O_WRONLY | os.O_APPEND)
-
-    def commit_new_log(self):
-        self._barrier_flush()
-        with self._file_lock:
-            try:
-                _fdatasync(self._fd)
-            except Exception:
-                pass
-            try:
-                os.close(self._fd)
-            except Exception:
-                pass
-
-            os.replace(self.rotated_path, self.log_path)
-            self._fsync_dir(self.log_path)
-
-            self._fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND)
+                os.remove(path)
+                deleted += 1
+            except Exception as e:
+                logger.warning(f"[WAL] failed to remove segment {path}: {e}")
+        if deleted:
+            self._fsync_dir(segments[0][1])
+            self.metrics["segments_deleted"] += deleted
+        return deleted
+
+    def segments(self) -> List[Tuple[int, str]]:
+        """[(first LSN, path)] in LSN order"""
+        result = []
+        for fname in os.listdir(self.wal_dir):
+            if fname.endswith(_SEGMENT_SUFFIX) and fname[:-len(_SEGMENT_SUFFIX)].isdigit():
+                result.append((int(fname[:-len(_SEGMENT_SUFFIX)]), os.path.join(self.wal_dir, fname)))
+        result.sort()
+        return result
 
     def read_all_records(self, start_percent: float = 0.0, end_percent: float = 100.0) -> List[Any]:
         if not (0.0 <= start_percent <= 100.0 and 0.0 <= end_percent <= 100.0):
@@ -147,8 +441,10 @@ class WalManager:
         if start_percent >= end_percent:
             return []
 
-        lines = self._read_complete_lines(self.log_path)
-        total = len(lines)
+        frames = []
+        for _, path in self.segments():
+            frames.extend(self._scan_file(path)[1].frames)
+        total = len(frames)
         if total == 0:
             return []
 
@@ -157,24 +453,11 @@ class WalManager:
         if end_idx <= start_idx:
             return []
 
-        out = []
-        for line in lines[start_idx:end_idx]:
-            parsed = self._parse_line(line)
-            if parsed is not None:
-                out.append(parsed)
-        return out
+        return self._decode_frames(frames[start_idx:end_idx])
 
     def recover(self) -> List[Any]:
-        result = []
-        if os.path.exists(self.rotated_path):
-            self._ensure_truncate_to_last_newline(self.log_path)
-            self._ensure_truncate_to_last_newline(self.rotated_path)
-            result.extend(self._read_and_parse_all(self.log_path))
-            result.extend(self._read_and_parse_all(self.rotated_path))
-        else:
-            self._ensure_truncate_to_last_newline(self.log_path)
-            result.extend(self._read_and_parse_all(self.log_path))
-        return result
+        """All records on disk. A torn tail of the active segment is already cut when the manager opens it."""
+        return self.load_resume_records()
 
     def close(self, wait: float = 5.0):
         self._stop_flag = True
@@ -182,31 +465,153 @@ class WalManager:
             self._q_cond.notify_all()
         self._flusher.join(timeout=wait)
         with self._file_lock:
-            try:
-                _fdatasync(self._fd)
-            except Exception:
-                pass
-            try:
-                os.close(self._fd)
-            except Exception:
-                pass
+            self._close_segment_locked()
 
     # -------------------------
     # internal helpers
     # -------------------------
-    def _normalize(self, record: Any) -> bytes:
-        if isinstance(record, dict):
-            s = json.dumps(record, ensure_ascii=False)
-            b = s.encode("utf-8")
-        elif isinstance(record, str):
-            b = record.encode("utf-8")
-        elif isinstance(record, (bytes, bytearray)):
-            b = bytes(record)
+    def _scan_file(self, path: str, verify: bool = True) -> Tuple[bytes, WalScan]:
+        if not os.path.exists(path):
+            return b"", WalScan()
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data:
+            return data, WalScan()
+        if not data.startswith(_MAGIC):
+            raise ValueError(f"{path} is not a binary WAL file")
+        scan = scan_frames(data, verify)
+        if scan.error is not None:
+            logger.warning(f"[WAL] {path}: {scan.error}, {len(scan.frames)} valid records before it")
+        return data, scan
+
+    def _iter_segment_frames(self, path: str, read_size: int, progress: Optional[dict]):
+        """Yield the valid frames of one segment buffer by buffer; stops (and logs) at a torn or corrupt frame."""
+        with open(path, "rb") as f:
+            magic = f.read(len(_MAGIC))
+            if not magic:
+                return
+            if magic != _MAGIC:
+                raise ValueError(f"{path} is not a binary WAL file")
+            offset = len(_MAGIC)  # file offset of buf[0]
+            buf = b""
+            eof = False
+            while not eof:
+                data = f.read(read_size)
+                eof = len(data) < read_size
+                if progress is not None:
+                    progress["bytes_read"] = progress.get("bytes_read", 0) + len(data)
+                buf = buf + data if buf else data
+                scan = scan_frames(buf, start=0)
+                if scan.frames:
+                    yield scan.frames
+                if scan.corrupt or scan.zero_tail:
+                    if scan.corrupt:
+                        logger.warning(f"[WAL] {path}: {scan.error} (file offset {offset + scan.valid_end})")
+                    return
+                offset += scan.valid_end
+                buf = buf[scan.valid_end:]
+            if buf:
+                logger.warning(f"[WAL] {path}: torn record at file offset {offset} ({len(buf)} bytes)")
+
+    def _open_tail(self):
+        """Reopen the newest segment for appending (or create the first one) and continue its LSNs. A torn or
+        corrupt tail is cut first, otherwise every frame appended after it would be unreadable."""
+        segments = self.segments()
+        if not segments:
+            self._new_segment(self.last_lsn + 1)
+            return
+        first_lsn, path = segments[-1]
+        data, scan = self._scan_file(path)
+        if scan.corrupt:
+            # not a crash artefact: keep the cut bytes around for inspection instead of silently dropping them
+            with open(f"{path}.corrupt-{scan.valid_end}", "wb") as f:
+                f.write(data[scan.valid_end:])
+        self.last_lsn = max(first_lsn - 1, scan.frames[-1][0] if scan.frames else 0)
+        self._fd = os.open(path, os.O_WRONLY)
+        if scan.valid_end < len(_MAGIC):
+            os.ftruncate(self._fd, 0)
+            os.pwrite(self._fd, _MAGIC, 0)
+            scan.valid_end = len(_MAGIC)
+        elif scan.valid_end < len(data):
+            os.ftruncate(self._fd, scan.valid_end)  # torn / corrupt / preallocated tail
+        if self.preallocate:
+            os.posix_fallocate(self._fd, 0, max(self.segment_size, scan.valid_end))
+        _fdatasync(self._fd)
+        self._segment_lsn = first_lsn
+        self._offset = scan.valid_end
+
+    def _new_segment(self, first_lsn: int):
+        """Caller holds _file_lock (or is __init__)."""
+        path = os.path.join(self.wal_dir, segment_name(first_lsn))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        if self.preallocate:
+            os.posix_fallocate(fd, 0, self.segment_size)
+        os.pwrite(fd, _MAGIC, 0)
+        self._fsync_dir(path)
+        self._fd = fd
+        self._segment_lsn = first_lsn
+        self._offset = len(_MAGIC)
+        self.metrics["segments_created"] += 1
+
+    def _close_segment_locked(self, sync: bool = True):
+        if self._fd < 0:
+            return
+        if self.preallocate:
+            try:
+                os.ftruncate(self._fd, self._offset)  # drop the unused preallocated tail
+            except Exception:
+                pass
+        if sync:
+            self._sync_locked()
         else:
-            raise TypeError("record must be dict/str/bytes")
-        if not b.endswith(b"\n"):
-            b += b"\n"
-        return b
+            self._unsynced_bytes = 0
+        try:
+            os.close(self._fd)
+        except Exception:
+            pass
+        self._fd = -1
+
+    def _roll_locked(self, sync: bool = True):
+        self._close_segment_locked(sync)
+        self._new_segment(self._written_lsn + 1)
+
+    def _upgrade_legacy(self):
+        """Move log.logs / log2.logs of older versions (JSON lines or single-file binary) into the first segment,
+        renumbering their records from LSN 1."""
+        paths = [os.path.join(self.wal_dir, name) for name in _LEGACY_LOGS]
+        paths = [path for path in paths if os.path.exists(path)]
+        if not paths:
+            return
+        if self.segments():  # crashed after writing the segment but before removing the old files
+            for path in paths:
+                os.remove(path)
+            return
+        records = []
+        for path in paths:
+            with open(path, "rb") as f:
+                binary = f.read(len(_MAGIC)) == _MAGIC
+            if binary:
+                records.extend(self._decode_frames(self._scan_file(path)[1].frames))
+            else:
+                records.extend(record for record in (self._parse_line(line) for line in self._read_complete_lines(path))
+                               if record is not None)
+        frames = []
+        for record in records:
+            self.last_lsn += 1
+            rec_type, payload = encode_record(record)
+            frames.append(frame_record(rec_type, self.last_lsn, payload))
+        segment_path = os.path.join(self.wal_dir, segment_name(1))
+        temp_path = segment_path + ".upgrade"
+        with open(temp_path, "wb") as f:
+            f.write(_MAGIC)
+            f.write(b"".join(frames))
+            f.flush()
+            _fdatasync(f.fileno())
+        os.replace(temp_path, segment_path)
+        self._fsync_dir(segment_path)
+        for path in paths:
+            os.remove(path)
+        logger.info(f"[WAL] moved {len(records)} records of {', '.join(paths)} into segment {segment_path}")
 
     def _parse_line(self, line: bytes) -> Optional[Any]:
         line = line.rstrip(b"\n")
@@ -223,63 +628,107 @@ class WalManager:
             batch.append(self._q.popleft())
         return batch
 
+    def _sync_due(self) -> bool:
+        if self.durability == DURABILITY_BATCH:
+            return self._unsynced_bytes > 0
+        if self.durability == DURABILITY_INTERVAL:
+            return self._unsynced_bytes > 0 and (self._unsynced_bytes >= self.sync_bytes
+                                                  or time.monotonic() - self._last_sync >= self.sync_interval)
+        return False
+
+    def _sync_locked(self) -> Optional[Exception]:
+        """Caller holds _file_lock. Returns the error if fdatasync failed; the unsynced bytes then stay pending,
+        so the next sync retries them."""
+        try:
+            _fdatasync(self._fd)
+        except Exception as e:
+            self.metrics["sync_errors"] += 1
+            logger.error(f"[WAL] fdatasync of segment {segment_name(self._segment_lsn)} failed "
+                         f"({self._unsynced_bytes} unsynced bytes): {e}")
+            return e
+        self.metrics["fsync_count"] += 1
+        self._unsynced_bytes = 0
+        self._last_sync = time.monotonic()
+        return None
+
+    def _commit(self, batch: List[_WalEntry], force_sync: bool = False):
+        """Write one batch with a single write loop; one fdatasync (if the mode or a durable waiter asks for it)
+        releases every entry of the batch at once: group commit."""
+        total_bytes = b"".join(entry.data for entry in batch if entry.data)
+        need_durable = force_sync or any(entry.durable for entry in batch)
+        error = None
+        with self._file_lock:
+            written = 0
+            try:
+                while written < len(total_bytes):
+                    n = os.pwrite(self._fd, total_bytes[written:], self._offset + written)
+                    if n == 0:
+                        raise OSError("os.pwrite returned 0")
+                    written += n
+            except Exception as e:
+                error = e
+                self.metrics["write_errors"] += 1
+                logger.error(f"[WAL] write of {len(batch)} entries (lsn <= {batch[-1].lsn}) failed after "
+                             f"{written} of {len(total_bytes)} bytes: {e}")
+                if written:
+                    try:
+                        os.ftruncate(self._fd, self._offset)  # cut the torn frames, later frames must stay readable
+                    except Exception as truncate_error:
+                        logger.error(f"[WAL] failed to cut torn bytes at offset {self._offset}: {truncate_error}")
+            else:
+                self._offset += written
+                self._unsynced_bytes += written
+                if need_durable or self._sync_due():
+                    error = self._sync_locked()
+                if error is None:
+                    for entry in batch:
+                        if entry.lsn > self._written_lsn:
+                            self._written_lsn = entry.lsn
+            if self._offset >= self.segment_size:
+                # os mode closes the full segment without fdatasync, the OS writes its pages back
+                self._roll_locked(sync=self.durability != DURABILITY_OS)
+
+        now = time.monotonic()
+        records = 0
+        for entry in batch:
+            records += entry.count
+            if error is not None:
+                entry.error = error
+            elif entry.durable:
+                self._commit_latencies.append(now - entry.enqueued)
+                self.metrics["durable_commits"] += 1
+            entry.event.set()
+        self.metrics["batches"] += 1
+        self.metrics["batch_records"] += records
+        if records > self.metrics["max_batch_records"]:
+            self.metrics["max_batch_records"] = records
+
     def _flusher_loop(self):
         while True:
             with self._q_cond:
                 if not self._q and not self._stop_flag:
-                    self._q_cond.wait(timeout=self.flush_interval)
+                    timeout = self.flush_interval
+                    if self.durability == DURABILITY_INTERVAL and self._unsynced_bytes:
+                        timeout = max(0.0, min(timeout, self._last_sync + self.sync_interval - time.monotonic()))
+                    self._q_cond.wait(timeout=timeout)
                 if not self._q and self._stop_flag:
                     break
                 batch = self._collect_batch()
 
-            if not batch:
-                continue
-
-            total_bytes = b"".join(entry.data for entry in batch if entry.data)
-            with self._file_lock:
-                try:
-                    written = 0
-                    while written < len(total_bytes):
-                        n = os.write(self._fd, total_bytes[written:])
-                        if n == 0:
-                            raise OSError("os.write returned 0")
-                        written += n
-                    try:
-                        _fdatasync(self._fd)
-                        self.metrics["fsync_count"] += 1
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-
-            for entry in batch:
-                entry.event.set()
-            self.metrics["batches"] += 1
+            if batch:
+                self._commit(batch)
+            elif self._sync_due():
+                # interval mode: nothing new arrived, but the deadline of the already written bytes has passed
+                with self._file_lock:
+                    if self._sync_due():
+                        self._sync_locked()
 
         remaining = []
         with self._q_lock:
             while self._q:
                 remaining.append(self._q.popleft())
         if remaining:
-            total_bytes = b"".join(entry.data for entry in remaining if entry.data)
-            with self._file_lock:
-                try:
-                    written = 0
-                    while written < len(total_bytes):
-                        n = os.write(self._fd, total_bytes[written:])
-                        if n == 0:
-                            raise OSError("os.write returned 0")
-                        written += n
-                    try:
-                        _fdatasync(self._fd)
-                        self.metrics["fsync_count"] += 1
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
-            for entry in remaining:
-                entry.event.set()
-            self.metrics["batches"] += 1
+            self._commit(remaining, force_sync=True)
 
     def _read_complete_lines(self, path: str) -> List[bytes]:
         if not os.path.exists(path):
@@ -292,47 +741,16 @@ class WalManager:
         complete = [ln for ln in raw_lines if ln.endswith(b"\n")]
         return complete
 
-    def _read_and_parse_all(self, path: str) -> List[Any]:
-        lines = self._read_complete_lines(path)
-        out = []
-        for ln in lines:
-            p = self._parse_line(ln)
-            if p is not None:
-                out.append(p)
-        return out
-
-    def _ensure_truncate_to_last_newline(self, path: str):
-        if not os.path.exists(path):
-            return
-        try:
-            fd = os.open(path, os.O_RDWR)
-        except Exception:
-            return
+    @staticmethod
+    def _decode_frames(frames) -> List[Any]:
+        # replay allocates millions of container objects that all survive, cyclic GC passes over them are pure overhead
+        gc_enabled = gc.isenabled()
+        gc.disable()
         try:
-            st = os.fstat(fd)
-            if st.st_size == 0:
-                os.close(fd)
-                return
-            data = os.pread(fd, st.st_size, 0)
-            if not data.endswith(b"\n"):
-                idx = data.rfind(b"\n")
-                if idx == -1:
-                    try:
-                        os.ftruncate(fd, 0)
-                        _fdatasync(fd)
-                    except Exception:
-                        pass
-                else:
-                    try:
-                        os.ftruncate(fd, idx + 1)
-                        _fdatasync(fd)
-                    except Exception:
-                        pass
+            return [decode_record(rec_type, payload) for _, rec_type, payload, _, _ in frames]
         finally:
-            try:
-                os.close(fd)
-            except Exception:
-                pass
+            if gc_enabled:
+                gc.enable()
 
     def _fsync_dir(self, path: str):
         dirpath = os.path.dirname(path) or "."
@@ -347,51 +765,37 @@ class WalManager:
 
 
 if __name__ == "__main__":
+    import shutil
     # --- 清理旧文件 ---
-    for f in ["log.logs", "log2.logs"]:
-        if os.path.exists(f):
-            os.remove(f)
+    shutil.rmtree("wal_demo", ignore_errors=True)
 
     print("=== 创建 WAL 实例 ===")
-    wal = WalManager(log_path="log.logs", rotated_path="log2.logs")
+    wal = WalManager(walmanager_path="wal_demo", segment_size=4096)
 
     print("\n=== 测试 1：异步 append ===")
     for i in range(50):
         wal.append({"msg": f"async-{i}"})
-    #time.sleep(0.1)
-    print(open("log.logs").read())
+    wal.append({"msg": "sync-write"}, sync=True)
+    print(wal.load_resume_records(), "last lsn:", wal.last_lsn)
 
-    # print("\n=== 测试 2：同步 append ===")
-    # wal.append({"msg": "sync-write"}, sync=True)
-    # print(open("log.logs").read())
-    #
-    # print("\n=== 测试 3：百分比读取 0~50 ===")
+    # print("\n=== 测试 2：百分比读取 0~50 ===")
     # recs = wal.read_all_records(0, 50)
     # print("读取结果：", recs)
     #
-    # print("\n=== 测试 4：rotate，拷贝最后两行 ===")
-    # wal.rotate(line_n=2)
-    # wal.append({"msg": "after-rotate-1"}, sync=True)
-    # wal.append({"msg": "after-rotate-2"}, sync=True)
-    # print("log2.logs 内容：")
-    # print(open("log2.logs").read())
+    # print("\n=== 测试 3：roll + truncate，快照覆盖到 covered ===")
+    # covered = wal.roll()
+    # wal.append({"msg": "after-roll"}, sync=True)
+    # wal.truncate(covered)
+    # print(wal.segments(), wal.load_resume_records(after_lsn=covered))
     #
-    # print("\n=== 测试 5：commit_new_log ===")
-    # wal.commit_new_log()
-    # print("log.logs 内容：")
-    # print(open("log.logs").read())
-    #
-    # print("\n=== 测试 6：模拟半行崩溃 ===")
-    # with open("log.logs", "ab") as f:
-    #     f.write(b'{"msg": "crash-partial"')
-    # print(open("log.logs").read())
-    #
-    # print("\n=== 测试 recover ===")
-    # out = wal.recover()
-    # print(out)
-    # print(open("log.logs").read())
+    # print("\n=== 测试 4：模拟半条记录崩溃 ===")
+    # with open(wal.segments()[-1][1], "ab") as f:
+    #     f.write(b"\x10\x00\x00\x00\x01partial")
+    # wal.close()
+    # wal = WalManager(walmanager_path="wal_demo", segment_size=4096)
+    # print(wal.recover())
     #
     # print("\n=== 关闭 WAL ===")
     # wal.close()
     # print("\n=== metrics ===")
-    # print(wal.metrics)
\ No newline at end of file
+    # print(wal.get_metrics())
@@ -6,7 +6,7 @@ import asyncio
 
 from Manager.register import Registry
 from Manager.instance_manager import InstanceManager
-from ApiServer.request_data import RadixRequest, RegisterRequest
+from ApiServer.request_data import RadixRequest, RegisterRequest, DigestRequest, PathsRequest
 from sentry import Sentry
 from utils.logger import logger
 
@@ -49,6 +49,22 @@ class APIServer:
 
             return {"status": "enqueued", "instance_id": instance_id}
 
+        @app.post("/v1/radixtree/digest")
+        async def radix_digest(req: DigestRequest):
+            """反熵：返回实例内容摘要中指定桶及其子桶的 (哈希和, 个数)"""
+            result = self.sentry.radix_digest(req.dict())
+            if result is None:
+                raise HTTPException(status_code=404, detail="instance not registered")
+            return {"instance_id": req.instance_id, "level": req.level, "digest": result}
+
+        @app.post("/v1/radixtree/paths")
+        async def radix_paths(req: PathsRequest):
+            """反熵：返回指定叶子桶内的全部极大路径"""
+            result = self.sentry.radix_paths(req.dict())
+            if result is None:
+                raise HTTPException(status_code=404, detail="instance not registered")
+            return {"instance_id": req.instance_id, "paths": result}
+
         @app.get("/v1/health")
         async def health_check():
             """服务健康检查"""
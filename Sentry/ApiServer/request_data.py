@@ -28,3 +28,13 @@ class RadixRequest(BaseModel):
     instance_id: str
     info: List[RadixOp]
 
+
+class DigestRequest(BaseModel):
+    instance_id: str
+    level: int = 0 # 摘要树的层号，0 是根
+    buckets: List[int] = Field(default_factory=lambda: [0]) # 本层要展开的桶
+
+
+class PathsRequest(BaseModel):
+    instance_id: str
+    buckets: List[int] = Field(default_factory=list) # 叶子桶
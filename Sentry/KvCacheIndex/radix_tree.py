@@ -2,6 +2,7 @@ import threading
 from collections import defaultdict
 from typing import List, Any, Dict, Tuple, Optional, Set
 from KvCacheIndex.base_prefix_cache import BasePrefixCache
+from KvCacheIndex.path_digest import PathDigest, path_hash
 
 from utils.logger import logger
 
@@ -13,6 +14,7 @@ class TreeNode:
         self.key: List[int] = None
         self.value: List[int] = None
         self.lock = threading.RLock()  # 节点级锁，保证局部线程安全
+        self.path_hash: Optional[int] = None  # 根到节点末尾的完整路径哈希（反熵摘要用），split 不改变已有节点的路径
 
         self.id = TreeNode.counter if id is None else id
         TreeNode.counter += 1
@@ -36,9 +38,15 @@ class TreeNode:
 
 
 class RadixTree(BasePrefixCache):
-    def __init__(self, instance_id):
+    def __init__(self, instance_id, max_index_depth: int = 0):
         self.root = TreeNode()
         self.instance_id = instance_id
+        # 内容摘要：成员是所有叶子节点（即实例缓存的极大路径），Nexuts 用它做反熵比对
+        self.digest = PathDigest()
+        self.digest_lock = threading.Lock()
+        # Nexuts 只索引前 max_index_depth 个 token，摘要里的路径同样截断；截断后相同的多个叶子共用一个成员
+        self.max_index_depth = int(max_index_depth)
+        self.digest_leaves: Dict[int, Set[TreeNode]] = {}  # 截断路径哈希 -> 叶子节点，只在设置了上限时维护
 
     
     def _print_tree(self):
@@ -60,6 +68,7 @@ class RadixTree(BasePrefixCache):
         # 外部调用接口
         # 创建节点
         self.root = self._build_tree_from_dict(tree_info)
+        self.rebuild_digest()
         self._print_tree()
 
     def _build_tree_from_dict(self, tree_info: dict, parent: TreeNode = None) -> TreeNode:
@@ -114,7 +123,10 @@ class RadixTree(BasePrefixCache):
                 new_node.value = node_value
                 new_node.parent = node
                 node.children[node_key[0]] = new_node
-            self._print_tree()
+            with self.digest_lock:
+                self._digest_discard(node)  # 父节点不再是叶子
+                if not new_node.children:
+                    self._digest_add(new_node)
             return True
         else:
             return False
@@ -135,9 +147,6 @@ class RadixTree(BasePrefixCache):
                 node.value = node.value[split_length:]
                 with new_node.parent.lock:
                     new_node.parent.children[key] = new_node
-                new_node.key = node.key[:split_length]
-                new_node.value = node.value[:split_length]
-            self._print_tree()
             return True
         else:
             return False
@@ -145,7 +154,93 @@ class RadixTree(BasePrefixCache):
     def _delete_node(self, parent_path: list):
         node = self._find_node(parent_path)
         logger.info("node is None?:{}".format(node is None))
-        for k, v in node.parent.items():
-            if v == node:
-                break
-        del node.parent.children[k] # 更radix tree的删除方式保持一致
+        if node is None or node.parent is None:
+            return False
+        parent = node.parent
+        with parent.lock:
+            for k, v in list(parent.children.items()):
+                if v is node:
+                    del parent.children[k] # 更radix tree的删除方式保持一致
+                    break
+            else:
+                return False
+            node.parent = None
+        with self.digest_lock:
+            stack = [node]  # 整个子树都被删除，子树里的叶子都要移出摘要
+            while stack:
+                current = stack.pop()
+                self._digest_discard(current)
+                stack.extend(current.children.values())
+            if parent is not self.root and not parent.children:
+                self._digest_add(parent)  # 父节点重新成为叶子
+        return True
+
+    # ------------------------------
+    # 内容摘要（反熵）
+    # ------------------------------
+    def _node_path(self, node: TreeNode) -> Tuple[List[int], List[int]]:
+        """根到 node 的完整 key 和 value"""
+        keys, values = [], []
+        current = node
+        while current is not None and current is not self.root:
+            keys.append(current.key or [])
+            values.append(current.value or [])
+            current = current.parent
+        return ([token for chunk in reversed(keys) for token in chunk],
+                [item for chunk in reversed(values) for item in chunk])
+
+    def _node_path_hash(self, node: TreeNode) -> int:
+        if node.path_hash is None:
+            prompt = self._node_path(node)[0]
+            if self.max_index_depth > 0:
+                prompt = prompt[:self.max_index_depth]
+            node.path_hash = path_hash([prompt])
+        return node.path_hash
+
+    def _digest_add(self, node: TreeNode):
+        """叶子加入摘要（调用方持有 digest_lock）"""
+        h = self._node_path_hash(node)
+        if self.max_index_depth > 0:
+            self.digest_leaves.setdefault(h, set()).add(node)
+        self.digest.add(h, node)
+
+    def _digest_discard(self, node: TreeNode):
+        """节点不再是叶子或被删除（调用方持有 digest_lock）；截断路径还有其他叶子时只换成员，不移出摘要"""
+        h = node.path_hash
+        if h is None:
+            return
+        if self.max_index_depth > 0:
+            leaves = self.digest_leaves.get(h)
+            if leaves is None:
+                return
+            leaves.discard(node)
+            if leaves:
+                self.digest.add(h, next(iter(leaves)))
+                return
+            del self.digest_leaves[h]
+        self.digest.discard(h)
+
+    def rebuild_digest(self):
+        with self.digest_lock:
+            self.digest.clear()
+            self.digest_leaves.clear()
+            stack = list(self.root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                else:
+                    self._digest_add(node)
+
+    def digest_children(self, level: int, buckets: List[int]) -> Dict[str, Dict[str, Any]]:
+        return self.digest.children(level, buckets)
+
+    def paths_in_buckets(self, buckets: List[int]) -> List[Dict[str, Any]]:
+        """若干叶子桶内的全部极大路径，供 Nexuts 逐条比对"""
+        result = []
+        for h, node in self.digest.members_in(buckets).items():
+            prompt, prompt_value = self._node_path(node)
+            if self.max_index_depth > 0:
+                prompt, prompt_value = prompt[:self.max_index_depth], prompt_value[:self.max_index_depth]
+            result.append({"hash": h, "prompt": prompt, "prompt_value": prompt_value})
+        return result
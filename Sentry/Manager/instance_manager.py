@@ -11,9 +11,9 @@ from utils.logger import logger
 
 
 class InstanceManager:
-    def __init__(self, instance_info: Dict[str, Any], call_back):
+    def __init__(self, instance_info: Dict[str, Any], call_back, max_index_depth: int = 0):
         self.info = instance_info
-        self.radix_tree = RadixTree(self.info["instance_id"])  # 实例化一颗树
+        self.radix_tree = RadixTree(self.info["instance_id"], max_index_depth)  # 实例化一颗树，摘要按 Nexuts 的索引深度上限截断
         self.ops_lock = threading.Lock()
         self.ops_id_next = 1
         self.queue_lock = threading.Lock()
@@ -29,7 +29,9 @@ class Registry:
                  call_back_for_loss,
                  call_back_set_loss_status,
                  call_back_deal_re_register_pod,
-                 health_interval=10.0
+                 health_interval=10.0,
+                 call_back_resync_pod=None,
+                 max_index_depth=0
                  ):
         # instance_id -> InstanceInfo
         self.instances: Dict[str, InstanceInfo] = {}  # 维护整个节点上的推理实例，包括P和D
@@ -40,6 +42,8 @@ class Registry:
         self.call_back_for_loss = call_back_for_loss
         self.call_back_set_loss_status = call_back_set_loss_status
         self.call_back_deal_re_register_pod = call_back_deal_re_register_pod
+        self.call_back_resync_pod = call_back_resync_pod # 恢复出完整的树后整体同步给 Nexuts
+        self.max_index_depth = max_index_depth # Nexuts 的索引深度上限，实例树的摘要按它截断
 
         self.load_from_sqlite()  # load all instance
 
@@ -60,7 +64,7 @@ class Registry:
                     r = requests.get(url, timeout=1).json()
                     if r["instance_type"] == "prefill": # 如果实例是P节点，就要拉取树
                         inst = InstanceInfo(info)
-                        inst.manager = InstanceManager(info, self.call_back)
+                        inst.manager = InstanceManager(info, self.call_back, self.max_index_depth)
                         # TODO 是因为sentry异常，然后重启导致的  需要拉取对应的信息 等待PD Server提供接口
                         #url = f"http://{info['node_ip']}:{info['service_port']}/v1/radixtree/full"
                         url = f"http://127.0.0.1:{info['service_port']}/v1/radixtree/full"
@@ -74,6 +78,8 @@ class Registry:
                     else:
                         self.register(info=info, write_db=False)  # 直接走重新注册维护实例，然后不写db
                     self.call_back_deal_re_register_pod(info) # 重新注册给Nexuts，Nexuts那边会处理
+                    if r.get("tree") is not None and self.call_back_resync_pod is not None:
+                        self.call_back_resync_pod(info["instance_id"], r["tree"]) # 注册之后再整体同步
                 except Exception as e:
                     logger.warning(f"[HealthCheck] ({info['instance_id']}) health check failed: {e}")
                     self.instance_db.delete_instance(info["instance_id"]) # 直接删除，Sentry恢复时，这个实例不在服务
@@ -90,7 +96,7 @@ class Registry:
 
             inst = InstanceInfo(info)
             if info["instance_type"] == "prefill":
-                inst.manager = InstanceManager(info, self.call_back)  # prefill节点才需要
+                inst.manager = InstanceManager(info, self.call_back, self.max_index_depth)  # prefill节点才需要
 
             with self.lock:
                 if instance_id in self.instances:
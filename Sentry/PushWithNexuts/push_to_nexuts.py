@@ -34,7 +34,9 @@ class PushToNexuts:
         self.nexuts_update_api_url = f"{prefix}{config['nexuts_api_url']['post_update']}"
         self.nexuts_deregister_api_url = f"{prefix}{config['nexuts_api_url']['deregister_pod']}"
         self.set_status_api_url = f"{prefix}{config['nexuts_api_url']['set_status']}"
+        self.nexuts_resync_api_url = f"{prefix}{config['nexuts_api_url'].get('resync_pod', '/v1/Nexuts/resync_instance')}"
         self.send_nexuts_cycle = config['send_nexuts_cycle']
+        self.max_index_depth = int(config.get('max_index_depth', 0)) # 只推送 prompt 的前多少个 token，需和 Nexuts 的 tree_budget.max_index_depth 一致，0 表示不截断
         # Redis
 
         self.r = redis.StrictRedis(
@@ -176,6 +178,22 @@ class PushToNexuts:
             logger.info(e)
             return False
 
+    def resync_pod_to_nexuts(self, instance_id, tree_info):
+        """
+        把实例的完整前缀树发给 Nexuts，整体替换该实例在合并树上的记录，不用逐条回放积压的变更
+        :param tree_info: /v1/radixtree/full 返回的 tree
+        """
+        if self.max_index_depth > 0:
+            tree_info = self._bound_tree(tree_info, self.max_index_depth)
+        info = {"sentry_id": self.sentry_id, "instance_id": instance_id, "tree": tree_info}
+        try:
+            r = requests.post(self.nexuts_resync_api_url, json=info)
+            logger.info("resync instance {} result:{}".format(instance_id, r.text))
+            return True
+        except Exception as e:
+            logger.info(e)
+            return False
+
     def add_active_callback(self, info: dict):
         """
         class RadixRequest(BaseModel):
@@ -205,6 +223,10 @@ class PushToNexuts:
                 data["prompt_value"] = radix_update_info.get("prompt_value")
             if radix_update_info["op_type"] == "delete_node":
                 data["length"] = radix_update_info.get("split_length")
+            if self.max_index_depth > 0:
+                data = self._bound_update(data)
+                if data is None:  # 删除的部分都在上限之后，Nexuts 上本来就没有
+                    continue
 
             # 转换为Nexuts格式
             nexuts_data = self._prepare_update_for_nexuts(data)  
@@ -213,6 +235,33 @@ class PushToNexuts:
                 self._active_buffer.append(nexuts_data)
         logger.info("add active callback done")
     
+    def _bound_update(self, data: dict):
+        """按 max_index_depth 截断一条变更，删除区间整个在上限之后时返回 None"""
+        cap = self.max_index_depth
+        prompt = data.get("prompt") or []
+        if len(prompt) <= cap:
+            return data
+        data["prompt"] = prompt[:cap]
+        if data["op_type"] == "insert_node":
+            data["prompt_value"] = (data.get("prompt_value") or [])[:cap]
+            return data
+        keep = max(len(prompt) - (data.get("length") or 0), 0)
+        if keep >= cap:
+            return None
+        data["length"] = cap - keep
+        return data
+
+    @staticmethod
+    def _bound_tree(tree_info: dict, cap: int) -> dict:
+        """/v1/radixtree/full 形状的树只保留根以下前 cap 个 token"""
+        def bound(node: dict, budget: int) -> dict:
+            key = list(node.get("key") or [])[:budget]
+            bounded = {"key": key, "value": list(node.get("value") or [])[:budget], "children": []}
+            if budget > len(key):
+                bounded["children"] = [bound(child, budget - len(key)) for child in node.get("children") or []]
+            return bounded
+        return bound(tree_info, cap)
+
     def _prepare_update_for_nexuts(self, update: dict) -> dict:  
         """准备发送到 Nexuts 的更新数据，转换操作类型和字段名"""  
         nexuts_update = update.copy()  
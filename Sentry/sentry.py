@@ -34,7 +34,9 @@ class Sentry:
                                  self.deal_loss_inference_pod,
                                  self.deal_set_status,
                                  self.deal_re_register_pod,
-                                 health_interval)  # 注册DB
+                                 health_interval,
+                                 self.push_manager.resync_pod_to_nexuts,
+                                 self.push_manager.max_index_depth)  # 注册DB
 
     @staticmethod
     def _random_str(length=13):
@@ -75,6 +77,24 @@ class Sentry:
         inst.manager.update_tree(info)
         return {"result": "ok"}
 
+    def _radix_tree(self, instance_id):
+        inst = self.register.get(instance_id)
+        if inst is None or inst.manager is None:  # 未注册或者不是 prefill 实例
+            return None
+        return inst.manager.radix_tree
+
+    def radix_digest(self, info: dict):
+        tree = self._radix_tree(info["instance_id"])
+        if tree is None:
+            return None
+        return tree.digest_children(info["level"], info["buckets"])
+
+    def radix_paths(self, info: dict):
+        tree = self._radix_tree(info["instance_id"])
+        if tree is None:
+            return None
+        return tree.paths_in_buckets(info["buckets"])
+
     def deal_loss_inference_pod(self, instance_id):  # 删除实例
         self.push_manager.deal_loss_pod(instance_id)
 
@@ -0,0 +1,457 @@
+"""
+MergePrefixTree 并发压力 + 差分模糊测试
+
+多个线程随机交错执行 插入 / 淘汰 / 按实例整体移除 / 全量替换 / 路由查询，
+结束后和单线程参考模型逐实例比对，同时统计吞吐和 p99 延迟。
+每个线程独占一组实例（和线上按 instance_id 分 lane 一致），所以不论线程如何交错，
+每个实例的最终状态都是确定的；所有线程共享同一批 prompt 前缀，节点 split 会在实例之间激烈竞争。
+
+--profile 选择树的配置（见 PROFILES），all 依次跑全部配置：
+    base        单 lane，各线程直接调用 apply_batch
+    lanes       多 lane，变更经 update_prefix_tree 分到各实例的 lane，不同 lane 并发写同一棵树
+    budget      多 lane + 节点预算，后台 LRU 淘汰和写入并发
+    ttl         多 lane + 置信度衰减和 TTL 过期，后台过期清理和写入并发
+    checkpoint  多 lane + 前缀检查点，长 prompt 的路由走检查点二分
+    depth       多 lane + 索引深度上限，参考模型同样截断
+    generational  GenerationalPrefixIndex，年轻代很小，运行期间后台不断封存、合并，墓碑和代数跨代生效
+budget/ttl 会在后台删掉记录，只检查树是参考模型的子集（匹配长度不超过参考模型），其余配置要求完全一致。
+淘汰和 Sentry 一样只淘汰叶子，两种索引的删除语义只在这个前提下一致。
+
+用法（离线运行，固定种子）：
+    python stress_tree.py --seed 2024 --threads 8 --ops 20000
+    python stress_tree.py --profile all --ops 3000             # 依次跑全部配置
+    python stress_tree.py --output result.json                  # 记录本次结果
+    python stress_tree.py --baseline result.json --tolerance 0.2 # 吞吐下降或 p99 上升超过 20% 视为回退
+正确性错误或性能回退时以非 0 退出。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import wait
+from typing import Dict, List, Set, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Nexuts"))
+
+from Tree.generational_index import GenerationalPrefixIndex  # noqa: E402
+from Tree.tree import MergePrefixTree  # noqa: E402
+
+# tree: 索引的构造参数；via_lanes: 变更经 update_prefix_tree 进各实例的 lane（否则各线程直接 apply_batch）；
+# exact: 树和参考模型必须完全一致，False 时后台会删掉记录，只检查子集；generational: 用 GenerationalPrefixIndex
+PROFILES = {
+    "base": {"tree": {"ingest_lanes": 1}, "via_lanes": False, "exact": True},
+    "lanes": {"tree": {"ingest_lanes": 8}, "via_lanes": True, "exact": True},
+    "budget": {"tree": {"ingest_lanes": 4, "max_nodes": 256, "evict_interval": 0.005},
+               "via_lanes": True, "exact": False},
+    "ttl": {"tree": {"ingest_lanes": 4, "confidence_half_life": 0.5, "presence_ttl": 0.2, "sweep_interval": 0.02},
+            "via_lanes": True, "exact": False},
+    "checkpoint": {"tree": {"ingest_lanes": 4, "checkpoint_interval": 8}, "via_lanes": True, "exact": True},
+    "depth": {"tree": {"ingest_lanes": 4, "max_index_depth": 24}, "via_lanes": True, "exact": True},
+    "generational": {"tree": {"ingest_lanes": 4, "young_max_nodes": 64, "max_generations": 4,
+                              "maintenance_interval": 0.002},
+                     "via_lanes": True, "exact": True, "generational": True},
+}
+
+
+class ReferenceModel:
+    """单线程参考模型：每个实例持有的前缀集合（前缀闭合）；cap > 0 时和树一样只保留 prompt 的前 cap 个 token"""
+
+    def __init__(self, cap: int = 0):
+        self.prefixes: Dict[str, Set[Tuple[int, ...]]] = defaultdict(set)
+        self.cap = cap
+
+    def insert(self, instance_id: str, prompt: List[int]):
+        if self.cap > 0:
+            prompt = prompt[:self.cap]
+        held = self.prefixes[instance_id]
+        for k in range(1, len(prompt) + 1):
+            held.add(tuple(prompt[:k]))
+
+    def maximal_paths(self, instance_id: str) -> Set[Tuple[int, ...]]:
+        held = self.prefixes[instance_id]
+        children = {p[:-1] for p in held}
+        return {p for p in held if p not in children}
+
+    def evict(self, instance_id: str, prompt: List[int], length: int):
+        held = self.prefixes[instance_id]
+        keep = len(prompt) - length
+        for k in range(keep + 1, len(prompt) + 1):
+            held.discard(tuple(prompt[:k]))
+
+    def clear(self, instance_id: str):
+        self.prefixes[instance_id] = set()
+
+    def match_length(self, instance_id: str, query: List[int]) -> int:
+        held = self.prefixes[instance_id]
+        best = 0
+        for k in range(1, len(query) + 1):
+            if tuple(query[:k]) not in held:
+                break
+            best = k
+        return best
+
+
+def evict_length(model: ReferenceModel, instance_id: str, path: Tuple[int, ...], rng: random.Random) -> int:
+    """和 Sentry 一样只淘汰叶子：淘汰长度不能越过和该实例其他路径的公共前缀"""
+    shared = 0
+    for other in model.maximal_paths(instance_id):
+        if other == path:
+            continue
+        lcp = 0
+        for a, b in zip(path, other):
+            if a != b:
+                break
+            lcp += 1
+        shared = max(shared, lcp)
+    return rng.randint(1, len(path) - shared) if len(path) > shared else 0
+
+
+class Worker(threading.Thread):
+    def __init__(self, tid: int, args, profile: Dict, tree: MergePrefixTree, prompt_pool: List[List[int]],
+                 start_barrier):
+        super().__init__(name=f"stress-{tid}", daemon=True)
+        self.tid = tid
+        self.args = args
+        self.tree = tree
+        self.pool = prompt_pool
+        self.rng = random.Random(args.seed * 1000 + tid)
+        self.instances = [f"inst-{tid}-{i}" for i in range(args.instances_per_thread)]
+        self.via_lanes = profile["via_lanes"]
+        self.model = ReferenceModel(profile["tree"].get("max_index_depth", 0))  # 只记录本线程的实例
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+        self.errors: List[str] = []
+        self.start_barrier = start_barrier
+        self.session_id = f"session-{tid}"
+        self.session_prompt: List[int] = []  # 多轮会话：每轮在上一轮 prompt 后追加新 token
+
+    def _prompt(self) -> List[int]:
+        base = self.rng.choice(self.pool)
+        return base[:self.rng.randint(1, len(base))] + \
+            [self.rng.randint(0, self.args.vocab - 1) for _ in range(self.rng.randint(0, self.args.tail_tokens))]
+
+    def _apply(self, update_info: Dict):
+        if self.via_lanes:
+            wait(self.tree.update_prefix_tree({"updates": [update_info]}, write_wal=False))
+            return
+        version = self.tree._get_global_version()
+        self.tree.apply_batch([(version, update_info)])
+
+    def run(self):
+        self.start_barrier.wait()
+        for _ in range(self.args.ops):
+            instance_id = self.rng.choice(self.instances)
+            r = self.rng.random()
+            begin = time.perf_counter()
+            try:
+                if r < 0.45:
+                    op = "insert"
+                    prompt = self._prompt()
+                    self._apply({"op_type": "insert_node", "instance_id": instance_id,
+                                 "prompt": prompt, "prompt_value": list(range(len(prompt)))})
+                    self.model.insert(instance_id, prompt)
+                elif r < 0.65:
+                    op = "evict"
+                    paths = sorted(self.model.maximal_paths(instance_id))
+                    if not paths:
+                        continue
+                    path = self.rng.choice(paths)
+                    length = evict_length(self.model, instance_id, path, self.rng)
+                    if length <= 0:
+                        continue
+                    begin = time.perf_counter()
+                    self._apply({"op_type": "delete_node", "instance_id": instance_id,
+                                 "prompt": list(path), "length": length})
+                    self.model.evict(instance_id, list(path), length)
+                elif r < 0.67:
+                    op = "evict_instance"  # 和实例注销/失联一样走 tombstone_instance，经该实例的 lane 执行
+                    wait(self.tree.tombstone_instance(instance_id))
+                    self.model.clear(instance_id)
+                elif r < 0.68:
+                    op = "resync_empty"
+                    self._apply({"op_type": "resync_instance", "instance_id": instance_id, "paths": []})
+                    self.model.clear(instance_id)
+                elif r < 0.70:
+                    op = "resync"
+                    image = [self._prompt() for _ in range(self.rng.randint(1, 8))]
+                    self._apply({"op_type": "resync_instance", "instance_id": instance_id,
+                                 "paths": [[p, list(range(len(p)))] for p in image]})
+                    self.model.clear(instance_id)
+                    for p in image:
+                        self.model.insert(instance_id, p)
+                elif r < 0.85:
+                    op = "search"
+                    if isinstance(self.tree, GenerationalPrefixIndex):  # 分代索引只有打分查询
+                        result = list(self.tree.match_instances_with_prefix(self._prompt()))
+                    else:
+                        result = self.tree.search_instances_with_prefix(self._prompt())
+                    if not isinstance(result, list):
+                        self.errors.append(f"search returned {type(result)}")
+                else:
+                    op = "session_match"
+                    if not self.session_prompt or self.rng.random() < 0.05:
+                        self.session_prompt = self._prompt()  # 新会话
+                    else:
+                        self.session_prompt = self.session_prompt + \
+                            [self.rng.randint(0, self.args.vocab - 1) for _ in range(self.rng.randint(0, self.args.tail_tokens))]
+                    result = self.tree.match_instances_with_prefix(self.session_prompt, session_id=self.session_id)
+                    if not isinstance(result, dict):
+                        self.errors.append(f"session match returned {type(result)}")
+            except Exception as e:
+                self.errors.append(f"{op} raised {type(e).__name__}: {e}")
+                continue
+            self.latency[op].append(time.perf_counter() - begin)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def tree_maximal_paths(tree: MergePrefixTree) -> Tuple[Dict[str, Set[Tuple[int, ...]]], List[str]]:
+    """遍历树：每个实例的极大路径，以及结构上的问题（前缀不闭合、空叶子、depth 错误）"""
+    paths: Dict[str, Set[Tuple[int, ...]]] = defaultdict(set)
+    problems = []
+    stack = [(child, ()) for child in tree.root.children.values()]
+    while stack:
+        node, prefix = stack.pop()
+        path = prefix + tuple(node.key.tolist())
+        if node.depth != len(path):
+            problems.append(f"depth {node.depth} != {len(path)} at node {node.id}")
+        if not node.children and len(node.value) == 0:
+            problems.append(f"empty leaf {node.id}")
+        parent_holders = set(node.parent.value.keys()) if node.parent is not tree.root else None
+        for instance_id in node.value.keys():
+            if not tree.is_live(node, instance_id):
+                continue  # 旧代数的记录（已作废，等待回收）
+            if parent_holders is not None and instance_id not in parent_holders:
+                problems.append(f"{instance_id} held at node {node.id} but not by its parent")
+            if len(node.value[instance_id]) != len(node.key):
+                problems.append(f"{instance_id} value length mismatch at node {node.id}")
+            if not any(tree.is_live(child, instance_id) for child in node.children.values()):
+                paths[instance_id].add(path)
+        for child in node.children.values():
+            if child.parent is not node:
+                problems.append(f"broken parent link at node {child.id}")
+            stack.append((child, path))
+    return paths, problems
+
+
+def verify_paths(tree: MergePrefixTree, workers: List[Worker], stage: str, exact: bool) -> List[str]:
+    errors = []
+    paths, problems = tree_maximal_paths(tree)
+    errors.extend(f"[{stage}] {p}" for p in problems)
+    for worker in workers:
+        for instance_id in worker.instances:
+            got = paths.get(instance_id, set())
+            if exact:
+                want = worker.model.maximal_paths(instance_id)
+                if want != got:
+                    errors.append(f"[{stage}] {instance_id}: {len(want - got)} paths missing, {len(got - want)} unexpected")
+            else:
+                # 淘汰/过期只会删掉记录：树上每条路径都必须是参考模型持有的前缀
+                unexpected = [p for p in got if p not in worker.model.prefixes[instance_id]]
+                if unexpected:
+                    errors.append(f"[{stage}] {instance_id}: {len(unexpected)} paths not held by the reference model")
+    return errors
+
+
+def verify(tree: MergePrefixTree, workers: List[Worker], args, profile: Dict) -> List[str]:
+    errors = []
+    exact = profile["exact"]
+    for worker in workers:
+        errors.extend(f"[{worker.name}] {e}" for e in worker.errors)
+    if profile.get("generational"):
+        return errors + verify_generational(tree, workers, args)
+    # 停掉后台淘汰/过期，比对期间树不再变化
+    tree.stop_evict()
+    tree.stop_sweeper()
+    if tree.max_nodes > 0:
+        tree.evict_lru()
+        if tree.node_count > tree.max_nodes:
+            errors.append(f"node_count {tree.node_count} over budget {tree.max_nodes} after evict_lru")
+    # 作废的记录回收前后，实例可见的内容都应该和参考模型一致
+    errors.extend(verify_paths(tree, workers, "before gc", exact))
+    tree.collect_tombstones()
+    errors.extend(verify_paths(tree, workers, "after gc", exact))
+
+    stats = tree.tree_stats()
+    tree.recount()
+    recounted = tree.tree_stats()
+    for key in ("node_count", "token_count", "internal_count", "instance_tokens", "depth_histogram"):
+        if stats[key] != recounted[key]:
+            errors.append(f"incremental stats {key} differ from recount")
+
+    errors.extend(verify_queries(tree, workers, args, exact))
+    return errors
+
+
+def verify_queries(tree, workers: List[Worker], args, exact: bool) -> List[str]:
+    """路由查询：每个实例的匹配长度和参考模型一致"""
+    errors = []
+    max_index_depth = tree.max_index_depth
+    rng = random.Random(args.seed)
+    for k in range(args.queries):
+        worker = rng.choice(workers)
+        if k % 2:
+            query = worker._prompt()
+            scores = tree.match_instances_with_prefix(query)
+        else:
+            # 会话游标是在并发写入期间留下的，从游标继续匹配的结果也要和参考模型一致
+            query = worker.session_prompt + [rng.randint(0, args.vocab - 1) for _ in range(rng.randint(0, args.tail_tokens))]
+            scores = tree.match_instances_with_prefix(query, session_id=worker.session_id)
+        for w in workers:
+            for instance_id in w.instances:
+                want = w.model.match_length(instance_id, query)
+                score = scores.get(instance_id, {})
+                got = int(score.get("match_length", 0))
+                if (want != got) if exact else (got > want):
+                    errors.append(f"query match_length {instance_id}: want {want}, got {got}")
+                if score and not 0.0 < score["confidence"] <= 1.0:
+                    errors.append(f"query confidence {instance_id}: {score['confidence']}")
+                if score and score["capped"] != (0 < max_index_depth <= got):
+                    errors.append(f"query capped {instance_id}: {score['capped']} at match_length {got}")
+    return errors
+
+
+def generation_node_counts(gen) -> Tuple[int, int]:
+    """遍历一代，返回实际的 (节点数, token 数)"""
+    nodes = tokens = 0
+    stack = list(gen.root.children.values())
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        tokens += len(node.key)
+        stack.extend(node.children.values())
+    return nodes, tokens
+
+
+def verify_generational(index: GenerationalPrefixIndex, workers: List[Worker], args) -> List[str]:
+    """
+    停掉后台维护后比对：先按运行结束时的代布局查询，再封存年轻代、合并到底后再查一次，
+    两次都要求每个实例的匹配长度和参考模型一致；每个实例的极大路径也逐条查询
+    """
+    errors = []
+    index.stop_maintenance()
+    if index.sealed == 0 or index.merges == 0:
+        errors.append(f"run did not exercise the generations: sealed {index.sealed}, merges {index.merges}")
+    for stage in ("layered", "compacted"):
+        if stage == "compacted":
+            index.seal()
+            index.compact()
+        for gen in index._generations_newest_first():
+            if generation_node_counts(gen) != (gen.node_count, gen.token_count):
+                errors.append(f"[{stage}] generation {gen.gen_id} counters {gen.node_count}/{gen.token_count} "
+                              f"differ from recount {generation_node_counts(gen)}")
+        errors.extend(f"[{stage}] {e}" for e in verify_queries(index, workers, args, True))
+        for worker in workers:
+            for instance_id in worker.instances:
+                for path in worker.model.maximal_paths(instance_id):
+                    got = int(index.match_instances_with_prefix(list(path)).get(instance_id, {}).get("match_length", 0))
+                    if got != len(path):
+                        errors.append(f"[{stage}] path match_length {instance_id}: want {len(path)}, got {got}")
+    return errors
+
+
+def run_profile(name: str, args) -> Dict:
+    profile = PROFILES[name]
+    rng = random.Random(args.seed)
+    pool = [[rng.randint(0, args.vocab - 1) for _ in range(args.prompt_len)] for _ in range(args.pool)]
+    if profile.get("generational"):
+        tree = GenerationalPrefixIndex(**profile["tree"])
+    else:
+        tree = MergePrefixTree(content_digest=True, session_cache_size=args.threads, **profile["tree"])
+    barrier = threading.Barrier(args.threads + 1)
+    workers = [Worker(tid, args, profile, tree, pool, barrier) for tid in range(args.threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    begin = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - begin
+
+    latency = defaultdict(list)
+    for worker in workers:
+        for op, values in worker.latency.items():
+            latency[op].extend(values)
+    total_ops = sum(len(values) for values in latency.values())
+    result = {
+        "profile": name,
+        "seed": args.seed,
+        "threads": args.threads,
+        "total_ops": total_ops,
+        "elapsed_seconds": round(elapsed, 3),
+        "ops_per_sec": round(total_ops / elapsed, 1) if elapsed else 0.0,
+        "p99_ms": round(percentile([v for values in latency.values() for v in values], 0.99) * 1000, 3),
+        "ops": {op: {"count": len(values),
+                     "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                     "p99_ms": round(percentile(values, 0.99) * 1000, 3)}
+                for op, values in sorted(latency.items())},
+    }
+    if profile.get("generational"):
+        stats = tree.tree_stats()
+        result["tree"] = {key: stats[key] for key in ("node_count", "token_count", "sealed", "merges")}
+    else:
+        result["tree"] = {"node_count": tree.node_count, "token_count": tree.token_count,
+                          "evicted_nodes": tree.stats.evicted_nodes, "expired_presences": tree.expired_presences}
+    result["errors"] = verify(tree, workers, args, profile)
+    return result
+
+
+def regressions(result: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    errors = []
+    if result["ops_per_sec"] < baseline["ops_per_sec"] * (1 - tolerance):
+        errors.append(f"throughput regression: {result['ops_per_sec']} < {baseline['ops_per_sec']} ops/s")
+    if result["p99_ms"] > baseline["p99_ms"] * (1 + tolerance):
+        errors.append(f"p99 regression: {result['p99_ms']} > {baseline['p99_ms']} ms")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MergePrefixTree concurrency stress & differential fuzz")
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--ops", type=int, default=5000, help="每个线程的操作数")
+    parser.add_argument("--instances-per-thread", type=int, default=4)
+    parser.add_argument("--pool", type=int, default=32, help="共享前缀的 prompt 数")
+    parser.add_argument("--prompt-len", type=int, default=64)
+    parser.add_argument("--tail-tokens", type=int, default=8)
+    parser.add_argument("--vocab", type=int, default=32, help="词表越小，分叉和 split 越多")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--output", type=str, default=None, help="结果写入 JSON 文件")
+    parser.add_argument("--baseline", type=str, default=None, help="和之前的结果比较，超过容忍度视为性能回退")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--profile", choices=sorted(PROFILES) + ["all"], default="base")
+    args = parser.parse_args()
+
+    names = sorted(PROFILES) if args.profile == "all" else [args.profile]
+    results = {name: run_profile(name, args) for name in names}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baselines = baseline.get("profiles", {baseline.get("profile", "base"): baseline})
+        for name, result in results.items():
+            if name in baselines:
+                result["errors"].extend(regressions(result, baselines[name], args.tolerance))
+    passed = True
+    for result in results.values():
+        passed = passed and not result["errors"]
+        result["passed"] = not result["errors"]
+        result["errors"] = result["errors"][:50]
+    output = results[names[0]] if len(names) == 1 else {"profiles": results, "passed": passed}
+
+    print(json.dumps(output, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2, ensure_ascii=False)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
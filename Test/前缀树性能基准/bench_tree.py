@@ -0,0 +1,340 @@
+"""
+前缀树微基准：用接近真实 LLM 流量形状的 prompt 压测 Nexuts 的 MergePrefixTree 和 Sentry 的 RadixTree。
+
+负载（--workloads）：
+    system_prompt  少量共享 system prompt + 各不相同的用户输入
+    multi_turn     多轮对话，每一轮在上一轮 prompt 后面追加回复和新问题
+    rag            system prompt + 从共享文档库里挑几篇文档 + 问题
+    random         完全随机的 prompt，几乎没有共享前缀
+指标（--ops）：insert / lookup / evict / remove_instance（仅 MergePrefixTree，Sentry 每个实例一棵树）
+
+每个 (树, 负载, 规模) 先插入到目标节点数，插入阶段即 insert 指标，然后依次测 lookup、evict、remove_instance。
+结果每行一个 JSON（JSON Lines）输出到 stdout，--output 追加写入文件，附带 commit，便于跨提交比较：
+    python bench_tree.py --sizes 10000,100000 --output bench.jsonl
+    python bench_tree.py --sizes 10000,100000 --compare bench.jsonl
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.abspath(os.path.join(HERE, "..", ".."))
+
+
+# ------------------------------
+# 负载生成
+# ------------------------------
+class Workload:
+    def __init__(self, name: str, seed: int, vocab: int):
+        self.name = name
+        self.rng = random.Random(seed)
+        self.vocab = vocab
+        self.system_prompts = [self._tokens(512, 2048) for _ in range(8)]
+        self.documents = [self._tokens(256, 1024) for _ in range(256)]
+        self.conversations: List[List[int]] = []
+
+    def _tokens(self, low: int, high: int) -> List[int]:
+        rng = self.rng
+        return [rng.randrange(self.vocab) for _ in range(rng.randint(low, high))]
+
+    def next_prompt(self) -> List[int]:
+        rng = self.rng
+        if self.name == "system_prompt":
+            return rng.choice(self.system_prompts) + self._tokens(32, 256)
+        if self.name == "multi_turn":
+            if not self.conversations or rng.random() < 0.2 or len(self.conversations) < 16:
+                prompt = rng.choice(self.system_prompts) + self._tokens(32, 256)
+                self.conversations.append(prompt)
+                if len(self.conversations) > 1024:
+                    self.conversations.pop(0)
+                return prompt
+            i = rng.randrange(len(self.conversations))
+            prompt = self.conversations[i] + self._tokens(64, 256)  # 上一轮回复 + 新问题
+            self.conversations[i] = prompt if len(prompt) < 16384 else prompt[:512]
+            return prompt
+        if self.name == "rag":
+            docs = rng.sample(self.documents, 3)
+            return self.system_prompts[0] + [t for doc in docs for t in doc] + self._tokens(16, 128)
+        return self._tokens(128, 1024)
+
+
+# ------------------------------
+# 被测对象
+# ------------------------------
+class MergeTreeTarget:
+    """Nexuts 的合并树：直接调用 apply_batch，测树本身的开销（不含 WAL 和 lane 排队）"""
+    name = "MergePrefixTree"
+
+    def __init__(self, instances: int):
+        sys.path.insert(0, os.path.join(REPO, "Nexuts"))
+        from Tree.tree import MergePrefixTree
+        self.tree = MergePrefixTree(ingest_lanes=1)
+        self.instances = [f"bench-{i}" for i in range(instances)]
+        self.rng = random.Random(0)
+
+    def node_count(self) -> int:
+        return self.tree.node_count
+
+    def insert(self, prompt: List[int]):
+        version = self.tree._get_global_version()
+        self.tree.apply_batch([(version, {"op_type": "insert_node", "instance_id": self.rng.choice(self.instances),
+                                          "prompt": prompt, "prompt_value": prompt})])
+
+    def lookup(self, prompt: List[int]):
+        self.tree.search_instances_with_prefix(prompt)
+
+    def eviction_ops(self, n: int) -> List[Callable]:
+        """随机挑 n 个叶子，各自淘汰一个持有实例在叶子上的整段"""
+        leaves, stack = [], [self.tree.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self.tree.root and len(node.value) > 0:
+                leaves.append(node)
+        ops = []
+        for leaf in self.rng.sample(leaves, min(n, len(leaves))):
+            prompt = self.tree._node_prompt(leaf)
+            update_info = {"op_type": "delete_node", "instance_id": next(iter(leaf.value.keys())),
+                           "prompt": prompt, "length": len(leaf.key)}
+            ops.append(lambda update_info=update_info: self.tree.apply_batch(
+                [(self.tree._get_global_version(), update_info)]))
+        return ops
+
+    def removal_ops(self) -> List[Callable]:
+        return [lambda instance_id=instance_id: self.tree.apply_batch(
+            [(self.tree._get_global_version(), {"op_type": "resync_instance", "instance_id": instance_id, "paths": []})])
+                for instance_id in self.instances]
+
+    def close(self):
+        self.tree._executor.shutdown()
+
+
+class RadixTreeTarget:
+    """
+    Sentry 的单实例 RadixTree：它只接受 PD Server 算好的 split/insert/delete 操作，
+    这里的驱动按 PD Server 的方式先沿树匹配再生成操作；insert/evict 只计 apply_op 的时间，lookup 计匹配的时间。
+    """
+    name = "RadixTree"
+
+    def __init__(self, instances: int):
+        sys.path.insert(0, os.path.join(REPO, "Sentry"))
+        from KvCacheIndex.radix_tree import RadixTree
+        self.tree = RadixTree("bench-0")
+        self.nodes = 1
+        self.rng = random.Random(0)
+
+    def node_count(self) -> int:
+        return self.nodes
+
+    @staticmethod
+    def _lcp(a: List[int], b: List[int], offset: int) -> int:
+        n = min(len(a), len(b) - offset)
+        if a[:n] == b[offset:offset + n]:
+            return n
+        i = 0
+        while i < n and a[i] == b[offset + i]:
+            i += 1
+        return i
+
+    def _match(self, prompt: List[int]) -> Tuple[list, object, int, int]:
+        """返回 (完整匹配的路径段, 最后部分匹配的子节点或 None, 部分匹配长度, 已匹配 token 数)"""
+        node, segs, i = self.tree.root, [], 0
+        while i < len(prompt):
+            child = node.children.get(prompt[i])
+            if child is None:
+                return segs, None, 0, i
+            m = self._lcp(child.key, prompt, i)
+            if m < len(child.key):
+                return segs, child, m, i + m
+            segs.append(child.key)
+            i += m
+            node = child
+        return segs, None, 0, i
+
+    def insert(self, prompt: List[int]):
+        segs, partial, m, i = self._match(prompt)
+        ops = []
+        if partial is not None:
+            ops.append({"op_type": "split_node", "parent_path": segs + [partial.key], "split_length": m})
+            segs = segs + [partial.key[:m]]
+        if i < len(prompt):
+            ops.append({"op_type": "insert_node", "parent_path": segs,
+                        "insert_key": prompt[i:], "insert_value": prompt[i:]})
+        return ops
+
+    def apply(self, ops: List[Dict]):
+        for op in ops:
+            self.tree.apply_op(op)
+            if op["op_type"] != "delete_node":
+                self.nodes += 1
+
+    def lookup(self, prompt: List[int]):
+        self._match(prompt)
+
+    def eviction_ops(self, n: int) -> List[Callable]:
+        leaves, stack = [], [self.tree.root]
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            elif node is not self.tree.root:
+                leaves.append(node)
+        ops = []
+        for leaf in self.rng.sample(leaves, min(n, len(leaves))):
+            segs, current = [], leaf
+            while current is not self.tree.root:
+                segs.append(current.key)
+                current = current.parent
+            op = {"op_type": "delete_node", "parent_path": list(reversed(segs))}
+            ops.append(lambda op=op: self.tree.apply_op(op))
+        return ops
+
+    def removal_ops(self) -> List[Callable]:
+        return []
+
+    def close(self):
+        pass
+
+
+TARGETS = {"merge": MergeTreeTarget, "radix": RadixTreeTarget}
+
+
+# ------------------------------
+# 测量
+# ------------------------------
+def summarize(latencies: List[float], elapsed: float) -> Dict[str, float]:
+    if not latencies:
+        return {"count": 0}
+    values = sorted(latencies)
+
+    def pct(q):
+        return round(values[min(int(len(values) * q), len(values) - 1)] * 1e6, 2)
+
+    return {"count": len(values), "ops_per_sec": round(len(values) / elapsed, 1) if elapsed else 0.0,
+            "mean_us": round(sum(values) / len(values) * 1e6, 2), "p50_us": pct(0.50), "p99_us": pct(0.99)}
+
+
+def timed(calls: Iterator[Callable]) -> Dict[str, float]:
+    latencies = []
+    begin = time.perf_counter()
+    for call in calls:
+        t0 = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - begin)
+
+
+def run_case(target_name: str, workload_name: str, size: int, args) -> List[Dict]:
+    target = TARGETS[target_name](args.instances)
+    workload = Workload(workload_name, args.seed, args.vocab)
+    ops = set(args.ops.split(","))
+    records = []
+
+    # insert：建树到目标规模
+    latencies, tokens = [], 0
+    begin = time.perf_counter()
+    while target.node_count() < size:
+        prompt = workload.next_prompt()
+        tokens += len(prompt)
+        if isinstance(target, RadixTreeTarget):
+            planned = target.insert(prompt)
+            t0 = time.perf_counter()
+            target.apply(planned)
+        else:
+            t0 = time.perf_counter()
+            target.insert(prompt)
+        latencies.append(time.perf_counter() - t0)
+    build_seconds = time.perf_counter() - begin
+    node_count = target.node_count()
+    summary = summarize(latencies, sum(latencies))
+    summary["tokens_per_sec"] = round(tokens / sum(latencies), 1) if latencies else 0.0
+    records.append(("insert", summary))
+
+    if "lookup" in ops:
+        queries = [workload.next_prompt() for _ in range(args.queries)]
+        records.append(("lookup", timed(lambda q=q: target.lookup(q) for q in queries)))
+    if "evict" in ops:
+        records.append(("evict", timed(iter(target.eviction_ops(args.evictions)))))
+    if "remove_instance" in ops:
+        removal = target.removal_ops()
+        if removal:
+            records.append(("remove_instance", timed(iter(removal))))
+    target.close()
+
+    common = {"commit": args.commit, "timestamp": args.timestamp, "seed": args.seed,
+              "tree": target.name, "workload": workload_name, "size": size,
+              "node_count": node_count, "build_seconds": round(build_seconds, 3)}
+    return [dict(common, op=op, **summary) for op, summary in records if op in ops or op == "insert"]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "-C", REPO, "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def compare(records: List[Dict], baseline_path: str):
+    baseline = {}
+    with open(baseline_path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                baseline[(item["tree"], item["workload"], item["size"], item["op"])] = item
+    print(f"{'tree':<16}{'workload':<14}{'size':>10} {'op':<16}{'ops/s':>12}{'base':>12}{'ratio':>8}{'p99 us':>12}{'base':>12}")
+    for item in records:
+        base = baseline.get((item["tree"], item["workload"], item["size"], item["op"]))
+        if not base or not item.get("count"):
+            continue
+        ratio = item["ops_per_sec"] / base["ops_per_sec"] if base.get("ops_per_sec") else 0.0
+        print(f"{item['tree']:<16}{item['workload']:<14}{item['size']:>10} {item['op']:<16}"
+              f"{item['ops_per_sec']:>12}{base['ops_per_sec']:>12}{ratio:>8.2f}{item['p99_us']:>12}{base['p99_us']:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="prefix tree microbenchmarks")
+    parser.add_argument("--trees", default="merge,radix", help="merge,radix")
+    parser.add_argument("--workloads", default="system_prompt,multi_turn,rag,random")
+    parser.add_argument("--sizes", default="10000,100000", help="目标节点数，可到 10000000（需要足够内存）")
+    parser.add_argument("--ops", default="insert,lookup,evict,remove_instance")
+    parser.add_argument("--instances", type=int, default=8, help="MergePrefixTree 上的实例数")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--evictions", type=int, default=2000)
+    parser.add_argument("--vocab", type=int, default=32000)
+    parser.add_argument("--seed", type=int, default=2024)
+    parser.add_argument("--output", default=None, help="结果追加写入 JSON Lines 文件")
+    parser.add_argument("--compare", default=None, help="和之前的 JSON Lines 结果对比")
+    args = parser.parse_args()
+    try:
+        from loguru import logger
+        logger.remove()  # 树的操作日志会淹没测量结果
+    except ImportError:
+        pass
+    args.commit = git_commit()
+    args.timestamp = datetime.datetime.now().isoformat(timespec="seconds")
+
+    records = []
+    for target_name in args.trees.split(","):
+        for workload_name in args.workloads.split(","):
+            for size in (int(s) for s in args.sizes.split(",")):
+                for record in run_case(target_name, workload_name, size, args):
+                    print(json.dumps(record, ensure_ascii=False), flush=True)
+                    records.append(record)
+    if args.output:
+        with open(args.output, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if args.compare:
+        compare(records, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+缓存感知路由的离线测试：不启动服务，直接用 MergePrefixTree 构造命中长度不同的实例，
+检查 find_worker_by_cache 只在命中前缀最长（或不低于最高分的 match_score_ratio）的实例之间按负载选择。
+
+用法：
+    python test_cache_routing.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Nexuts"))
+
+from Tree.tree import MergePrefixTree  # noqa: E402
+from nexuts import InformationCenter  # noqa: E402
+
+
+class StubSentry:
+    """只提供 find_worker_by_cache 用到的 prefill_list，不起心跳线程"""
+    def __init__(self, prefill_ids):
+        self.prefill_list = {instance_id: {} for instance_id in prefill_ids}
+        self.decode_list = {}
+
+
+def build_center(holdings, loads, min_match_length=4, match_score_ratio=1.0) -> InformationCenter:
+    """holdings: {instance_id: prompt}，loads: {instance_id: weighted_load}"""
+    tree = MergePrefixTree(ingest_lanes=1)
+    for instance_id, prompt in holdings.items():
+        tree.apply_batch([(tree._get_global_version(), {"op_type": "insert_node", "instance_id": instance_id,
+                                                        "prompt": prompt, "prompt_value": list(range(len(prompt)))})])
+    center = InformationCenter.__new__(InformationCenter)  # 只测路由选择，不初始化 WAL/快照/SQLite
+    center.tree = tree
+    center.min_match_length = min_match_length
+    center.match_score_ratio = match_score_ratio
+    center.sentry_instance = {"sentry-0": StubSentry(holdings)}
+    center.instances_status = {instance_id: True for instance_id in holdings}
+    center.instances_metrics = {instance_id: {"weighted_load": load} for instance_id, load in loads.items()}
+    return center
+
+
+def test_long_prefix_holder_wins():
+    prompt = list(range(2000))
+    center = build_center({"long": prompt, "short": prompt[:8]}, {"long": 0.9, "short": 0.1})
+    scores = center.tree.match_instances_with_prefix(prompt)
+    assert scores["long"]["score"] == 2000 and scores["short"]["score"] == 8, scores
+    # short 负载更低，但只命中 8 个 token，不能和命中整段前缀的 long 一起参与负载均衡
+    assert center.find_worker_by_cache(prompt) == "long"
+
+
+def test_least_loaded_among_best():
+    prompt = list(range(2000))
+    center = build_center({"a": prompt, "b": prompt, "short": prompt[:8]}, {"a": 0.6, "b": 0.2, "short": 0.1})
+    assert center.find_worker_by_cache(prompt) == "b"
+
+
+def test_match_score_ratio():
+    prompt = list(range(2000))
+    holdings = {"long": prompt, "most": prompt[:1500], "short": prompt[:8]}
+    loads = {"long": 0.9, "most": 0.3, "short": 0.1}
+    assert build_center(holdings, loads, match_score_ratio=1.0).find_worker_by_cache(prompt) == "long"
+    # 1500 >= 2000 * 0.7，most 也参与负载均衡；short 仍然被排除
+    assert build_center(holdings, loads, match_score_ratio=0.7).find_worker_by_cache(prompt) == "most"
+
+
+def test_min_match_length():
+    prompt = list(range(100))
+    center = build_center({"short": prompt[:3]}, {"short": 0.1}, min_match_length=4)
+    assert center.find_worker_by_cache(prompt) is None
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_") and callable(func):
+            func()
+            print(f"{name} passed")